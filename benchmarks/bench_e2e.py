@@ -0,0 +1,156 @@
+"""
+End-to-end benchmark of `eldata initdb`, `eldata update` and the dashboard
+queries against the local mock API in `eloverblik.mockapi`.
+
+Each step runs in a fresh Python process, working in a temporary data
+directory, and reports its wall time, API requests per second and peak RSS.
+With --baseline, the results are compared to a previous --json output and the
+benchmark exits with status 1 when a step is slower than the baseline by more
+than --tolerance.
+
+Usage:
+    python benchmarks/bench_e2e.py [--meters N] [--years Y] [--workers W]
+        [--latency S] [--json FILE] [--baseline FILE] [--tolerance T]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from eloverblik.mockapi import Fleet, MockAPIServer
+
+# Code run in the child processes. Each prints a JSON line with its results.
+BUILD = """
+import json, resource
+from eloverblik.eloverblik import DatabaseBuilder
+db = DatabaseBuilder(workers={workers}, storage="{storage}")
+db.{method}()
+print(json.dumps({{"requests": db.metrics.requests,
+                   "maxrss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024}}))
+"""
+
+TRIM = """
+import duckdb
+from eloverblik import tools
+conn = duckdb.connect(str(tools.datapath))
+if not tools.is_table(conn, "readings"):
+    raise SystemExit("Trimming is only supported with --storage duckdb")
+conn.execute(
+    "DELETE FROM readings"
+    " WHERE minute >= CAST(epoch(current_date - INTERVAL {days} DAY) // 60 AS INTEGER)"
+)
+conn.close()
+"""
+
+DASHBOARD = """
+import json, resource, time
+from eloverblik import dashboard
+queries = [
+    ("meterids", dashboard.get_meterids_in_db, ()),
+    ("years", dashboard.get_years_in_db, ()),
+    ("overall", dashboard.get_overall_consumption, ()),
+    ("anomaly_summary", dashboard.get_anomaly_summary, ()),
+]
+meterid = dashboard.get_meterids_in_db()[0]
+queries += [
+    ("rolling_avgs", dashboard.get_daily_rolling_avgs, (meterid,)),
+    ("hourly_profile", dashboard.get_hourly_profile, (meterid,)),
+    ("tariffs", dashboard.get_current_tariffs, (meterid,)),
+    ("anomalies", dashboard.get_anomalies, (meterid,)),
+]
+results = {}
+for name, func, args in queries:
+    start = time.perf_counter()
+    func.__wrapped__(*args)
+    results[name] = round((time.perf_counter() - start) * 1000, 2)
+results["maxrss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+print(json.dumps(results))
+"""
+
+
+def run(code: str, cwd: Path, env: dict) -> dict:
+    """Run `code` in a new interpreter and return its wall time and JSON output."""
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=cwd, env=env, check=True,
+        stdout=subprocess.PIPE, text=True,
+    ).stdout
+    wall = time.perf_counter() - start
+    lines = [line for line in out.splitlines() if line.startswith("{")]
+    result = json.loads(lines[-1]) if lines else {}
+    result["wall_s"] = round(wall, 3)
+    if "requests" in result:
+        result["requests_per_s"] = round(result["requests"] / wall, 1)
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Return the (step, metric, value, baseline) exceeding the baseline by `tolerance`."""
+    regressions = []
+    for step, metrics in results.items():
+        for metric in ("wall_s", "maxrss_mb"):
+            old, new = baseline.get(step, {}).get(metric), metrics.get(metric)
+            if old and new and new > old * (1 + tolerance):
+                regressions.append((step, metric, new, old))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--meters", type=int, default=10)
+    parser.add_argument("--years", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--storage", choices=["duckdb", "parquet"], default="duckdb")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds waited by the mock API before each response")
+    parser.add_argument("--trim-days", type=int, default=5,
+                        help="Days deleted before the update, so that it has work to do")
+    parser.add_argument("--json", type=Path, help="Write the results to this file")
+    parser.add_argument("--baseline", type=Path, help="Compare to results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Accepted slowdown relative to the baseline")
+    args = parser.parse_args()
+
+    server = MockAPIServer(fleet=Fleet(args.meters, args.years), latency=args.latency)
+    server.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        (tmp / "token.txt").write_text("benchmark-refresh-token")
+        env = dict(
+            os.environ,
+            ELOVERBLIK_API_URL=server.url,
+            ELOVERBLIK_SPOT_URL=server.spot_url,
+            ELOVERBLIK_DATA_DIR=str(tmp / "data"),
+            PYTHONPATH=os.pathsep.join(
+                [str(Path(__file__).resolve().parent.parent), os.environ.get("PYTHONPATH", "")]
+            ),
+        )
+        build = dict(workers=args.workers, storage=args.storage)
+        results = {"initdb": run(BUILD.format(method="build_dataset", **build), tmp, env)}
+        if args.storage == "duckdb":
+            run(TRIM.format(days=args.trim_days), tmp, env)
+        # Do not let the update be served from the response cache
+        shutil.rmtree(tmp / "data" / "cache", ignore_errors=True)
+        results["update"] = run(BUILD.format(method="update_dataset", **build), tmp, env)
+        results["dashboard"] = run(DASHBOARD, tmp, env)
+    server.shutdown()
+
+    for step, metrics in results.items():
+        print(f"{step:>10}: " + ", ".join(f"{k}={v}" for k, v in metrics.items()))
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for step, metric, new, old in regressions:
+            print(f"REGRESSION {step} {metric}: {new} > {old} (+{args.tolerance:.0%})")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Import-time benchmark of the `eloverblik` CLI.
+
+Runs `eloverblik --help` and `eloverblik <command> --help` for every command
+in a fresh interpreter with `python -X importtime`, and reports the time
+spent importing modules, the median of --repeat runs, and the heavy
+dependencies each of them imported. The benchmark exits with status 1 when a
+command exceeds --budget-ms or imports one of HEAVY, so that it can run as a
+check in CI.
+
+Usage:
+    python benchmarks/bench_import.py [--repeat N] [--budget-ms MS] [--json FILE]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+# Dependencies only the commands doing the work should import
+HEAVY = (
+    "altair", "duckdb", "matplotlib", "numpy", "pandas", "pyarrow", "requests", "streamlit",
+)
+
+# Written to stderr before running the CLI, so that the imports done by the
+# interpreter at startup are not counted
+MARKER = "-- eloverblik --"
+
+CHILD = """
+import sys
+sys.stderr.write({marker!r} + "\\n")
+from eloverblik.scripts.eldata import eloverblik
+eloverblik({args!r}, prog_name="eloverblik")
+"""
+
+
+def parse_importtime(stderr: str) -> dict:
+    """
+    Return the cumulative import time in microseconds of each top-level
+    import in the output of `python -X importtime`, after MARKER.
+    """
+    lines = stderr.splitlines()
+    if MARKER in lines:
+        lines = lines[lines.index(MARKER) + 1:]
+    imports = {}
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            # The header line
+            continue
+        # Nested imports are indented
+        imports.setdefault(name[1:], 0)
+        if not name[1:].startswith(" "):
+            imports[name[1:]] += int(cumulative)
+    return imports
+
+
+def measure(args: list, env: dict) -> tuple:
+    """Return the import time in ms of running the CLI with `args`, and the heavy modules imported."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD.format(marker=MARKER, args=args)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    imports = parse_importtime(process.stderr)
+    total = sum(imports.values()) / 1000
+    heavy = sorted({name.strip() for name in imports if name.strip() in HEAVY})
+    return total, heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=100,
+                        help="Maximum import time of a command")
+    parser.add_argument("--json", type=Path, help="Write the results to this file")
+    args = parser.parse_args()
+
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(
+            [str(Path(__file__).resolve().parent.parent), os.environ.get("PYTHONPATH", "")]
+        ),
+    )
+    # Importing the CLI is cheap, so its commands are listed from here
+    from eloverblik.scripts.eldata import eloverblik
+    cases = [["--help"]] + [[command, "--help"] for command in sorted(eloverblik.commands)]
+
+    results = {}
+    failed = False
+    for case in cases:
+        runs = [measure(case, env) for _ in range(args.repeat)]
+        median = statistics.median(total for total, _ in runs)
+        heavy = sorted({name for _, names in runs for name in names})
+        name = " ".join(case)
+        results[name] = {"import_ms": round(median, 1), "heavy": heavy}
+        over = median > args.budget_ms
+        failed = failed or over or len(heavy) > 0
+        flags = (" OVER BUDGET" if over else "") + (f" imports {', '.join(heavy)}" if heavy else "")
+        print(f"{name:>20}: {median:7.1f} ms{flags}")
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+    if failed:
+        print(f"FAILED: budget {args.budget_ms} ms, heavy modules {', '.join(HEAVY)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
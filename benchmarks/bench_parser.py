@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of the timeseries parser in `eloverblik.tools` against the
+previous implementation based on `pd.json_normalize`.
+
+Usage:
+    python benchmarks/bench_parser.py [--meters N] [--years Y] [--repeat R]
+"""
+import argparse
+import json
+import timeit
+from datetime import date
+
+import pandas as pd
+
+from eloverblik import tools
+from eloverblik.mockapi import Fleet
+
+
+def synthetic_response(meters: int, years: int, start: date = date(2019, 1, 1)) -> dict:
+    """Build a timeseries response with hourly data for `meters` meters."""
+    fleet = Fleet(meters, years, end=start.replace(year=start.year + years - 1))
+    end = start.replace(year=start.year + years)
+    return {"result": [fleet.timeseries(m, start, end) for m in fleet.meterids]}
+
+
+def json_normalize_parser(content: bytes) -> pd.DataFrame:
+    """The parser used before `tools.parse_timeseries`, extended to every result."""
+    dflist = []
+    for result in json.loads(content)["result"]:
+        df = pd.json_normalize(
+            result["MyEnergyData_MarketDocument"]["TimeSeries"][0]["Period"],
+            record_path="Point",
+            meta=[["timeInterval", "end"]],
+        )
+        df = df.drop(columns=["out_Quantity.quality"])
+        df.columns = ["hour", "kWh", "date"]
+        df["date"] = pd.to_datetime(df["date"]).dt.normalize() + pd.to_timedelta(
+            (df["hour"].astype(int) - 1).astype(int), unit="hours"
+        )
+        df["meterid"] = result["id"]
+        dflist += [df[["meterid", "date", "kWh"]]]
+    return pd.concat(dflist).reset_index(drop=True)
+
+
+def fast_parser(content: bytes) -> pd.DataFrame:
+    return tools.parse_timeseries(tools.json_loads(content)["result"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--meters", type=int, default=5)
+    parser.add_argument("--years", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    content = json.dumps(synthetic_response(args.meters, args.years)).encode()
+    old, new = json_normalize_parser(content), fast_parser(content)
+    pd.testing.assert_series_equal(
+        old["date"].dt.tz_localize(None), new["date"], check_dtype=False
+    )
+    pd.testing.assert_series_equal(old["kWh"].astype(float), new["kWh"])
+
+    print(f"{len(new)} points, {len(content) / 1e6:.1f} MB, JSON decoder: {tools.json_loads.__module__}")
+    for name, func in [("json_normalize", json_normalize_parser), ("fast", fast_parser)]:
+        best = min(timeit.repeat(lambda: func(content), number=1, repeat=args.repeat))
+        print(f"{name:>15}: {best * 1000:8.1f} ms ({len(new) / best / 1e6:.2f} M points/s)")
+
+
+if __name__ == "__main__":
+    main()
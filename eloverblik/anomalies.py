@@ -0,0 +1,191 @@
+"""
+Incremental statistics of the hourly consumption of each meter, and anomaly
+scores of new readings.
+
+For each meter and hour of the week, "consumption_stats" holds the number,
+mean and sum of squared deviations of the hourly consumption, merged with
+those of new hours with the parallel variant of Welford's algorithm, and
+"consumption_sketch" a histogram with logarithmic bins, a quantile sketch
+from which the rank of an hour in the history is estimated. Readings
+are appended to "stats_pending" as they are downloaded, see
+DatabaseBuilder.load_consumption, so an update only reads the hours it
+downloaded: its cost does not depend on the size of the history.
+
+New hours are scored against the statistics of the hours before them, then
+included in the statistics. Hours up to the watermark of a meter, e.g.
+readings downloaded again or corrected by a backfill, are not counted twice
+and are not scored again.
+"""
+import eloverblik.tools as tools
+from eloverblik.profiling import span
+
+# Ratio between the bounds of consecutive bins of consumption_sketch
+GAMMA = 1.2
+
+# Hours of the week with fewer hours of history are scored, but not flagged
+MIN_HISTORY = 8
+
+# An hour is flagged "high" if both its z-score is at least Z_THRESHOLD and
+# its rank in the history is at least the upper quantile, and "low" in the
+# symmetric case
+Z_THRESHOLD = 3.0
+QUANTILES = (0.01, 0.99)
+
+# Standard deviation below which the consumption of an hour of the week is
+# considered constant, in kWh, so that z-scores stay finite
+MIN_STD = 0.01
+
+# Complete hours of the readings in stats_pending. Readings downloaded twice
+# are counted once, and hours with missing readings, e.g. a day which is not
+# fully published, are left for a later update.
+PENDING_HOURS = """
+    select meterid, minute // 60 * 60 as minute, SUM(Wh) / 1000 as kWh
+    from (
+        select meterid, minute, MAX(Wh) as Wh, MAX(resolution) as resolution
+        from stats_pending
+        group by meterid, minute
+    )
+    group by meterid, minute // 60 * 60
+    having SUM(resolution) >= 60
+"""
+
+# Hours of the whole history, from the consumption view
+HISTORY_HOURS = """
+    select meterid, CAST(epoch(date_trunc('hour', date)) // 60 AS INTEGER) as minute
+    , CAST(SUM(kWh) AS DOUBLE) as kWh
+    from consumption
+    group by meterid, date_trunc('hour', date)
+"""
+
+
+def create_tables(conn) -> bool:
+    """
+    Create the tables of tools.STATS_TABLES which do not exist yet.
+
+    Returns:
+        True if the statistics were created, in which case they should be
+        computed from the whole history.
+    """
+    tables = [t[0] for t in conn.execute("select table_name from duckdb_tables()").fetchall()]
+    for table, tabledef in tools.STATS_TABLES.items():
+        if table not in tables:
+            conn.execute(tabledef(table))
+    return "consumption_stats" not in tables
+
+
+def drop_tables(conn) -> None:
+    """Drop the tables of tools.STATS_TABLES, e.g. before the database is built again."""
+    for table in tools.STATS_TABLES:
+        conn.execute(f"DROP TABLE IF EXISTS {table};")
+
+
+def update_statistics(conn, history=False, min_history=MIN_HISTORY,
+                      z_threshold=Z_THRESHOLD, quantiles=QUANTILES) -> dict:
+    """
+    Score the hours in "stats_pending" and include them in the statistics.
+
+    Parameters:
+        conn: A read-write connection to the database.
+        history: If True, read the hours from the "consumption" view instead,
+            e.g. to compute the statistics of an existing database.
+        min_history: See MIN_HISTORY.
+        z_threshold: See Z_THRESHOLD.
+        quantiles: See QUANTILES.
+
+    Returns:
+        A dictionary with the number of "hours" included in the statistics
+        and the number of "anomalies" flagged among them.
+    """
+    source = HISTORY_HOURS if history else PENDING_HOURS
+    low, high = quantiles
+    with span("statistics", history=history) as timing:
+        conn.execute("BEGIN TRANSACTION")
+        conn.execute(
+            f"""
+            CREATE OR REPLACE TEMP TABLE new_hours AS
+            select h.meterid, h.minute, h.hour, h.kWh
+            , CAST((ISODOW(h.hour) - 1) * 24 + HOUR(h.hour) AS SMALLINT) as how
+            , CAST(ceil(ln(greatest(h.kWh * 1000, 1)) / ln({GAMMA})) AS SMALLINT) as bin
+            from (
+                select *, TIMESTAMP '1970-01-01 00:00:00' + to_minutes(minute) as hour
+                from ({source})
+            ) as h
+            left join stats_watermark as w on w.meterid=h.meterid
+            where w.minute is null or h.minute > w.minute
+            """
+        )
+        conn.execute(
+            f"""
+            INSERT INTO consumption_anomalies
+            with ranks as (
+                select h.meterid, h.minute
+                , SUM(CASE WHEN k.bin < h.bin THEN k.n WHEN k.bin = h.bin THEN k.n / 2 ELSE 0 END)
+                    as below
+                from new_hours as h
+                inner join consumption_sketch as k on k.meterid=h.meterid and k.how=h.how
+                group by h.meterid, h.minute
+            ), scores as (
+                select h.meterid, h.hour, h.kWh, s.mean as expected, s.n
+                , (h.kWh - s.mean) / greatest(sqrt(s.m2 / (s.n - 1)), {MIN_STD}) as z
+                , r.below / s.n as rank
+                from new_hours as h
+                inner join consumption_stats as s on s.meterid=h.meterid and s.how=h.how
+                inner join ranks as r on r.meterid=h.meterid and r.minute=h.minute
+                where s.n >= 2
+            )
+            select meterid, hour, kWh, expected, z, rank
+            , CASE
+                WHEN n < {int(min_history)} THEN NULL
+                WHEN z >= {z_threshold} and rank >= {high} THEN 'high'
+                WHEN z <= -{z_threshold} and rank <= {low} THEN 'low'
+            END as flag
+            from scores
+            ON CONFLICT (meterid, hour) DO UPDATE SET
+            kWh = excluded.kWh, expected = excluded.expected, z = excluded.z
+            , rank = excluded.rank, flag = excluded.flag
+            """
+        )
+        conn.execute(
+            """
+            INSERT INTO consumption_stats
+            select meterid, how, COUNT(*), AVG(kWh), var_pop(kWh) * COUNT(*)
+            from new_hours
+            group by meterid, how
+            ON CONFLICT (meterid, how) DO UPDATE SET
+            n = consumption_stats.n + excluded.n
+            , mean = consumption_stats.mean + (excluded.mean - consumption_stats.mean)
+                * excluded.n / (consumption_stats.n + excluded.n)
+            , m2 = consumption_stats.m2 + excluded.m2
+                + (excluded.mean - consumption_stats.mean) ^ 2
+                * consumption_stats.n * excluded.n / (consumption_stats.n + excluded.n)
+            """
+        )
+        conn.execute(
+            """
+            INSERT INTO consumption_sketch
+            select meterid, how, bin, COUNT(*)
+            from new_hours
+            group by meterid, how, bin
+            ON CONFLICT (meterid, how, bin) DO UPDATE SET n = consumption_sketch.n + excluded.n
+            """
+        )
+        conn.execute(
+            """
+            INSERT INTO stats_watermark
+            select meterid, MAX(minute) from new_hours group by meterid
+            ON CONFLICT (meterid) DO UPDATE SET minute = greatest(stats_watermark.minute, excluded.minute)
+            """
+        )
+        hours, anomalies = conn.execute(
+            """
+            select COUNT(*), COUNT(a.flag)
+            from new_hours as h
+            left join consumption_anomalies as a on a.meterid=h.meterid and a.hour=h.hour
+            """
+        ).fetchone()
+        conn.execute("DELETE FROM stats_pending")
+        conn.execute("DROP TABLE new_hours")
+        conn.execute("COMMIT")
+        timing.set(hours=hours, anomalies=anomalies)
+    return {"hours": hours, "anomalies": anomalies}
+
@@ -0,0 +1,130 @@
+import gzip
+import json
+import os
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+
+class CacheMiss(LookupError):
+    """Raised in offline mode when a response is not in the cache."""
+
+
+class CachedResponse:
+    """
+    A stand-in for `requests.Response` holding a JSON body, returned when
+    responses are served from the cache.
+    """
+
+    status_code = 200
+
+    def __init__(self, data) -> None:
+        self._data = data
+        self.headers = {}
+
+    def json(self):
+        return self._data
+
+    @property
+    def content(self) -> bytes:
+        return json.dumps(self._data).encode()
+
+
+class ResponseCache:
+    """
+    A compressed on-disk cache of raw API responses, one entry per meter.
+
+    Entries are stored as gzipped JSON under
+    `<path>/<endpoint>/<meterid>/<agg>/<fromdate>_<todate>.json.gz`.
+    Timeseries covering periods that ended more than `closed_after` days ago
+    are considered final and never expire; all other entries, including
+    those without dates such as the meter list and the charges, expire
+    after `ttl` seconds.
+
+    Attributes:
+        path: The cache directory.
+        ttl: Lifetime in seconds of entries which may still change.
+        closed_after: Number of days after which a period is considered final.
+    """
+
+    def __init__(self, path: Path, ttl: float = 6 * 3600, closed_after: int = 7) -> None:
+        self.path = Path(path)
+        self.ttl = ttl
+        self.closed_after = closed_after
+
+    def _dir(self, endpoint, meterid, agg) -> Path:
+        return self.path / endpoint / str(meterid) / (agg or "_")
+
+    @staticmethod
+    def _name(fromdate, todate) -> str:
+        return f"{fromdate or '_'}_{todate or '_'}.json.gz"
+
+    def is_closed(self, todate) -> bool:
+        """Return True if a period ending on `todate` will not change anymore."""
+        if todate is None:
+            return False
+        return str(todate) <= str(date.today() - timedelta(days=self.closed_after))
+
+    def _is_fresh(self, file: Path) -> bool:
+        # Entries without a todate, like the meter list and the charges, are
+        # named "<fromdate>__" or "___" and stay open
+        stem = file.name[: -len(".json.gz")]
+        todate = None if stem.endswith("_") else stem.split("_")[-1]
+        if self.is_closed(todate):
+            return True
+        return time.time() - file.stat().st_mtime < self.ttl
+
+    def get(self, endpoint, meterid, fromdate=None, todate=None, agg=None,
+            offline=False):
+        """
+        Return a cached result entry, or None.
+
+        Parameters:
+            offline: If True, expired entries are returned too, and when there
+                is no entry for `todate`, the entry with the same `fromdate`
+                and the latest `todate` is returned instead. This allows to
+                replay periods which were still open when they were cached.
+        """
+        directory = self._dir(endpoint, meterid, agg)
+        file = directory / self._name(fromdate, todate)
+        if not file.exists():
+            if not offline or not directory.exists():
+                return None
+            candidates = sorted(directory.glob(self._name(fromdate, "*")))
+            if len(candidates) == 0:
+                return None
+            file = candidates[-1]
+        elif not offline and not self._is_fresh(file):
+            return None
+        with gzip.open(file, "rt") as f:
+            return json.load(f)
+
+    def put(self, endpoint, meterid, entry, fromdate=None, todate=None, agg=None) -> None:
+        """Store a result entry, replacing the file atomically."""
+        directory = self._dir(endpoint, meterid, agg)
+        directory.mkdir(parents=True, exist_ok=True)
+        file = directory / self._name(fromdate, todate)
+        tmp = file.with_name(f".{file.name}.{os.getpid()}.tmp")
+        with gzip.open(tmp, "wt") as f:
+            json.dump(entry, f)
+        os.replace(tmp, file)
+
+    def prune(self) -> int:
+        """
+        Remove expired entries, except the most recent entry of each open
+        period, which is kept for offline replay.
+
+        Returns:
+            The number of removed files.
+        """
+        removed = 0
+        for directory in {f.parent for f in self.path.glob("*/*/*/*.json.gz")}:
+            byfrom = {}
+            for file in sorted(directory.glob("*.json.gz")):
+                byfrom.setdefault(file.name.split("_")[0], []).append(file)
+            for files in byfrom.values():
+                for file in files[:-1]:
+                    if not self._is_fresh(file):
+                        file.unlink()
+                        removed += 1
+        return removed
@@ -0,0 +1,387 @@
+"""
+The updater run by `eloverblik serve`, a long-running process keeping the
+database up to date.
+
+Running `eloverblik update` from cron starts a new interpreter, opens new
+connections to the API and gets a data access token every time. The Updater
+keeps one DatabaseBuilder, with its session, token and caches, for its whole
+lifetime, and polls each meter around the time eloverblik publishes the
+readings of the previous day:
+
+- a meter whose readings are complete up to yesterday is polled next at
+  `publish_time` on the following day, plus a random delay of up to `jitter`
+  seconds, so that meters and installations do not all poll at once;
+- a meter whose readings of yesterday are not published yet is polled again
+  after `retry_interval` seconds, plus up to a quarter of it;
+- the meters of a failed update back off exponentially, up to `max_backoff`
+  seconds.
+
+The database is opened for writing only while an update runs, since DuckDB
+locks the file against other processes, so the dashboard can read it in
+between. The state of the updater is written to tools.statuspath, and served
+over HTTP as JSON on /health and in the Prometheus text format on /metrics.
+"""
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zoneinfo import ZoneInfo
+
+import duckdb
+
+import eloverblik.tools as tools
+from eloverblik.profiling import span
+
+# Readings are stored in Danish local time
+TIMEZONE = ZoneInfo("Europe/Copenhagen")
+
+
+def local_now() -> datetime:
+    """Return the current Danish local time, naive like the dates of readings."""
+    return datetime.now(TIMEZONE).replace(tzinfo=None)
+
+
+class Updater:
+    """
+    Schedules the updates of each meter and keeps track of their lag.
+
+    Attributes:
+        db: The DatabaseBuilder, or FleetBuilder, running the updates.
+        publish_time: The (hour, minute), in Danish local time, after which
+            the readings of the previous day are usually published.
+        jitter: Maximum random delay in seconds added to `publish_time`.
+        retry_interval: Seconds between polls of a meter whose readings of
+            yesterday are not published yet.
+        max_backoff: Maximum delay in seconds after failed updates.
+        max_lag: Seconds after the last reading of a meter beyond which the
+            updater is reported as lagging.
+        max_failures: Number of consecutive failed updates after which the
+            updater is reported as failing.
+        window: Meters due within this many seconds are updated together.
+        schedule: The next poll of each meter, in Danish local time.
+        failures: The number of consecutive failed polls of each meter.
+        watermarks: The last reading of each meter.
+        anomalies: The number of hours of each meter flagged as unusual in
+            the last day of readings, see eloverblik.anomalies.
+        cycles: The number of updates run.
+        failed_cycles: The number of updates which failed.
+        consecutive_failures: The number of updates which failed since the
+            last successful one.
+        last_cycle: Start, duration, meters and error of the last update.
+        last_success: UNIX time of the end of the last successful update.
+    """
+
+    def __init__(self, db, publish_time=(6, 0), jitter=3600, retry_interval=3600,
+                 max_backoff=6 * 3600, max_lag=48 * 3600, max_failures=3, window=60,
+                 seed=None) -> None:
+        self.db = db
+        self.publish_time = publish_time
+        self.jitter = jitter
+        self.retry_interval = retry_interval
+        self.max_backoff = max_backoff
+        self.max_lag = max_lag
+        self.max_failures = max_failures
+        self.window = window
+        self.schedule = {}
+        self.failures = {}
+        self.watermarks = {}
+        self.anomalies = {}
+        self.cycles = 0
+        self.failed_cycles = 0
+        self.consecutive_failures = 0
+        self.last_cycle = None
+        self.last_success = None
+        self.started = time.time()
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+    def next_publication(self, now: datetime) -> datetime:
+        """Return the first `publish_time` after `now`."""
+        hour, minute = self.publish_time
+        publication = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if publication <= now:
+            publication += timedelta(days=1)
+        return publication
+
+    def is_complete(self, meterid, now: datetime) -> bool:
+        """Return True if the meter has readings up to the last hour of yesterday."""
+        watermark = self.watermarks.get(meterid)
+        yesterday = now.date() - timedelta(days=1)
+        return watermark is not None and watermark >= datetime(
+            yesterday.year, yesterday.month, yesterday.day, 23
+        )
+
+    def reschedule(self, meterids, now: datetime, error=False) -> None:
+        """Schedule the next poll of meters which have just been updated."""
+        for meterid in meterids:
+            if error:
+                self.failures[meterid] = self.failures.get(meterid, 0) + 1
+                delay = min(self.max_backoff, tools.backoff(self.failures[meterid], base=30))
+                self.schedule[meterid] = now + timedelta(seconds=delay)
+                continue
+            self.failures[meterid] = 0
+            if self.is_complete(meterid, now):
+                delay = self._random.uniform(0, self.jitter)
+                self.schedule[meterid] = self.next_publication(now) + timedelta(seconds=delay)
+            else:
+                delay = self.retry_interval * self._random.uniform(1, 1.25)
+                self.schedule[meterid] = now + timedelta(seconds=delay)
+
+    def due(self, now: datetime) -> list:
+        """Return the meters to poll now, including the ones due within `window`."""
+        horizon = now + timedelta(seconds=self.window)
+        return sorted(m for m, t in self.schedule.items() if t <= horizon)
+
+    def wait_time(self, now: datetime) -> float:
+        """Return the number of seconds until the next poll."""
+        if len(self.schedule) == 0:
+            # The meters could not be listed yet
+            return min(self.max_backoff, tools.backoff(self.consecutive_failures, base=30))
+        return max(0.0, (min(self.schedule.values()) - now).total_seconds())
+
+    def read_watermarks(self) -> None:
+        """
+        Read the last reading of each meter from the database, and the number
+        of unusual hours in the last day before it.
+        """
+        with duckdb.connect(str(self.db.data_dir), read_only=True) as conn:
+            self.watermarks = dict(
+                conn.execute("select meterid, MAX(date) from consumption group by meterid").fetchall()
+            )
+            if tools.is_table(conn, "consumption_anomalies"):
+                self.anomalies = dict(
+                    conn.execute(
+                        """
+                        select a.meterid, COUNT(a.flag)
+                        from consumption_anomalies as a
+                        inner join (
+                            select meterid, MAX(hour) as last
+                            from consumption_anomalies group by meterid
+                        ) as l
+                        on a.meterid=l.meterid and a.hour > l.last - INTERVAL 1 DAY
+                        group by a.meterid
+                        """
+                    ).fetchall()
+                )
+
+    def _failed_meters(self, meterids) -> set:
+        """
+        Return the meters with ranges which could not be downloaded, or whose
+        account failed in a FleetBuilder.
+        """
+        failures = getattr(self.db, "failures", {})
+        owner = getattr(self.db, "owner", {})
+        failed = {m for _, _, batch, _ in self.db.failed_ranges for m in batch}
+        return {m for m in meterids if owner.get(m) in failures or m in failed}
+
+    def run_cycle(self, meterids=None) -> None:
+        """
+        Update the consumption of `meterids`, or of all meters if None, and
+        schedule their next poll. Meters listed by the API for the first time
+        are scheduled as well, and meters which are not listed anymore are
+        dropped. Errors are recorded instead of raised.
+        """
+        start = time.time()
+        error = None
+        self.db.reset()
+        try:
+            with span("cycle", meters=len(meterids) if meterids is not None else "all"):
+                self.db.update_dataset(meterids=meterids, refresh=True)
+            self.read_watermarks()
+        except Exception as e:
+            error = e
+        now = local_now()
+        with self._lock:
+            self.cycles += 1
+            listed = self.db.meterids or []
+            if meterids is None:
+                meterids = listed
+            if error is None:
+                if len(getattr(self.db, "failures", {})) == 0:
+                    for meterid in set(self.schedule) - set(listed):
+                        del self.schedule[meterid]
+                        self.failures.pop(meterid, None)
+                meterids = list(meterids) + [
+                    m for m in listed if m not in self.schedule and m not in meterids
+                ]
+            failed = set(meterids) if error is not None else self._failed_meters(meterids)
+            self.reschedule([m for m in meterids if m not in failed], now)
+            self.reschedule(failed, now, error=True)
+            if error is None and len(failed) == 0:
+                self.consecutive_failures = 0
+                self.last_success = time.time()
+            else:
+                self.failed_cycles += 1
+                self.consecutive_failures += 1
+            self.last_cycle = {
+                "start": start,
+                "duration_s": round(time.time() - start, 3),
+                "meters": len(meterids),
+                "error": repr(error) if error is not None else None,
+                "failed_meters": len(failed),
+            }
+
+    def step(self) -> float:
+        """
+        Run the update of the meters which are due, if any, and write the
+        status file.
+
+        Returns:
+            The number of seconds until the next poll.
+        """
+        now = local_now()
+        if len(self.schedule) == 0:
+            self.run_cycle()
+        else:
+            due = self.due(now)
+            if len(due) > 0:
+                self.run_cycle(due)
+        self.write_status()
+        return self.wait_time(local_now())
+
+    def run(self, stop: threading.Event, heartbeat=60) -> None:
+        """
+        Poll until `stop` is set, writing the status file at least every
+        `heartbeat` seconds.
+        """
+        while not stop.is_set():
+            wait = self.step()
+            stop.wait(min(wait, heartbeat))
+
+    def status(self) -> dict:
+        """Return the state of the updater and the lag of each meter."""
+        now = local_now()
+        with self._lock:
+            meters = {}
+            for meterid in sorted(set(self.schedule) | set(self.watermarks)):
+                watermark = self.watermarks.get(meterid)
+                lag = None
+                if watermark is not None:
+                    lag = (now - watermark - timedelta(hours=1)).total_seconds()
+                nextpoll = self.schedule.get(meterid)
+                meters[meterid] = {
+                    "last_reading": watermark.isoformat() if watermark is not None else None,
+                    "lag_hours": round(lag / 3600, 2) if lag is not None else None,
+                    "next_poll": nextpoll.isoformat() if nextpoll is not None else None,
+                    "failures": self.failures.get(meterid, 0),
+                    "anomalous_hours": self.anomalies.get(meterid, 0),
+                }
+            lags = [m["lag_hours"] for m in meters.values()]
+            if self.cycles == 0:
+                state = "starting"
+            elif self.consecutive_failures >= self.max_failures:
+                state = "failing"
+            elif any(lag is None or lag * 3600 > self.max_lag for lag in lags):
+                state = "lagging"
+            else:
+                state = "ok"
+            return {
+                "status": state,
+                "healthy": state in ("starting", "ok"),
+                "pid": os.getpid(),
+                "started": self.started,
+                "heartbeat": time.time(),
+                "cycles": self.cycles,
+                "failed_cycles": self.failed_cycles,
+                "consecutive_failures": self.consecutive_failures,
+                "last_cycle": self.last_cycle,
+                "last_success": self.last_success,
+                "max_lag_hours": max((lag for lag in lags if lag is not None), default=None),
+                "meters": meters,
+                "api": self.db.metrics.summary(),
+            }
+
+    def write_status(self) -> None:
+        """Write `status` to tools.statuspath, replacing the file atomically."""
+        tools.statuspath.parent.mkdir(parents=True, exist_ok=True)
+        tmp = f"{tools.statuspath}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.status(), f)
+        os.replace(tmp, tools.statuspath)
+
+    def metrics(self) -> str:
+        """Return `status` in the Prometheus text exposition format."""
+        status = self.status()
+        lines = [
+            "# TYPE eloverblik_up gauge",
+            f"eloverblik_up {int(status['healthy'])}",
+            "# TYPE eloverblik_cycles_total counter",
+            f"eloverblik_cycles_total {status['cycles']}",
+            "# TYPE eloverblik_cycle_failures_total counter",
+            f"eloverblik_cycle_failures_total {status['failed_cycles']}",
+            "# TYPE eloverblik_consecutive_failures gauge",
+            f"eloverblik_consecutive_failures {status['consecutive_failures']}",
+        ]
+        if status["last_success"] is not None:
+            lines += [
+                "# TYPE eloverblik_last_success_timestamp_seconds gauge",
+                f"eloverblik_last_success_timestamp_seconds {status['last_success']:.3f}",
+            ]
+        lines.append("# TYPE eloverblik_meter_lag_hours gauge")
+        for meterid, meter in status["meters"].items():
+            if meter["lag_hours"] is not None:
+                lines.append(f'eloverblik_meter_lag_hours{{meterid="{meterid}"}} {meter["lag_hours"]}')
+        lines.append("# TYPE eloverblik_meter_failures gauge")
+        for meterid, meter in status["meters"].items():
+            lines.append(f'eloverblik_meter_failures{{meterid="{meterid}"}} {meter["failures"]}')
+        lines.append("# TYPE eloverblik_meter_anomalous_hours gauge")
+        for meterid, meter in status["meters"].items():
+            lines.append(
+                f'eloverblik_meter_anomalous_hours{{meterid="{meterid}"}} {meter["anomalous_hours"]}'
+            )
+        for name in ("requests", "retries", "errors", "bytes"):
+            lines += [
+                f"# TYPE eloverblik_api_{name}_total counter",
+                f"eloverblik_api_{name}_total {status['api'][name]}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+class StatusServer(ThreadingHTTPServer):
+    """
+    Serves the status of an Updater on /health, with status 503 when it is
+    not healthy, and its metrics on /metrics.
+
+    Attributes:
+        updater: The Updater.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, updater: Updater, address=("127.0.0.1", 8089)) -> None:
+        super().__init__(address, StatusHandler)
+        self.updater = updater
+
+    def start(self) -> threading.Thread:
+        """Serve requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, name="status-server", daemon=True)
+        thread.start()
+        return thread
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/health":
+            status = self.server.updater.status()
+            body = json.dumps(status).encode()
+            code = 200 if status["healthy"] else 503
+            content_type = "application/json"
+        elif self.path == "/metrics":
+            body = self.server.updater.metrics().encode()
+            code = 200
+            content_type = "text/plain; version=0.0.4"
+        else:
+            body = b"Not found"
+            code = 404
+            content_type = "text/plain"
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -1,12 +1,89 @@
 import duckdb
+import functools
+import json
+import threading
+import time
 import altair as alt
 import eloverblik.tools
 import matplotlib.pyplot as plt
 
+# A read-only connection shared by all dashboard queries, opened on demand
+_conn = None
+# Query results by (function, arguments), valid for the database version in
+# _results_version
+_results = {}
+_results_version = None
+_lock = threading.RLock()
 
+
+def get_connection():
+    """
+    Return the shared read-only connection to the database, opening it if
+    needed. Callers must hold `_lock` while using it.
+    """
+    global _conn
+    with _lock:
+        if _conn is None:
+            _conn = duckdb.connect(str(eloverblik.tools.datapath), read_only=True)
+        return _conn
+
+
+def close_connection():
+    """
+    Close the shared connection, so that another process, or this one, can
+    open the database for writing. Memoized results are kept.
+    """
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+
+def memoize(func):
+    """
+    Cache the results of a query function by its arguments. The cache is
+    cleared when the database version stamp changes, i.e. after the database
+    has been built, updated or backfilled.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _results_version
+        version = eloverblik.tools.get_db_version(eloverblik.tools.datapath)
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        with _lock:
+            if version != _results_version:
+                # The connection may hold a view of the previous version
+                close_connection()
+                _results.clear()
+                _results_version = version
+            if key not in _results:
+                _results[key] = func(*args, **kwargs)
+            return _results[key]
+
+    return wrapper
+
+
+def get_updater_status(max_age=300):
+    """
+    Return the status written by a running `eloverblik serve`, or None if
+    none has written it in the last `max_age` seconds.
+    """
+    try:
+        with open(eloverblik.tools.statuspath) as f:
+            status = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if time.time() - status.get("heartbeat", 0) > max_age:
+        return None
+    return status
+
+
+@memoize
 def get_meterids_in_db():
     """ """
-    conn = duckdb.connect(str(eloverblik.tools.datapath), read_only=True)
+    conn = get_connection()
     meterids = [
         i[0]
         for i in conn.execute("""select meteringPointId from meterinfo""").fetchall()
@@ -14,30 +91,31 @@ def get_meterids_in_db():
     return meterids
 
 
+@memoize
 def get_years_in_db():
     """ """
-    conn = duckdb.connect(str(eloverblik.tools.datapath), read_only=True)
+    conn = get_connection()
     meterids = [
         i[0]
         for i in conn.execute(
-            """select YEAR(date) as year from consumption group by YEAR(date)"""
+            """select year from consumption_yearly group by year order by year"""
         ).fetchall()
     ]
     return meterids
 
 
+@memoize
 def get_overall_consumption():
-    conn = duckdb.connect(str(eloverblik.tools.datapath), read_only=True)
+    conn = get_connection()
     df = (
         conn.execute(
             """
-        select c.meterid as 'Meter ID', YEAR(c.date) as 'Year'
-        , CAST(SUM(c.kWh) as INT) as 'Total kWh consumption'
-        , FIRST(CONCAT_WS(' ', mi.streetName, mi.buildingNumber, mi.floorId || mi.roomId || ',', cityName)) as address
-        from consumption as c
+        select c.meterid as 'Meter ID', c.year as 'Year'
+        , CAST(c.kWh as INT) as 'Total kWh consumption'
+        , CONCAT_WS(' ', mi.streetName, mi.buildingNumber, mi.floorId || mi.roomId || ',', cityName) as address
+        from consumption_yearly as c
         inner join meterinfo as mi
         on c.meterid=mi.meteringPointId
-        group by YEAR(date), meterid
         """
         )
         .df()
@@ -51,34 +129,38 @@ def get_overall_consumption():
     df = df.reset_index()
     df.columns = varnames
     df = df.set_index("Meter ID")
-    conn.close()
     return df
 
 
-def chart_year_rolling_avgs(meterid=None):
+@memoize
+def get_daily_rolling_avgs(meterid):
     """ """
-    conn = duckdb.connect(str(eloverblik.tools.datapath), read_only=True)
-    if meterid is None:
-        meterid = conn.execute("select MIN(meterid) from consumption").fetchone()[0]
-    # Get data
+    conn = get_connection()
     df = conn.execute(
-        f"""
+        """
         SELECT
             round(AVG(kWh_day) OVER(ROWS between 7 preceding and 7 following), 2) as rolling_average
             , cast(YEAR(date) as string) as year
             , date - interval (year(date) - 2019) YEAR as newdate
             , strftime(date, '%-d %b') as strdate
         from (
-            select date_trunc('day', date) as date,
-            SUM(kWh) as kWh_day
-            from consumption
-            where meterid = {meterid}
-            group by date_trunc('day', date)
+            select CAST(day AS TIMESTAMP) as date,
+            kWh as kWh_day
+            from consumption_daily
+            where meterid = ?
+            order by day
             ) as c
-        """
+        """,
+        [str(meterid)],
     ).df()
-    # Close connection
-    conn.close()
+    return df
+
+
+def chart_year_rolling_avgs(meterid=None):
+    """ """
+    if meterid is None:
+        meterid = get_meterids_in_db()[0]
+    df = get_daily_rolling_avgs(meterid)
 
     nearest = alt.selection(
         type="single", nearest=True, on="mouseover", fields=["newdate"], empty="none"
@@ -115,35 +197,130 @@ def chart_year_rolling_avgs(meterid=None):
     return chart
 
 
-def get_avg_hourly_consumption(conn, meterid, years, summer=True, winter=True):
-    seasons = []
-    if summer:
-        seasons += ["'summer'"]
-    if winter:
-        seasons += ["'winter'"]
-    if len(seasons) == 0:
-        seasons = "('None')"
-    else:
-        seasons = f"""({",".join(seasons)})"""
+@memoize
+def get_anomaly_summary(days=7):
+    """
+    Return the number of hours flagged as unusually high or low consumption
+    by meter in the last `days` days of scored readings, and the last one.
+    """
+    conn = get_connection()
+    if not eloverblik.tools.is_table(conn, "consumption_anomalies"):
+        return None
+    df = conn.execute(
+        """
+        select meterid as 'Meter ID'
+        , COUNT(*) FILTER (where flag = 'high') as 'High hours'
+        , COUNT(*) FILTER (where flag = 'low') as 'Low hours'
+        , MAX(hour) FILTER (where flag is not null) as 'Last flagged hour'
+        from consumption_anomalies
+        where hour >= (select MAX(hour) from consumption_anomalies) - to_days(?)
+        group by meterid
+        order by meterid
+        """,
+        [int(days)],
+    ).df()
+    return df.set_index("Meter ID")
+
 
+@memoize
+def get_anomalies(meterid, days=14):
+    """
+    Return the scored hours of a meter in the last `days` days of scored
+    readings: consumption, expected consumption, z-score, rank in the history
+    of the same hour of the week, and flag.
+    """
+    conn = get_connection()
+    if not eloverblik.tools.is_table(conn, "consumption_anomalies"):
+        return None
+    df = conn.execute(
+        """
+        select hour, CAST(kWh AS DOUBLE) as kWh, expected, z, rank
+        , COALESCE(flag, 'normal') as flag
+        from consumption_anomalies
+        where meterid = ?
+        and hour >= (select MAX(hour) from consumption_anomalies where meterid = ?) - to_days(?)
+        order by hour
+        """,
+        [str(meterid), str(meterid), int(days)],
+    ).df()
+    return df
+
+
+def chart_anomalies(meterid, days=14):
+    df = get_anomalies(meterid, days=days)
+    if df is None or len(df) == 0:
+        return None
+    base = alt.Chart(df).encode(x=alt.X("hour:T", axis=alt.Axis(title="")))
+    consumption = base.mark_line(color="steelblue").encode(
+        y=alt.Y("kWh:Q", axis=alt.Axis(title=""))
+    )
+    expected = base.mark_line(color="gray", strokeDash=[4, 4]).encode(y="expected:Q")
+    flagged = base.transform_filter(alt.datum.flag != "normal").mark_point(
+        filled=True, size=60
+    ).encode(
+        y="kWh:Q",
+        color=alt.Color(
+            "flag:N", scale=alt.Scale(domain=["high", "low"], range=["red", "orange"])
+        ),
+        tooltip=[
+            alt.Tooltip("hour:T", format="%d %b %H:%M"),
+            alt.Tooltip("kWh:Q", format=".3f"),
+            alt.Tooltip("expected:Q", format=".3f"),
+            alt.Tooltip("z:Q", format=".1f"),
+            alt.Tooltip("rank:Q", format=".3f"),
+        ],
+    )
+    return alt.layer(consumption, expected, flagged).properties(
+        title="Hourly kWh consumption (line), expected (dashed) and unusual hours",
+        width=700, height=300,
+    )
+
+
+@memoize
+def get_hourly_profile(meterid):
+    """
+    Return the total kWh and number of readings of a meter by year, season
+    and hour of day, from which the average hourly consumption of any
+    combination of years and seasons can be computed.
+    """
+    conn = get_connection()
     df = conn.execute(
-        f"""
-        select HOUR(date) as hour
-        , AVG(kWh) as tot
-        from (
-            select *
-            , CASE when month(date) between 4 and 9 then 'summer' else 'winter' end as season
-            from consumption
-            where year(date) in ({','.join([str(y) for y in years])})
-            and month(date)>3
-        ) as c
-        WHERE season in {seasons}
-        group by HOUR(date)
         """
+        select year
+        , CASE when month between 4 and 9 then 'summer' else 'winter' end as season
+        , hour
+        , CAST(SUM(kWh) AS DOUBLE) as kWh
+        , SUM(n) as n
+        from consumption_hourly
+        where meterid = ?
+        group by all
+        """,
+        [str(meterid)],
     ).df()
     return df
 
 
+def get_avg_hourly_consumption(meterid, years, summer=True, winter=True):
+    """
+    Average hourly consumption of a meter in the given years and seasons,
+    weighted by the number of readings. Summer is April to September.
+    """
+    seasons = []
+    if summer:
+        seasons += ["summer"]
+    if winter:
+        seasons += ["winter"]
+
+    cube = get_hourly_profile(meterid)
+    df = (
+        cube[cube["year"].isin(list(years)) & cube["season"].isin(seasons)]
+        .groupby("hour", as_index=False)[["kWh", "n"]]
+        .sum()
+    )
+    df["tot"] = df["kWh"] / df["n"]
+    return df[["hour", "tot"]]
+
+
 def chart_hourly_consumption_bysample(df1, df2, width=0.35):
     fig, ax = plt.subplots(1, 1, figsize=(10, 5), sharey=True)
 
@@ -170,25 +347,99 @@ def chart_hourly_consumption_bysample(df1, df2, width=0.35):
 def hourly_consumption_wrapper(
     meterid, years1, summer1, winter1, years2, summer2, winter2, width=0.35
 ):
-    conn = duckdb.connect(str(eloverblik.tools.datapath), read_only=True)
     df1 = get_avg_hourly_consumption(
-        conn, meterid, years1, summer=summer1, winter=winter1
+        meterid, tuple(years1), summer=summer1, winter=winter1
     )
     df2 = get_avg_hourly_consumption(
-        conn, meterid, years2, summer=summer2, winter=winter2
+        meterid, tuple(years2), summer=summer2, winter=winter2
     )
     return chart_hourly_consumption_bysample(df1, df2, width=width)
 
 
-def current_tariffs_graph(meterid):
-    with duckdb.connect(str(eloverblik.tools.datapath), read_only=True) as conn:
-        df = conn.execute(
-            f"""
-            SELECT *
-            from current_tariffs
-            where meterid={meterid}
+@memoize
+def get_cost_by_year():
+    """
+    Return the cost of consumption in tariffs and at spot prices by meter and
+    year, in columns by year.
+    """
+    conn = get_connection()
+    df = (
+        conn.execute(
+            """
+            select meterid as 'Meter ID', year as 'Year'
+            , CAST(round(COALESCE(cost, 0) + COALESCE(spot_cost, 0)) as INT) as 'Cost (kr.)'
+            from consumption_yearly
             """
-        ).df().set_index(['meterid', 'hour']).stack().reset_index()
+        )
+        .df()
+        .pivot(index="Meter ID", columns="Year", values="Cost (kr.)")
+    )
+    df.columns = [str(c) for c in df.columns]
+    return df
+
+
+@memoize
+def get_monthly_cost(meterid):
+    """
+    Return the consumption, the cost in tariffs and at spot prices, and the
+    average tariff and spot price of a meter by month.
+    """
+    conn = get_connection()
+    df = conn.execute(
+        """
+        select month, CAST(kWh AS DOUBLE) as kWh
+        , CAST(cost AS DOUBLE) as Tariffs, CAST(spot_cost AS DOUBLE) as 'Spot price'
+        , CAST(cost / NULLIF(kWh, 0) AS DOUBLE) as tariff
+        , CAST(spot_cost / NULLIF(kWh, 0) AS DOUBLE) as spot_price
+        from consumption_monthly
+        where meterid = ? and (cost is not null or spot_cost is not null)
+        order by month
+        """,
+        [str(meterid)],
+    ).df()
+    return df
+
+
+def chart_monthly_cost(meterid):
+    df = get_monthly_cost(meterid)
+    bars = alt.Chart(df).transform_fold(
+        ['Tariffs', 'Spot price'], as_=['Cost type', 'cost']
+    ).mark_bar().encode(
+        x=alt.X('yearmonth(month):T', axis=alt.Axis(title='')),
+        y=alt.Y('cost:Q', axis=alt.Axis(title='')),
+        color='Cost type:N',
+        tooltip=[
+            alt.Tooltip('yearmonth(month):T', title='Month'),
+            alt.Tooltip('kWh:Q', format='.0f'),
+            alt.Tooltip('Cost type:N'),
+            alt.Tooltip('cost:Q', format='.2f'),
+            alt.Tooltip('tariff:Q', format='.3f', title='Tariff (kr./kWh)'),
+            alt.Tooltip('spot_price:Q', format='.3f', title='Spot price (kr./kWh)'),
+        ],
+    ).properties(
+        title='Monthly cost of consumption (kr.)',
+        width=700, height=300
+    )
+    return bars
+
+
+@memoize
+def get_current_tariffs(meterid):
+    """ """
+    conn = get_connection()
+    df = conn.execute(
+        """
+        SELECT *
+        from current_tariffs
+        where meterid = ?
+        """,
+        [str(meterid)],
+    ).df()
+    return df
+
+
+def current_tariffs_graph(meterid):
+    df = get_current_tariffs(meterid).set_index(['meterid', 'hour']).stack().reset_index()
     df['hour'] = df['hour'].astype(int)
     df.columns=['meterid', 'hour', 'Tariff type', 'tariff']
     
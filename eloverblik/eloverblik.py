@@ -1,8 +1,21 @@
 import eloverblik.tools as tools
+import eloverblik.anomalies as anomalies
 import requests
 import duckdb
+import sys
+import threading
+import time
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
+from eloverblik.ratelimit import TokenBucket
+from eloverblik.session import make_session, send_with_retries, RequestMetrics
+from eloverblik import tokencache
+from eloverblik.cache import CacheMiss, CachedResponse, ResponseCache
+from eloverblik.storage import ParquetStore
+from eloverblik.planner import RequestPlanner, is_oversized, split_range
+from eloverblik.profiling import span
+from eloverblik.spotprices import EnergiDataServiceSource
 
 
 class Downloader:
@@ -14,44 +27,200 @@ class Downloader:
     Attributes:
         meterids: A list of meterids.
         data_access_token: A data access token.
+        rate_limiter: A TokenBucket shared by all requests, or None.
+        max_retries: How many times a failed request is retried.
+        batch_size: Maximum number of meters sent in a single request.
+        session: The requests Session keeping connections to the API alive.
+        timeout: The (connect, read) timeout of each request, in seconds.
+        metrics: A RequestMetrics with counters about the requests sent.
+        token_cache: The file where the data access token is cached, or None.
+        token_expires: Expiry of the data access token, as a UNIX timestamp.
+        cache: A ResponseCache of raw API responses, or None.
+        offline: If True, responses are only read from the cache.
+        base_url: The root URL of the API.
+        refresh_token: The refresh token of the account, or None to read it
+            from token.txt.
+        account: The name of the account, or None.
     """
 
-    def __init__(self) -> None:
-        """Initialize meterids and data_access_token attributes."""
+    def __init__(self, rate=None, max_retries=5, batch_size=10, pool_size=10,
+                 timeout=(10, 300), token_cache=tools.tokencachepath,
+                 cache_dir=tools.cachepath, offline=False, base_url=None,
+                 refresh_token=None, account=None) -> None:
+        """
+        Initialize meterids and data_access_token attributes.
+
+        Parameters:
+            rate: Maximum number of requests per second sent to the API. If
+                None, requests are not rate limited.
+            max_retries: How many times a request is retried after the API
+                throttled it, answered with a 5xx error, or the connection
+                failed.
+            batch_size: Maximum number of meters sent in a single timeseries
+                or charges request.
+            pool_size: Number of connections kept alive to the API.
+            timeout: The (connect, read) timeout of each request, in seconds.
+            token_cache: The file where the data access token is cached
+                between processes. If None, the token is not cached.
+            cache_dir: The directory where raw API responses are cached. If
+                None, responses are not cached.
+            offline: If True, never contact the API and serve every response
+                from the cache, raising CacheMiss when it is not there.
+            base_url: The root URL of the API. Defaults to tools.apiurl, which
+                can be set with the ELOVERBLIK_API_URL environment variable.
+            refresh_token: The refresh token to use. If None, it is read from
+                token.txt in the working directory.
+            account: A name identifying the account of the refresh token,
+                keeping its cached meter list apart from other accounts'.
+        """
         self.meterids = None
         self.data_access_token = None
+        self.rate_limiter = TokenBucket(rate) if rate is not None else None
+        self.max_retries = max_retries
+        self.batch_size = batch_size
+        self.session = make_session(pool_size)
+        self.timeout = timeout
+        self.metrics = RequestMetrics()
+        self.token_cache = token_cache
+        self.token_expires = None
+        self._token_lock = threading.Lock()
+        self.cache = ResponseCache(cache_dir) if cache_dir is not None else None
+        self.offline = offline
+        self.base_url = (base_url or tools.apiurl).rstrip("/")
+        self.refresh_token = refresh_token
+        self.account = account
+        if offline and self.cache is None:
+            raise ValueError("offline mode requires a cache_dir")
         return
 
-    @staticmethod
-    def read_refresh_token() -> str:
-        """Read a refresh token from a file and return it as a string."""
+    def _request(self, method, url, refresh_on_401=True, **kwargs):
+        """
+        Send a request to the API, waiting for the rate limiter and backing
+        off when the API throttles the request. Connection errors and 5xx
+        errors are retried too: every endpoint used here only reads data, so
+        POST requests are safe to repeat. If the API rejects the data access
+        token, a new one is requested once and the request is repeated.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = url[len(self.base_url):]
+
+        def send(attempt):
+            if self.rate_limiter is not None:
+                with span("ratelimit"):
+                    self.rate_limiter.acquire()
+            start = time.monotonic()
+            try:
+                with span("http", method=method, endpoint=endpoint, attempt=attempt) as timing:
+                    response = self.session.request(method, url, **kwargs)
+                    timing.set(status=response.status_code, bytes=len(response.content))
+            except (requests.ConnectionError, requests.Timeout):
+                self.metrics.record(time.monotonic() - start, retry=attempt > 0, error=True)
+                raise
+            self.metrics.record(
+                time.monotonic() - start, len(response.content), retry=attempt > 0
+            )
+            return response
+
+        def retry(response):
+            nonlocal refresh_on_401
+            if response.status_code != 401 or not refresh_on_401:
+                return False
+            used_token = kwargs["headers"]["Authorization"][len("Bearer "):]
+            with self._token_lock:
+                # Another thread may already have refreshed the token
+                if used_token == self.data_access_token:
+                    self.update_data_access_token(force=True)
+            kwargs["headers"] = tools.get_headers(self.data_access_token)
+            refresh_on_401 = False
+            return True
+
+        return send_with_retries(
+            send, self.max_retries, retry=retry,
+            wait=self.rate_limiter.penalize if self.rate_limiter is not None else None,
+        )
+
+    def read_refresh_token(self) -> str:
+        """
+        Return the refresh token given to the constructor, or read it from a
+        file and return it as a string.
+        """
+        if self.refresh_token is not None:
+            return self.refresh_token
         with open("token.txt") as f:
-            refresh_token = f.readline()
+            refresh_token = f.readline().strip()
         return refresh_token
 
-    def update_data_access_token(self) -> str:
-        """Update the data_access_token attribute by making a request to the API."""
-        get_data_access_token_url = "https://api.eloverblik.dk/CustomerApi/api/token"
-        headers = tools.get_headers(self.read_refresh_token())
+    def update_data_access_token(self, force=False) -> str:
+        """
+        Update the data_access_token attribute, reusing the token cached on
+        disk while it is valid, otherwise making a request to the API.
 
-        response = requests.get(get_data_access_token_url, headers=headers)
-        data_access_token = response.json()["result"]
+        Parameters:
+            force: If True, ignore the cached token and request a new one.
+        """
+        refresh_token = self.read_refresh_token()
+        if self.token_cache is not None and not force:
+            cached = tokencache.load_token(self.token_cache, refresh_token)
+            if cached is not None:
+                self.data_access_token, self.token_expires = cached
+                return
+
+        get_data_access_token_url = f"{self.base_url}/token"
+        headers = tools.get_headers(refresh_token)
+
+        with span("token"):
+            response = self._request(
+                "GET", get_data_access_token_url, headers=headers, refresh_on_401=False
+            )
+            data_access_token = response.json()["result"]
 
         self.data_access_token = data_access_token
+        self.token_expires = tokencache.token_expiry(data_access_token)
+        if self.token_cache is not None:
+            tokencache.save_token(
+                self.token_cache, refresh_token, data_access_token, self.token_expires
+            )
 
         return
 
-    def get_meter_info(self) -> str:
-        """Get information about the meters and return it as a Pandas DataFrame."""
-        if self.data_access_token is None:
-            self.update_data_access_token()
+    def check_data_access_token(self, margin=3600) -> None:
+        """
+        Make sure the data_access_token attribute holds a token valid for at
+        least `margin` more seconds, updating it otherwise.
+        """
+        with self._token_lock:
+            if (
+                self.data_access_token is None
+                or self.token_expires - margin < time.time()
+            ):
+                self.update_data_access_token()
+
+    def get_meter_info(self, refresh=False) -> str:
+        """
+        Get information about the meters and return it as a Pandas DataFrame.
+
+        Parameters:
+            refresh: If True, do not serve the meter list from the response
+                cache, e.g. when a long-lived process looks for new meters.
+        """
+        cached = None
+        if self.cache is not None and not (refresh and not self.offline):
+            cached = self.cache.get("meteringpoints", self.account or "all", offline=self.offline)
+        if cached is not None:
+            meters = CachedResponse(cached)
+        elif self.offline:
+            raise CacheMiss("meteringpoints")
+        else:
+            self.check_data_access_token()
 
-        metering_points_url = "https://api.eloverblik.dk/CustomerApi/api/meteringpoints/meteringpoints"
-        headers = tools.get_headers(self.data_access_token)
-        meters = requests.get(metering_points_url, headers=headers)
+            metering_points_url = f"{self.base_url}/meteringpoints/meteringpoints"
+            headers = tools.get_headers(self.data_access_token)
+            meters = self._request("GET", metering_points_url, headers=headers)
+            if self.cache is not None and meters.status_code == 200:
+                self.cache.put("meteringpoints", self.account or "all", meters.json())
         df = pd.json_normalize(meters.json()["result"])
 
-        if self.meterids is None:
+        if self.meterids is None or refresh:
             self.meterids = df['meteringPointId'].tolist()
 
         return df
@@ -72,46 +241,102 @@ class Downloader:
             meterid: The ID of the meter to get charges for. If None, the first
                 meterid in the list will be used.
         """
-        if self.data_access_token is None:
-            self.update_data_access_token()
-
         if meterid is None:
             meterid = self.get_meter_ids()[0]
 
-        meter_charges_url = "https://api.eloverblik.dk/CustomerApi/api/meteringpoints/meteringpoint/getcharges"
-        headers = tools.get_headers(self.data_access_token)
+        return self.get_charges_batch([meterid])
 
-        meter_json = {"meteringPoints": {"meteringPoint": [meterid]}}
+    def get_charges_batch(self, meterids) -> str:
+        """
+        Get charges for several meters with a single request and return the
+        API response, which has one `result` entry per meter.
 
-        data = requests.post(
-            meter_charges_url, headers=headers, json=meter_json
-        )
+        Parameters:
+            meterids: A list of at most `batch_size` meterids.
+        """
+        meter_charges_url = f"{self.base_url}/meteringpoints/meteringpoint/getcharges"
 
-        return data
+        return self._post_meters("getcharges", meter_charges_url, meterids)
 
     def get_consumption(self, fromdate, todate, agg="Hour", meterid=None):
         """
         If `meterid` is None it will take the first meterid in the list
         """
-
-        if self.data_access_token is None:
-            self.update_data_access_token()
         if meterid is None:
             meterid = self.get_meter_ids()[0]
 
-        meter_data = (
-            "https://api.eloverblik.dk/CustomerApi/api/meterdata/gettimeseries/"
-        )
-        headers = tools.get_headers(self.data_access_token)
-        meter_data_url = f"{meter_data}{fromdate}/{todate}/{agg}"
+        return self.get_consumption_batch(fromdate, todate, [meterid], agg=agg)
 
-        meter_json = {"meteringPoints": {"meteringPoint": [meterid]}}
+    def get_consumption_batch(self, fromdate, todate, meterids, agg="Hour", refresh=False):
+        """
+        Get timeseries for several meters with a single request and return
+        the API response, which has one `result` entry per meter.
 
-        meter_data_request = requests.post(
-            meter_data_url, headers=headers, json=meter_json
+        Parameters:
+            fromdate: First date, as "YYYY-MM-DD".
+            todate: Last date (excluded), as "YYYY-MM-DD".
+            meterids: A list of at most `batch_size` meterids.
+            agg: Aggregation level of the timeseries.
+            refresh: If True, do not serve the response from the cache.
+        """
+        meter_data = f"{self.base_url}/meterdata/gettimeseries/"
+        meter_data_url = f"{meter_data}{fromdate}/{todate}/{agg}"
+
+        return self._post_meters(
+            "gettimeseries", meter_data_url, meterids, fromdate, todate, agg,
+            refresh=refresh,
         )
 
-        return meter_data_request
+    def _post_meters(self, endpoint, url, meterids, fromdate=None, todate=None, agg=None,
+                     refresh=False):
+        """
+        Post a request for several meters, serving the meters found in the
+        response cache from disk and requesting only the others.
+
+        Returns:
+            The API response if nothing is cached, otherwise a CachedResponse
+            with one `result` entry per meter, in the order of `meterids`.
+        """
+        meterids = list(meterids)
+        if self.cache is None:
+            self.check_data_access_token()
+            headers = tools.get_headers(self.data_access_token)
+            meter_json = {"meteringPoints": {"meteringPoint": meterids}}
+            return self._request("POST", url, headers=headers, json=meter_json)
+
+        results = {}
+        with span("cache", endpoint=endpoint, meters=len(meterids)) as timing:
+            for meterid in meterids if not refresh or self.offline else []:
+                entry = self.cache.get(endpoint, meterid, fromdate, todate, agg, offline=self.offline)
+                if entry is not None:
+                    results[meterid] = entry
+            timing.set(hits=len(results))
+
+        missing = [meterid for meterid in meterids if meterid not in results]
+        if len(missing) > 0:
+            if self.offline:
+                raise CacheMiss(f"{endpoint} {fromdate} {todate} {agg} {missing}")
+            self.check_data_access_token()
+            headers = tools.get_headers(self.data_access_token)
+            meter_json = {"meteringPoints": {"meteringPoint": missing}}
+            response = self._request("POST", url, headers=headers, json=meter_json)
+            if response.status_code != 200:
+                return response
+            for entry in tools.response_json(response)["result"]:
+                meterid = tools.result_meterid(entry)
+                results[meterid] = entry
+                if tools.result_error(entry) is None:
+                    self.cache.put(endpoint, meterid, entry, fromdate, todate, agg)
+
+        return CachedResponse({"result": [results[m] for m in meterids if m in results]})
+
+    def batches(self, meterids):
+        """Split a list of meterids in lists of at most `batch_size` meterids."""
+        meterids = list(meterids)
+        return [
+            meterids[i:i + self.batch_size]
+            for i in range(0, len(meterids), self.batch_size)
+        ]
 
 
 class DatabaseBuilder(Downloader):
@@ -125,13 +350,58 @@ class DatabaseBuilder(Downloader):
 
     Attributes:
         data_dir: The directory where the database is stored.
+        workers: Number of API requests run concurrently.
+        store: A ParquetStore holding the consumption data, or None if it is
+            stored in the DuckDB file.
+        spot_source: The source of spot prices, see eloverblik.spotprices.
+        price_area: The spot price area of every meter, or None to derive it
+            from the postcode of each meter.
+        planner: The RequestPlanner splitting timeseries requests, whose
+            limits are stored in the data directory.
+        agg: The aggregation of the timeseries requested.
+        failed_ranges: The (fromdate, todate, meterids, error) of each
+            request which failed since the builder was created or reset, see
+            `load_consumption`.
     """
-    def __init__(self) -> None:
+    def __init__(self, workers=1, rate=None, batch_size=10, offline=False,
+                 storage="duckdb", spot_source=None, price_area=None, agg="Actual") -> None:
         """
         Initialize the DatabaseBuilder and set the data_dir attribute.
+
+        Parameters:
+            workers: Number of (meter, year) requests run concurrently when
+                building the consumption table.
+            rate: Maximum number of requests per second sent to the API.
+            batch_size: Maximum number of meters sent in a single request.
+            offline: If True, build the database from cached API responses
+                only.
+            storage: Where `build_dataset` stores consumption data: "duckdb"
+                for a table in the database, or "parquet" for a partitioned
+                Parquet dataset, which the database reads through a view.
+                Updates use the backend the database was built with.
+            spot_source: The source of spot prices. Defaults to Energi Data
+                Service.
+            price_area: The spot price area, "DK1" or "DK2", of every meter.
+                Defaults to the area of the postcode of each meter.
+            agg: The aggregation of the timeseries requested. "Actual"
+                returns the readings at the resolution of each meter, e.g. 15
+                minutes, "Hour" sums them by hour.
         """
-        super().__init__()
+        super().__init__(
+            rate=rate, batch_size=batch_size, pool_size=max(10, workers), offline=offline
+        )
+        if storage not in ("duckdb", "parquet"):
+            raise ValueError(f"Unknown storage backend: {storage}")
         self.data_dir = tools.datapath
+        self.workers = workers
+        self.store = ParquetStore(tools.parquetpath) if storage == "parquet" else None
+        if spot_source is None:
+            spot_source = EnergiDataServiceSource(session=self.session, timeout=self.timeout)
+        self.spot_source = spot_source
+        self.price_area = price_area
+        self.planner = RequestPlanner(tools.datadir / "planner.json")
+        self.agg = agg
+        self.failed_ranges = []
 
     def get_min_date(self, meterid, conn=None):
         """
@@ -141,23 +411,18 @@ class DatabaseBuilder(Downloader):
             meterid: The ID of the meter.
 
         Returns:
-            The minimum date as a string in the format "YYYY-MM-DD".
+            The minimum date as a date, not before 2019-01-01.
         """
+        # consumerStartDate is an ISO date, possibly followed by a time
+        query = """
+            select greatest(CAST(left(consumerStartDate, 10) AS DATE), DATE '2019-01-01') as startdate
+            from meterinfo where meteringPointId = ?
+            """
         if conn is None:
             with duckdb.connect(str(self.data_dir), read_only=True) as conn:
-                v = conn.execute(
-                    f"""
-                    select greatest(consumerStartDate, DATE '2019-01-01') as startdate
-                    from meterinfo where meteringPointId={meterid}
-                    """
-                ).fetchone()[0]
+                v = conn.execute(query, [str(meterid)]).fetchone()[0]
         else:
-            v = conn.execute(
-                    f"""
-                    select greatest(consumerStartDate, DATE '2019-01-01') as startdate
-                    from meterinfo where meteringPointId={meterid}
-                    """
-                ).fetchone()[0]
+            v = conn.execute(query, [str(meterid)]).fetchone()[0]
         return v
 
     def build_consumption_table(self) -> None:
@@ -165,75 +430,542 @@ class DatabaseBuilder(Downloader):
         Build a table with consumption data in the database.
 
         This method gets consumption data for each meter in the list of meterids,
-        and stores the data in a table called "consumption" in the database.
+        and stores the data in a table called "readings" in the database, read
+        through the "consumption" view, see `load_consumption`.
         """
 
         conn = duckdb.connect(str(self.data_dir), read_only=False)
+        if tools.is_view(conn, "consumption"):
+            conn.execute("DROP VIEW consumption;")
         conn.execute("DROP TABLE IF EXISTS consumption;")
-        conn.execute(tools.tabledef_consumption("consumption"))
+        conn.execute("DROP TABLE IF EXISTS readings;")
+        if self.store is None:
+            conn.execute(tools.tabledef_readings("readings"))
+        else:
+            self.store.clear()
+        conn.execute("DROP TABLE IF EXISTS meter_resolution;")
+        conn.execute(tools.tabledef_meter_resolution("meter_resolution"))
+        anomalies.drop_tables(conn)
+        anomalies.create_tables(conn)
+
+        conn.execute("DROP TABLE IF EXISTS coverage;")
+        conn.execute(tools.tabledef_coverage("coverage"))
+        conn.execute("DROP TABLE IF EXISTS failed_ranges;")
+        conn.execute(tools.tabledef_failed_ranges("failed_ranges"))
 
-        # Get consumption data
+        # Group meters by calendar-year date range
+        periods = {}
         for meterid in self.get_meter_ids():
-            mindate = self.get_min_date(meterid, conn=conn)
-            minyear = int(mindate[:4])
-            datalist = []
-
-            for year in range(minyear, datetime.today().year):
-                # Determine when to start querying the API
-                if year == minyear:
-                    startdate = mindate
-                else:
-                    startdate = f"{year}-01-01"
-
-                datalist += [
-                    tools.data_to_df(
-                        self.get_consumption(startdate, f"{year+1}-01-01", meterid=meterid)
+            for period in tools.consumption_periods(self.get_min_date(meterid, conn=conn)):
+                periods.setdefault(period, []).append(meterid)
+
+        self.load_consumption(conn, periods)
+        if self.store is not None:
+            conn.execute(self.store.viewdef("consumption"))
+        else:
+            self.cluster_consumption(conn)
+            conn.execute(tools.viewdef_consumption("consumption"))
+        conn.execute(tools.viewdef_consumption_cost("consumption_cost"))
+
+        for table in tools.ROLLUP_TABLES:
+            conn.execute(f"DROP TABLE IF EXISTS {table};")
+        self.create_rollup_tables(conn)
+        self.refresh_rollups(conn)
+        anomalies.update_statistics(conn)
+
+        conn.close()
+
+        return
+
+    def load_consumption(self, conn, periods, refresh=False) -> None:
+        """
+        Download consumption data and upsert it into the "readings" table,
+        or append it to the Parquet store, recording each downloaded range in
+        the "coverage" table and the resolution of each meter in the
+        "meter_resolution" table. Readings are also appended to
+        "stats_pending", see eloverblik.anomalies.
+
+        The ranges are planned by `planner`, which merges close ranges of a
+        meter and splits long ones, and one request is sent per planned range
+        and batch of meters, running on `workers` threads. A request which
+        times out or is rejected as too large is bisected, see
+        RequestPlanner. Each response is streamed into the table as an Arrow
+        table, in a deterministic order, so memory use does not grow with
+        history.
+
+        Requests which fail otherwise, or whose first half fails too, and
+        meters the API answers with a failed entry, are printed, added to `failed_ranges` and recorded in the
+        "failed_ranges" table, replacing the rows of `periods`, so the next
+        update or backfill requests them again, see `add_failed_ranges`.
+
+        Parameters:
+            conn: A read-write connection to the database.
+            periods: A dictionary mapping (fromdate, todate) to the list of
+                meterids to download for that range.
+            refresh: If True, do not serve responses from the cache.
+        """
+        endpoint = f"gettimeseries/{self.agg}"
+        jobs = [
+            (startdate, enddate, batch)
+            for (startdate, enddate), meterids in self.planner.plan(periods, endpoint).items()
+            for batch in self.batches(meterids)
+        ]
+
+        # The token is shared by all workers, so fetch it before starting them
+        if not self.offline:
+            self.check_data_access_token()
+
+        def fetch(startdate, enddate, batch, splits=0):
+            """
+            Download a range for a batch of meters, splitting it if it is
+            longer than the planner's current limit, and bisecting it if the
+            API rejects it as too large.
+
+            Returns:
+                A list of (startdate, enddate, batch, data) tuples for the
+                parts which were downloaded, and a list of (startdate,
+                enddate, batch, error) tuples for the parts which failed.
+            """
+            days = (date.fromisoformat(enddate) - date.fromisoformat(startdate)).days
+            limit = self.planner.limit(endpoint)
+            if days > limit:
+                ranges = split_range(
+                    date.fromisoformat(startdate), date.fromisoformat(enddate), limit
+                )
+                results = [fetch(str(start), str(end), batch, splits) for start, end in ranges]
+                return [p for parts, _ in results for p in parts], [f for _, failed in results for f in failed]
+            response, error = None, None
+            with span("download", fromdate=startdate, todate=enddate, meterids=batch):
+                try:
+                    response = self.get_consumption_batch(
+                        startdate, enddate, batch, agg=self.agg, refresh=refresh
                     )
+                except requests.RequestException as e:
+                    error = e
+            if response is not None and response.status_code == 200:
+                self.planner.record(endpoint, days, ok=True)
+                with span("parse", fromdate=startdate, todate=enddate, meterids=batch) as timing:
+                    body = CachedResponse(tools.response_json(response))
+                    errors = tools.result_errors(body.json()["result"])
+                    data = tools.data_to_arrow(body)
+                    timing.set(rows=data.num_rows)
+                # The API answers for each meter, so meters it failed for are
+                # recorded as failed while the others are loaded
+                done = [meterid for meterid in batch if meterid not in errors]
+                parts = [(startdate, enddate, done, data)] if len(done) > 0 else []
+                return parts, [
+                    (startdate, enddate, [meterid], error) for meterid, error in errors.items()
                 ]
-            if minyear < datetime.today().year:
-                startdate = f"{datetime.today().year}-01-01"
+            halves = []
+            if is_oversized(response, error) and splits < self.planner.max_splits:
+                halves = self.planner.bisect(startdate, enddate, batch)
+            if len(halves) == 0:
+                if error is None:
+                    error = f"HTTP {response.status_code}" if response is not None else "no response"
+                return [], [(startdate, enddate, batch, str(error))]
+            parts, failed = fetch(*halves[0], splits + 1)
+            if len(parts) == 0:
+                # Nothing smaller worked either, so the error is likely not
+                # caused by the size of the request
+                return [], [(startdate, enddate, batch, failed[0][3])]
+            if halves[0][2] == batch:
+                # A shorter range worked, so this one was too long
+                self.planner.record(endpoint, days, ok=False)
+            more_parts, more_failed = fetch(*halves[1], splits + 1)
+            return parts + more_parts, failed + more_failed
+
+        # At most two responses per worker are held in memory
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = tools.ordered_map(executor, lambda job: fetch(*job), jobs, 2 * self.workers)
+            for parts, failures in results:
+                failed += failures
+                for startdate, enddate, batch, data in parts:
+                    with span("insert", fromdate=startdate, todate=enddate, meterids=batch,
+                              rows=data.num_rows):
+                        if self.store is None:
+                            conn.execute(tools.upsert_readings("data"))
+                        else:
+                            self.store.append(tools.readings_to_consumption(data))
+                        conn.execute(tools.upsert_meter_resolution("data"))
+                        conn.execute(
+                            "INSERT INTO stats_pending SELECT meterid, minute, Wh, resolution FROM data"
+                        )
+                        conn.executemany(
+                            "INSERT INTO coverage VALUES (?, ?, ?, ?)",
+                            [(meterid, startdate, enddate, datetime.now()) for meterid in batch],
+                        )
+        self.planner.save()
+
+        for startdate, enddate, batch, error in failed:
+            print(f"Failed to download {startdate} to {enddate} for {len(batch)} meters "
+                  f"({', '.join(batch)}): {error}", file=sys.stderr)
+        self.failed_ranges += failed
+        conn.executemany(
+            "DELETE FROM failed_ranges WHERE meterid = ? AND fromdate >= ? AND todate <= ?",
+            [(meterid, startdate, enddate) for (startdate, enddate), meterids in periods.items()
+             for meterid in meterids],
+        )
+        conn.executemany(
+            "INSERT INTO failed_ranges VALUES (?, ?, ?, ?, ?)",
+            [(meterid, startdate, enddate, error, datetime.now())
+             for startdate, enddate, batch, error in failed for meterid in batch],
+        )
+
+    @staticmethod
+    def cluster_consumption(conn) -> None:
+        """
+        Rewrite the "readings" table sorted by (meterid, minute).
+
+        Responses are inserted by date range, so the readings of a meter end
+        up spread over the whole table. Once sorted, the zone maps of each
+        row group cover few meters and a short time span, and DuckDB skips
+        the row groups a per-meter or per-period query does not need.
+        """
+        with span("cluster"):
+            conn.execute("BEGIN TRANSACTION")
+            conn.execute(tools.tabledef_readings("readings_sorted"))
+            conn.execute(
+                """
+                INSERT INTO readings_sorted
+                SELECT meterid, minute, Wh, quality FROM readings ORDER BY meterid, minute
+                """
+            )
+            conn.execute("DROP TABLE readings")
+            conn.execute("ALTER TABLE readings_sorted RENAME TO readings")
+            conn.execute("COMMIT")
+
+    @staticmethod
+    def create_rollup_tables(conn) -> bool:
+        """
+        Create the rollup tables which do not exist yet.
+
+        Returns:
+            True if any table was created, in which case the rollups should be
+            refreshed for the whole history.
+        """
+        tables = [t[0] for t in conn.execute("select table_name from duckdb_tables()").fetchall()]
+        created = False
+        for table, tabledef in tools.ROLLUP_TABLES.items():
+            if table not in tables:
+                conn.execute(tabledef(table))
+                created = True
+        return created
+
+    @staticmethod
+    def affected_consumption(conn, periods=None) -> str:
+        """
+        Return a relation with the readings of the months touched by
+        `periods`, see refresh_rollups.
+
+        The months are written as literal bounds on the stored columns,
+        "minute" of "readings" or "date" of a Parquet dataset, rather than
+        joined, so that DuckDB prunes the scan instead of decoding the whole
+        history.
+        """
+        if periods is None:
+            return "consumption"
+        readings = tools.is_table(conn, "readings")
+        epoch = pd.Timestamp("1970-01-01")
+        filters = []
+        for (startdate, enddate), meterids in periods.items():
+            if len(meterids) == 0:
+                continue
+            lo = pd.Timestamp(startdate).to_period("M").to_timestamp()
+            hi = pd.Timestamp(enddate).to_period("M").to_timestamp() + pd.DateOffset(months=1)
+            meters = ", ".join("'" + str(m).replace("'", "''") + "'" for m in sorted(set(meterids)))
+            if readings:
+                lo, hi = (int((t - epoch).total_seconds()) // 60 for t in (lo, hi))
+                bounds = f"minute >= {lo} and minute < {hi}"
             else:
-                startdate = mindate
-            datalist += [
-                tools.data_to_df(
-                    self.get_consumption(
-                        startdate,
-                        f"{str(date.today())}",
-                        meterid=meterid
-                    )
-                )
-            ]
-            data = pd.concat(datalist).reset_index(drop=True)
-            data['meterid'] = meterid
+                bounds = f"date >= TIMESTAMP '{lo}' and date < TIMESTAMP '{hi}'"
+            filters.append(f"({bounds} and meterid in ({meters}))")
+        where = " or ".join(filters) if len(filters) > 0 else "false"
+        if not readings:
+            return f"(select * from consumption where {where})"
+        return f"""(
+            SELECT meterid, TIMESTAMP '1970-01-01 00:00:00' + to_minutes(minute) as date
+            , CAST(Wh / 1000 AS DECIMAL(9, 3)) as kWh, quality
+            FROM readings where {where}
+        )"""
 
-            conn.execute("INSERT INTO consumption SELECT meterid, date, kWh FROM data")
+    @staticmethod
+    def refresh_rollups(conn, periods=None) -> None:
+        """
+        Recompute the rollup tables for the months touched by `periods`.
 
-        conn.close()
+        The daily and hour-of-day rollups are recomputed from "consumption"
+        for every affected (meter, month), the monthly rollup from the daily
+        one and the yearly rollup from the monthly one, so the cost of an
+        update does not depend on how much history is stored. The cost of
+        each reading is found with an ASOF join on "tariff_schedule", and its
+        spot cost with a join on "spot_prices". Readings shorter than an hour
+        are summed, and `n` counts the hours with readings, so averages by
+        hour do not depend on the resolution of the meters.
 
-        return
+        Parameters:
+            conn: A read-write connection to the database.
+            periods: A dictionary mapping (fromdate, todate) to a list of
+                meterids, as passed to `load_consumption`. If None, the
+                rollups are recomputed for the whole history.
+        """
+        if periods is not None and len(periods) == 0:
+            return
+        with span("rollups", periods=len(periods) if periods is not None else "all"):
+            if periods is None:
+                conn.execute(
+                    """
+                    CREATE OR REPLACE TEMP TABLE affected_months AS
+                    select distinct meterid, CAST(date_trunc('month', date) AS DATE) as month
+                    from consumption
+                    """
+                )
+            else:
+                affected = pd.DataFrame(
+                    [
+                        (meterid, startdate, enddate)
+                        for (startdate, enddate), meterids in periods.items()
+                        for meterid in meterids
+                    ],
+                    columns=["meterid", "fromdate", "todate"],
+                )
+                conn.execute(
+                    """
+                    CREATE OR REPLACE TEMP TABLE affected_months AS
+                    select distinct meterid
+                    , CAST(unnest(generate_series(
+                        CAST(date_trunc('month', CAST(fromdate AS DATE)) AS TIMESTAMP),
+                        CAST(todate AS TIMESTAMP),
+                        INTERVAL 1 MONTH
+                    )) AS DATE) as month
+                    from affected
+                    """
+                )
+
+            source = DatabaseBuilder.affected_consumption(conn, periods)
+            conn.execute("BEGIN TRANSACTION")
+            conn.execute(
+                """
+                DELETE FROM consumption_daily as d
+                WHERE EXISTS (
+                    select 1 from affected_months as a
+                    where a.meterid=d.meterid and a.month=date_trunc('month', d.day)
+                )
+                """
+            )
+            conn.execute(
+                f"""
+                INSERT INTO consumption_daily
+                SELECT c.meterid, CAST(c.date AS DATE) as day, SUM(c.kWh)
+                , COUNT(DISTINCT HOUR(c.date))
+                , SUM(c.kWh * s.price), SUM(c.kWh * p.price)
+                from {source} as c
+                inner join affected_months as a
+                on c.meterid=a.meterid
+                and c.date >= a.month and c.date < a.month + INTERVAL 1 MONTH
+                left join meterinfo as mi on mi.meteringPointId=c.meterid
+                left join spot_prices as p
+                on p.area=mi.priceArea and p.hour=date_trunc('hour', c.date)
+                ASOF LEFT JOIN tariff_schedule as s
+                on c.meterid=s.meterid and HOUR(c.date)=s.hour and c.date >= s.validfrom
+                group by c.meterid, CAST(c.date AS DATE)
+                """
+            )
+            conn.execute(
+                """
+                DELETE FROM consumption_hourly as h
+                WHERE EXISTS (
+                    select 1 from affected_months as a
+                    where a.meterid=h.meterid and YEAR(a.month)=h.year and MONTH(a.month)=h.month
+                )
+                """
+            )
+            conn.execute(
+                f"""
+                INSERT INTO consumption_hourly
+                SELECT c.meterid, YEAR(c.date), MONTH(c.date), HOUR(c.date), SUM(c.kWh)
+                , COUNT(DISTINCT DAY(c.date))
+                from {source} as c
+                inner join affected_months as a
+                on c.meterid=a.meterid
+                and c.date >= a.month and c.date < a.month + INTERVAL 1 MONTH
+                group by c.meterid, YEAR(c.date), MONTH(c.date), HOUR(c.date)
+                """
+            )
+            conn.execute(
+                """
+                DELETE FROM consumption_monthly as m
+                WHERE EXISTS (
+                    select 1 from affected_months as a
+                    where a.meterid=m.meterid and a.month=m.month
+                )
+                """
+            )
+            conn.execute(
+                """
+                INSERT INTO consumption_monthly
+                SELECT d.meterid, CAST(date_trunc('month', d.day) AS DATE) as month, SUM(d.kWh), SUM(d.n)
+                , SUM(d.cost), SUM(d.spot_cost)
+                from consumption_daily as d
+                inner join affected_months as a
+                on d.meterid=a.meterid and date_trunc('month', d.day)=a.month
+                group by d.meterid, date_trunc('month', d.day)
+                """
+            )
+            conn.execute(
+                """
+                DELETE FROM consumption_yearly as y
+                WHERE EXISTS (
+                    select 1 from affected_months as a
+                    where a.meterid=y.meterid and YEAR(a.month)=y.year
+                )
+                """
+            )
+            conn.execute(
+                """
+                INSERT INTO consumption_yearly
+                SELECT m.meterid, YEAR(m.month) as year, SUM(m.kWh), SUM(m.n), SUM(m.cost), SUM(m.spot_cost)
+                from consumption_monthly as m
+                where exists (
+                    select 1 from affected_months as a
+                    where a.meterid=m.meterid and YEAR(a.month)=YEAR(m.month)
+                )
+                group by m.meterid, YEAR(m.month)
+                """
+            )
+            conn.execute("COMMIT")
 
-    def build_tariffs_dataset(self) -> None:
+    def build_tariffs_dataset(self, conn) -> bool:
         """
-        Build a table with current tariff data in the database.
+        Update the tariff tables of the database.
+
+        This method gets the current tariffs for each meter in the list of
+        meterids, and stores them in a table called "current_tariffs" in the
+        database. The tariffs are also added, with their validity period, to
+        the "tariffs" table, which keeps every tariff seen so far, and the
+        "tariff_schedule" table, used to compute the cost of consumption, is
+        recomputed from it. Meters whose charges could not be downloaded are
+        printed and keep the tariffs known so far; if no charges could be
+        downloaded, the tables are left as they are.
 
-        This method gets the current tariffs for each meter in the list of meterids,
-        and stores the data in a table called "current_tariffs" in the database.
+        Returns:
+            True if the tariff schedule changed, in which case the cost in
+            the rollup tables should be recomputed for the whole history.
         """
-        tdata = []
-        for meterid in self.get_meter_ids():
-            data = self.get_charges()
-            tariffs = tools.extract_tariffs(data)
-            tariffs['meterid'] = meterid
-            tdata += [tariffs]
+        tdata, history, skipped = [], [], []
+        for batch in self.batches(self.get_meter_ids()):
+            response = self.get_charges_batch(batch)
+            if response is None or response.status_code != 200:
+                skipped += batch
+                continue
+            with span("parse", endpoint="getcharges", meterids=batch):
+                response = CachedResponse(tools.response_json(response))
+                errors = tools.result_errors(response.json()["result"])
+                skipped += list(errors)
+                if len(errors) == len(response.json()["result"]):
+                    continue
+                tdata += [tools.batch_extract_tariffs(response)]
+                history += [tools.tariff_history(response)]
+        if len(skipped) > 0:
+            print(f"Failed to download the charges of {len(skipped)} meters "
+                  f"({', '.join(skipped)}), keeping their known tariffs", file=sys.stderr)
+
+        tables = [t[0] for t in conn.execute("select table_name from duckdb_tables()").fetchall()]
+        if "tariffs" not in tables:
+            conn.execute(tools.tabledef_tariffs("tariffs"))
+        if len(tdata) == 0:
+            if "tariff_schedule" not in tables:
+                conn.execute(tools.tariff_schedule("tariff_schedule"))
+            return False
 
         tdata = pd.concat(tdata)
+        history = pd.concat(history)
+        with span("insert", table="tariffs", rows=len(history)):
+            if "current_tariffs" in tables and len(skipped) > 0:
+                previous = conn.execute(
+                    "select * from current_tariffs where list_contains(?, meterid)", [skipped]
+                ).df()
+                tdata = pd.concat([tdata, previous], ignore_index=True)
+            conn.execute("DROP TABLE IF EXISTS current_tariffs;")
+            conn.execute("CREATE TABLE current_tariffs AS SELECT * FROM tdata")
+            conn.execute(tools.upsert_tariffs("history"))
+            conn.execute(tools.tariff_schedule("tariff_schedule_new"))
 
-        conn = duckdb.connect(str(self.data_dir), read_only=False)
-        conn.execute("DROP TABLE IF EXISTS current_tariffs;")
-        conn.execute("CREATE TABLE current_tariffs AS SELECT * FROM tdata")
-        conn.close()
+        changed = "tariff_schedule" not in tables or conn.execute(
+            """
+            select count(*) from (
+                (select * from tariff_schedule_new except select * from tariff_schedule)
+                union all
+                (select * from tariff_schedule except select * from tariff_schedule_new)
+            )
+            """
+        ).fetchone()[0] > 0
+        conn.execute("DROP TABLE IF EXISTS tariff_schedule")
+        conn.execute("ALTER TABLE tariff_schedule_new RENAME TO tariff_schedule")
 
-        return
+        return changed
+
+    def update_spot_prices(self, conn) -> dict:
+        """
+        Add the spot prices of the price areas of the meters to the
+        "spot_prices" table, from the last stored hour of each area, or from
+        the start date of its first meter, up to tomorrow. Prices are
+        upserted on (area, hour), so loads are idempotent. If the prices of
+        an area cannot be downloaded, the error is printed and the other
+        areas are updated. In offline mode, the stored prices are used as
+        they are.
+
+        Returns:
+            A dictionary mapping (fromdate, todate) to the meterids whose
+            spot cost must be recomputed for that range, as expected by
+            `refresh_rollups`.
+        """
+        if self.offline:
+            return {}
+        areas = conn.execute(
+            """
+            select mi.priceArea
+            , MIN(greatest(CAST(left(mi.consumerStartDate, 10) AS DATE), DATE '2019-01-01'))
+            , CAST(MAX(p.hour) AS DATE)
+            , list(DISTINCT mi.meteringPointId)
+            from meterinfo as mi
+            left join spot_prices as p on p.area=mi.priceArea
+            where mi.priceArea is not null
+            group by mi.priceArea
+            """
+        ).fetchall()
+        # Day-ahead prices of tomorrow are published in the afternoon
+        todate = date.today() + timedelta(days=2)
+        affected = {}
+        for area, startdate, lastdate, meterids in areas:
+            fromdate = lastdate if lastdate is not None else startdate
+            for period in tools.consumption_periods(fromdate, today=todate):
+                try:
+                    prices = self.spot_source.fetch(area, *period)
+                except (requests.RequestException, ValueError, KeyError) as e:
+                    # The next update starts from the last stored hour, so
+                    # the later periods of the area are left for it too
+                    print(f"Failed to download the spot prices of {area} from {period[0]} "
+                          f"to {period[1]}: {e!r}", file=sys.stderr)
+                    break
+                with span("insert", table="spot_prices", rows=len(prices)):
+                    conn.execute(tools.upsert_spot_prices("prices"))
+                affected[period] = affected.get(period, []) + meterids
+        return affected
+
+    def build_meterinfo_table(self, conn, refresh=False) -> None:
+        """
+        Replace the "meterinfo" table with the meters currently listed by the
+        API, bypassing the response cache if `refresh` is True.
+        """
+        meter_info = self.get_meter_info(refresh=refresh)
+        if self.price_area is not None:
+            meter_info["priceArea"] = self.price_area
+        else:
+            meter_info["priceArea"] = meter_info["postcode"].map(tools.price_area)
+        with span("insert", table="meterinfo", rows=len(meter_info)):
+            conn.execute("DROP TABLE IF EXISTS meterinfo;")
+            conn.execute("CREATE TABLE meterinfo AS SELECT * FROM meter_info")
 
     def build_dataset(self) -> None:
         """
@@ -242,45 +974,331 @@ class DatabaseBuilder(Downloader):
         This method gets meter information, consumption data, and current tariff data
         for each meter in the list of meterids, and stores the data in the database.
         """
-        meter_info = self.get_meter_info()
+        self.data_dir.parent.mkdir(parents=True, exist_ok=True)
         conn = duckdb.connect(str(self.data_dir), read_only=False)
-        conn.execute("DROP TABLE IF EXISTS meterinfo;")
-        meter_info.shape
-        conn.execute("CREATE TABLE meterinfo AS SELECT * FROM meter_info")
+        self.build_meterinfo_table(conn)
+        # Tariffs and spot prices are needed to compute the cost in the
+        # rollups. Spot prices do not depend on the meters and are kept.
+        conn.execute("DROP TABLE IF EXISTS tariffs;")
+        self.build_tariffs_dataset(conn)
+        if "spot_prices" not in [t[0] for t in conn.execute("select table_name from duckdb_tables()").fetchall()]:
+            conn.execute(tools.tabledef_spot_prices("spot_prices"))
+        self.update_spot_prices(conn)
         conn.close()
 
         self.build_consumption_table()
 
-        self.build_tariffs_dataset()
+        tools.bump_db_version(self.data_dir)
+
+        if self.cache is not None and not self.offline:
+            self.cache.prune()
 
         return
 
-    def update_dataset(self) -> pd.DataFrame:
+    def detect_storage(self, conn) -> None:
+        """
+        Use the storage backend the database was built with: consumption data
+        is in the Parquet store if "consumption" is a view which is not over
+        the "readings" table.
+
+        Earlier versions of the store kept superseded readings until
+        compaction and removed them in the view: the store is then compacted
+        and the view created again.
+        """
+        if tools.is_view(conn, "consumption") and not tools.is_table(conn, "readings"):
+            if self.store is None:
+                self.store = ParquetStore(tools.parquetpath)
+            sql = conn.execute(
+                "select sql from duckdb_views() where view_name = 'consumption'"
+            ).fetchone()[0]
+            if "hive_partitioning" not in sql:
+                self.store.compact()
+                conn.execute(self.store.viewdef("consumption"))
+                conn.execute(tools.viewdef_consumption_cost("consumption_cost"))
+        else:
+            self.store = None
+
+    @staticmethod
+    def migrate_tables(conn) -> None:
+        """
+        Bring tables created by earlier versions up to date: convert a
+        "consumption" table to the compact "readings" table read through the
+        "consumption" view, dropping duplicated rows, create the "coverage",
+        "failed_ranges", tariff, "spot_prices" and "meter_resolution" tables,
+        and drop rollup tables without cost columns or rounding kWh to 2
+        decimals, so that they are created and computed again.
+        """
+        tables = [t[0] for t in conn.execute("select table_name from duckdb_tables()").fetchall()]
+        if "coverage" not in tables:
+            conn.execute(tools.tabledef_coverage("coverage"))
+        if "failed_ranges" not in tables:
+            conn.execute(tools.tabledef_failed_ranges("failed_ranges"))
+        if "tariffs" not in tables:
+            conn.execute(tools.tabledef_tariffs("tariffs"))
+            conn.execute(tools.tariff_schedule("tariff_schedule"))
+        if "spot_prices" not in tables:
+            conn.execute(tools.tabledef_spot_prices("spot_prices"))
+        if "meter_resolution" not in tables:
+            conn.execute(tools.tabledef_meter_resolution("meter_resolution"))
+        if "consumption_daily" in tables:
+            columns = dict(
+                (c[1], c[2]) for c in conn.execute("PRAGMA table_info('consumption_daily')").fetchall()
+            )
+            if "spot_cost" not in columns or columns["kWh"] != "DECIMAL(18,3)":
+                for table in tools.ROLLUP_TABLES:
+                    conn.execute(f"DROP TABLE IF EXISTS {table};")
+        if not tools.is_view(conn, "consumption_cost"):
+            conn.execute(tools.viewdef_consumption_cost("consumption_cost"))
+        if tools.is_view(conn, "consumption"):
+            # Over the "readings" table, or a ParquetStore, which is keyed by
+            # construction
+            return
+        columns = [c[1] for c in conn.execute("PRAGMA table_info('consumption')").fetchall()]
+        quality = "MAX(quality)" if "quality" in columns else "NULL"
+        conn.execute("BEGIN TRANSACTION")
+        conn.execute(tools.tabledef_readings("readings"))
+        conn.execute(
+            f"""
+            INSERT INTO readings (meterid, minute, Wh, quality)
+            SELECT CAST(meterid AS VARCHAR), CAST(epoch(date) // 60 AS INTEGER)
+            , CAST(round(MAX(kWh) * 1000) AS INTEGER), {quality}
+            FROM consumption
+            GROUP BY meterid, date ORDER BY meterid, date
+            """
+        )
+        # Earlier versions only downloaded hourly readings
+        conn.execute(
+            """
+            INSERT OR IGNORE INTO meter_resolution
+            SELECT meterid, 60, MAX(minute) FROM readings GROUP BY meterid
+            """
+        )
+        conn.execute("DROP TABLE consumption")
+        conn.execute(tools.viewdef_consumption("consumption"))
+        # Views are bound to the types of the columns they read
+        conn.execute(tools.viewdef_consumption_cost("consumption_cost"))
+        conn.execute("COMMIT")
+
+    def reset(self) -> None:
+        """
+        Forget the list of meters, so that the next request lists them again,
+        e.g. between updates run by a long-lived process, and the failed
+        ranges of the last run.
+        """
+        self.meterids = None
+        self.failed_ranges = []
+
+    def update_dataset(self, meterids=None, refresh=False) -> pd.DataFrame:
         """
         Update the database with new data.
 
-        This method updates the "consumption" table in the database with new
-        consumption data for each meter in the list of meterids.
+        This method updates the "readings" table in the database with new
+        consumption data for each meter in the list of meterids. The last
+        stored day of each meter is requested again and rows are upserted on
+        (meterid, minute), so running an update twice, or after a partial
+        failure, does not create duplicates. Meters without any data are
+        downloaded from their start date, and ranges which failed to
+        download before are requested again. Tariffs are updated too, and when
+        they changed the cost of the whole history is recomputed. New spot
+        prices are downloaded, and the spot cost of the months they cover is
+        recomputed. The new hours are scored and included in the statistics
+        of each meter, see eloverblik.anomalies.
 
-        Returns:
-            A DataFrame with the new data that was added to the database.
+        Parameters:
+            meterids: The meters whose consumption is updated. Defaults to
+                all meters.
+            refresh: If True, do not serve the meter list and consumption
+                from the response cache, e.g. when polling for new meters and
+                readings published since the last update.
         """
         conn = duckdb.connect(str(self.data_dir), read_only=False)
-        for meterid in self.get_meter_ids():
-            lastdate = (
-                conn.execute(f"select MAX(date) from consumption where meterid={meterid}")
-                .fetchall()[0][0]
-                .date()
-            )
-            if date.today() - timedelta(days=1) > lastdate:
-                updatedf = tools.data_to_df(
-                    self.get_consumption(
-                        lastdate + timedelta(days=1), f"{str(date.today())}", meterid=meterid
-                    )
-                )
-                updatedf['meterid'] = meterid
-                conn.execute("insert into consumption select meterid, date, kWh from updatedf")
+        self.detect_storage(conn)
+        self.build_meterinfo_table(conn, refresh=refresh)
+        self.migrate_tables(conn)
+        if anomalies.create_tables(conn):
+            anomalies.update_statistics(conn, history=True)
+        tariffs_changed = self.build_tariffs_dataset(conn)
+        repriced = self.update_spot_prices(conn)
+
+        watermarks = dict(
+            conn.execute(
+                "select meterid, MAX(date) from consumption group by meterid"
+            ).fetchall()
+        )
+
+        # Group meters by the date range to request
+        missing = {}
+        yesterday = date.today() - timedelta(days=1)
+        selected = [m for m in self.get_meter_ids() if meterids is None or m in meterids]
+        for meterid in selected:
+            lastdate = watermarks.get(meterid)
+            if lastdate is None:
+                periods = tools.consumption_periods(self.get_min_date(meterid, conn=conn))
+            elif lastdate < datetime(yesterday.year, yesterday.month, yesterday.day, 23):
+                periods = [(str(lastdate.date()), str(date.today()))]
             else:
                 print("Database is already updated")
+                periods = []
+            for period in periods:
+                missing.setdefault(period, []).append(meterid)
+        missing = self.add_failed_ranges(conn, missing, selected)
+
+        self.load_consumption(conn, missing, refresh=refresh)
+        if self.create_rollup_tables(conn) or tariffs_changed:
+            self.refresh_rollups(conn)
+        else:
+            periods = dict(missing)
+            for period, meterids in repriced.items():
+                periods[period] = periods.get(period, []) + meterids
+            self.refresh_rollups(conn, periods)
+        anomalies.update_statistics(conn)
         conn.close()
+        tools.bump_db_version(self.data_dir)
+
+        if self.store is not None:
+            self.store.start_compaction(
+                meterids={m for meterids in missing.values() for m in meterids}
+            )
+
+        if self.cache is not None and not self.offline:
+            self.cache.prune()
+
         return
+
+    @staticmethod
+    def add_failed_ranges(conn, periods, meterids=None) -> dict:
+        """
+        Add the ranges recorded in the "failed_ranges" table to `periods`.
+
+        Parameters:
+            conn: A connection to the database.
+            periods: A dictionary mapping (fromdate, todate) to a list of
+                meterids, as passed to `load_consumption`.
+            meterids: Only add the ranges of these meters. Defaults to all.
+
+        Returns:
+            A new dictionary in the same format.
+        """
+        periods = {period: list(ids) for period, ids in periods.items()}
+        failed = conn.execute(
+            "select distinct meterid, fromdate, todate from failed_ranges order by all"
+        ).fetchall()
+        for meterid, fromdate, todate in failed:
+            if meterids is not None and meterid not in meterids:
+                continue
+            ids = periods.setdefault((str(fromdate), str(todate)), [])
+            if meterid not in ids:
+                ids.append(meterid)
+        return periods
+
+    def find_gaps(self, conn, settle_days=7, max_attempts=3) -> pd.DataFrame:
+        """
+        Find the date ranges of each meter with missing or estimated hours.
+
+        The hourly grid between each meter's start date and its last reading
+        is compared with the "consumption" table, and days with missing hours
+        or readings whose quality is in tools.ESTIMATED_QUALITY are merged in
+        consecutive ranges. The hour skipped when daylight saving time
+        starts, which no download can fill, is not part of the grid.
+
+        A day is downloaded again until it has been downloaded
+        `max_attempts` times, counting only the downloads made at least
+        `settle_days` days after it ended, when its data should be final.
+        Days the API has no data for are thus not requested forever.
+
+        Returns:
+            A DataFrame with columns meterid, fromdate and todate (excluded).
+        """
+        quality = ", ".join(f"'{q}'" for q in tools.ESTIMATED_QUALITY)
+        return conn.execute(
+            f"""
+            with bounds as (
+                select c.meterid
+                , greatest(
+                    CAST(left(CAST(mi.consumerStartDate AS VARCHAR), 10) AS DATE),
+                    DATE '2019-01-01'
+                ) as mindate
+                , MAX(c.date) as maxdate
+                from consumption as c
+                inner join meterinfo as mi
+                on c.meterid=mi.meteringPointId
+                group by c.meterid, mi.consumerStartDate
+            ), grid as (
+                select meterid
+                , unnest(generate_series(CAST(mindate AS TIMESTAMP), maxdate, INTERVAL 1 HOUR)) as date
+                from bounds
+            ), days as (
+                select distinct g.meterid, CAST(g.date AS DATE) as day
+                from grid as g
+                left join consumption as c
+                on c.meterid=g.meterid and c.date=g.date
+                where c.date is null
+                -- Readings are dated by position from midnight, so the day
+                -- daylight saving time starts, the last Sunday of March,
+                -- has no reading at 23:00
+                and not (
+                    month(g.date) = 3 and dayofweek(g.date) = 0
+                    and day(g.date) >= 25 and hour(g.date) = 23
+                )
+                union
+                select meterid, CAST(date AS DATE) as day
+                from consumption
+                where quality in ({quality})
+            ), pending as (
+                select d.meterid, d.day
+                from days as d
+                left join coverage as v
+                on v.meterid=d.meterid
+                and d.day >= v.fromdate and d.day < v.todate
+                and v.fetched >= d.day + INTERVAL {int(settle_days) + 1} DAY
+                group by d.meterid, d.day
+                having count(v.meterid) < {int(max_attempts)}
+            )
+            select meterid
+            , MIN(day) as fromdate
+            , MAX(day) + 1 as todate
+            from (
+                select meterid, day
+                , day - CAST(row_number() over (partition by meterid order by day) AS INTEGER) as island
+                from pending
+            )
+            group by meterid, island
+            order by meterid, fromdate
+            """
+        ).df()
+
+    def backfill_dataset(self, settle_days=7, max_attempts=3) -> pd.DataFrame:
+        """
+        Download again the ranges returned by `find_gaps` and the ranges
+        which failed to download before, bypassing the response cache, and
+        upsert them into the "readings" table. Each download is recorded in
+        the "coverage" table, which counts the attempts of `find_gaps`.
+
+        Returns:
+            The DataFrame of the ranges that were downloaded.
+        """
+        conn = duckdb.connect(str(self.data_dir), read_only=False)
+        self.detect_storage(conn)
+        self.migrate_tables(conn)
+        if anomalies.create_tables(conn):
+            anomalies.update_statistics(conn, history=True)
+        gaps = self.find_gaps(conn, settle_days=settle_days, max_attempts=max_attempts)
+
+        periods = {}
+        for meterid, fromdate, todate in gaps.itertuples(index=False):
+            periods.setdefault((str(fromdate.date()), str(todate.date())), []).append(meterid)
+        periods = self.add_failed_ranges(conn, periods)
+
+        self.load_consumption(conn, periods, refresh=True)
+        if self.create_rollup_tables(conn):
+            self.refresh_rollups(conn)
+        else:
+            self.refresh_rollups(conn, periods)
+        anomalies.update_statistics(conn)
+        conn.close()
+        tools.bump_db_version(self.data_dir)
+
+        if self.store is not None:
+            self.store.start_compaction(meterids=set(gaps["meterid"]))
+
+        return gaps
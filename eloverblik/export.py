@@ -0,0 +1,172 @@
+"""
+Streaming exports of the database to Parquet, CSV and Arrow IPC.
+
+Results are fetched from DuckDB as Arrow record batches and written one batch
+at a time. Sorting the rows is done by DuckDB within a memory limit, spilling
+to a temporary directory beyond it, so memory use does not depend on the size
+of the export. Unsorted exports stream rows in storage order, which is
+faster.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import duckdb
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
+
+import eloverblik.tools as tools
+
+# For each resolution, the table it is read from and the expression of the
+# start of each row's period, used by the date filters. "hour" exports the
+# readings at the resolution of each meter, which may be 15 minutes. Other
+# resolutions are read from the rollups maintained by DatabaseBuilder;
+# "hour-of-day" is the consumption by hour of day of each month.
+RESOLUTIONS = {
+    "hour": ("consumption", "date"),
+    "day": ("consumption_daily", "day"),
+    "month": ("consumption_monthly", "month"),
+    "year": ("consumption_yearly", "make_date(year, 1, 1)"),
+    "hour-of-day": ("consumption_hourly", "make_date(year, month, 1)"),
+}
+
+# Output formats, by file extension. "arrows" is the Arrow IPC stream
+# format, which can be read while it is written, e.g. from a pipe.
+FORMATS = {
+    ".parquet": "parquet",
+    ".csv": "csv",
+    ".arrow": "arrow",
+    ".arrows": "arrows",
+}
+
+# The columns by which each resolution is sorted
+ORDER = {
+    "hour": "meterid, date",
+    "day": "meterid, day",
+    "month": "meterid, month",
+    "year": "meterid, year",
+    "hour-of-day": "meterid, year, month, hour",
+}
+
+
+def export_query(resolution="hour", meterids=None, fromdate=None, todate=None,
+                 cost=False, sort=True) -> tuple:
+    """
+    Return the query selecting the rows to export, and its parameters.
+
+    Parameters:
+        resolution: One of RESOLUTIONS.
+        meterids: The meters to export, or None for all meters.
+        fromdate: The first date to export, as "YYYY-MM-DD", or None. Days,
+            months and years are exported if they start on or after it.
+        todate: The date after the last one to export, or None.
+        cost: If True, readings are exported with the tariff and spot price
+            of their hour and their cost, from the "consumption_cost"
+            view. Rollups always include their cost.
+        sort: If True, rows are sorted by meter and date.
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown resolution: {resolution}")
+    table, start = RESOLUTIONS[resolution]
+    if resolution == "hour" and cost:
+        table = "consumption_cost"
+    conditions = []
+    params = []
+    if meterids:
+        conditions.append("list_contains(?, meterid)")
+        params.append([str(m) for m in meterids])
+    if fromdate is not None:
+        conditions.append(f"{start} >= CAST(? AS DATE)")
+        params.append(str(fromdate))
+    if todate is not None:
+        conditions.append(f"{start} < CAST(? AS DATE)")
+        params.append(str(todate))
+    where = f"where {' and '.join(conditions)}" if conditions else ""
+    query = f"select * from {table} {where}"
+    if sort:
+        query += f" order by {ORDER[resolution]}"
+    return query, params
+
+
+def format_of(path) -> str:
+    """Return the output format matching the extension of `path`, or None."""
+    return FORMATS.get(Path(path).suffix.lower())
+
+
+def open_writer(fmt: str, sink, schema: pa.Schema):
+    """Return a writer of record batches with `schema` to `sink`, in format `fmt`."""
+    if fmt == "parquet":
+        return pq.ParquetWriter(sink, schema)
+    if fmt == "csv":
+        return pcsv.CSVWriter(sink, schema)
+    if fmt == "arrow":
+        return pa.ipc.new_file(sink, schema)
+    if fmt == "arrows":
+        return pa.ipc.new_stream(sink, schema)
+    raise ValueError(f"Unknown format: {fmt}")
+
+
+def write_batches(reader: pa.RecordBatchReader, fmt: str, sink) -> int:
+    """
+    Write the batches of `reader` to `sink` one at a time.
+
+    Returns:
+        The number of rows written.
+    """
+    rows = 0
+    writer = open_writer(fmt, sink, reader.schema)
+    try:
+        for batch in reader:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    finally:
+        writer.close()
+    return rows
+
+
+def export(output, fmt=None, resolution="hour", meterids=None, fromdate=None,
+           todate=None, cost=False, sort=True, batch_rows=1_000_000,
+           memory_limit="256MB", path=None) -> int:
+    """
+    Export consumption data to a file, or to stdout.
+
+    The file is written under a temporary name and renamed when complete, so
+    an interrupted export does not leave a partial file.
+
+    Parameters:
+        output: The output file, or "-" for stdout.
+        fmt: One of "parquet", "csv", "arrow" or "arrows". Defaults to the
+            format of the extension of `output`, or "csv" for stdout.
+        resolution, meterids, fromdate, todate, cost, sort: See
+            `export_query`.
+        batch_rows: Number of rows fetched and written at a time, which
+            is the size of Parquet row groups.
+        memory_limit: The memory DuckDB may use, e.g. to sort the rows.
+        path: The database. Defaults to tools.datapath.
+
+    Returns:
+        The number of rows written.
+    """
+    if fmt is None:
+        fmt = "csv" if output == "-" else format_of(output)
+        if fmt is None:
+            raise ValueError(f"Cannot guess the format of {output}, set it explicitly")
+    query, params = export_query(resolution, meterids, fromdate, todate, cost, sort)
+    with tempfile.TemporaryDirectory(prefix="eloverblik-export-") as spill, \
+            duckdb.connect(
+                str(path or tools.datapath), read_only=True,
+                config={"memory_limit": memory_limit, "temp_directory": spill},
+            ) as conn:
+        reader = conn.execute(query, params).fetch_record_batch(batch_rows)
+        if output == "-":
+            return write_batches(reader, fmt, pa.PythonFile(sys.stdout.buffer, mode="w"))
+        tmp = f"{output}.{os.getpid()}.tmp"
+        try:
+            rows = write_batches(reader, fmt, tmp)
+            os.replace(tmp, output)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return rows
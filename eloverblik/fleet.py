@@ -0,0 +1,229 @@
+"""
+Fleet mode: one database holding the meters of many accounts, each with its
+own refresh token.
+
+Accounts are listed in a JSON file:
+
+    [
+        {"name": "household-1", "refresh_token": "eyJ..."},
+        {"name": "household-2", "token_file": "tokens/household-2.txt"}
+    ]
+
+where `token_file` is relative to the directory of the JSON file. Names are
+used as file names, so they cannot contain path separators.
+"""
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+import requests
+
+import eloverblik.tools as tools
+from eloverblik.eloverblik import DatabaseBuilder, Downloader
+from eloverblik.planner import is_oversized
+
+
+def check_account_name(name: str) -> str:
+    """
+    Return `name` if it can be used as an account name, which is a path
+    component of the token and response caches, or raise ValueError.
+    """
+    if name in ("", ".", "..") or any(c in name for c in ("/", "\\", "\0")):
+        raise ValueError(f"Invalid account name {name!r}: it is used as a file name")
+    return name
+
+
+def load_accounts(path: Path) -> list:
+    """
+    Read a list of accounts.
+
+    Returns:
+        A list of dictionaries with keys name and refresh_token.
+    """
+    path = Path(path)
+    with open(path) as f:
+        entries = json.load(f)
+    accounts = []
+    for entry in entries:
+        if "refresh_token" in entry:
+            token = entry["refresh_token"]
+        else:
+            with open(path.parent / entry["token_file"]) as f:
+                token = f.readline()
+        accounts.append(
+            {"name": check_account_name(str(entry["name"])), "refresh_token": token.strip()}
+        )
+    names = [a["name"] for a in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicated account names in {path}")
+    return accounts
+
+
+class FleetBuilder(DatabaseBuilder):
+    """
+    A DatabaseBuilder for the meters of several accounts.
+
+    Every account has its own Downloader, with its own data access token,
+    cached in `<data dir>/tokens/<name>.json`, while the session, rate
+    limiter, metrics and response cache are shared. Requests never mix the
+    meters of different accounts, and run concurrently on `workers` threads
+    across accounts. The "meterinfo" table has an `account` column.
+
+    When an account fails, e.g. because its refresh token expired, the error
+    is recorded in `failures` and the other accounts are processed as usual.
+    The meters of an account whose meter list could not be downloaded keep
+    their previous rows in "meterinfo"; ranges which could not be downloaded
+    are recorded in "failed_ranges", so the next update requests them again.
+
+    Attributes:
+        downloaders: The Downloader of each account, by name.
+        owner: The account of each meterid.
+        failures: The first error of each failed account, by name.
+    """
+
+    def __init__(self, accounts, workers=4, **kwargs) -> None:
+        """
+        Parameters:
+            accounts: A list of dictionaries with keys name and
+                refresh_token, see `load_accounts`.
+            workers: Number of requests run concurrently.
+            kwargs: Other arguments of DatabaseBuilder.
+        """
+        super().__init__(workers=workers, **kwargs)
+        self.downloaders = {}
+        for account in accounts:
+            check_account_name(account["name"])
+            downloader = Downloader(
+                batch_size=self.batch_size,
+                timeout=self.timeout,
+                token_cache=tools.datadir / "tokens" / f"{account['name']}.json",
+                cache_dir=self.cache.path if self.cache is not None else None,
+                offline=self.offline,
+                base_url=self.base_url,
+                refresh_token=account["refresh_token"],
+                account=account["name"],
+            )
+            downloader.session = self.session
+            downloader.rate_limiter = self.rate_limiter
+            downloader.metrics = self.metrics
+            self.downloaders[account["name"]] = downloader
+        self.owner = {}
+        self.failures = {}
+        self._meter_info = None
+        self._failures_lock = threading.Lock()
+
+    def reset(self) -> None:
+        """Forget the meters of every account and the failures of the last run."""
+        super().reset()
+        self.owner = {}
+        self.failures = {}
+        self._meter_info = None
+
+    def _fail(self, account, error) -> None:
+        with self._failures_lock:
+            self.failures.setdefault(account, error)
+
+    def _account_meter_info(self, name, refresh=False) -> pd.DataFrame:
+        try:
+            df = self.downloaders[name].get_meter_info(refresh=refresh)
+        except Exception as e:
+            self._fail(name, e)
+            return None
+        df["account"] = name
+        return df
+
+    def get_meter_info(self, refresh=False) -> pd.DataFrame:
+        """
+        Get information about the meters of every account, downloaded
+        concurrently, and return it as a single DataFrame with an `account`
+        column. The result is kept for the lifetime of the builder, or until
+        it is downloaded again with `refresh`, bypassing the response cache.
+        """
+        if self._meter_info is None or refresh:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                frames = list(executor.map(
+                    lambda name: self._account_meter_info(name, refresh), self.downloaders
+                ))
+            frames = [df for df in frames if df is not None]
+            if len(frames) == 0:
+                raise RuntimeError(f"No account could be downloaded: {self.failures}")
+            # A meter shared by several accounts is downloaded with the first
+            self._meter_info = pd.concat(frames, ignore_index=True).drop_duplicates(
+                "meteringPointId", ignore_index=True
+            )
+            self.owner = dict(zip(self._meter_info["meteringPointId"], self._meter_info["account"]))
+            self.meterids = list(self.owner)
+        return self._meter_info
+
+    def build_meterinfo_table(self, conn, refresh=False) -> None:
+        """
+        Replace the "meterinfo" table with the meters of every account,
+        keeping the previous rows of accounts which failed.
+        """
+        meter_info = self.get_meter_info(refresh=refresh)
+        failed = [name for name in self.downloaders if name in self.failures]
+        if len(failed) > 0 and "account" in self._meterinfo_columns(conn):
+            previous = conn.execute(
+                "select * from meterinfo where list_contains(?, account)", [failed]
+            ).df()
+            self._meter_info = pd.concat([meter_info, previous], ignore_index=True)
+        super().build_meterinfo_table(conn)
+
+    @staticmethod
+    def _meterinfo_columns(conn) -> list:
+        return [c[0] for c in conn.execute(
+            "select column_name from duckdb_columns() where table_name='meterinfo'"
+        ).fetchall()]
+
+    def check_data_access_token(self, margin=3600) -> None:
+        """Every account's Downloader checks its own token before requesting."""
+        return
+
+    def batches(self, meterids):
+        """
+        Split a list of meterids in lists of meters of the same account,
+        leaving out the meters of accounts whose meter list failed.
+        """
+        byaccount = {}
+        for meterid in meterids:
+            if meterid in self.owner:
+                byaccount.setdefault(self.owner[meterid], []).append(meterid)
+        return [
+            batch
+            for name in sorted(byaccount)
+            for batch in self.downloaders[name].batches(byaccount[name])
+        ]
+
+    def _route(self, method, meterids, *args, **kwargs):
+        """
+        Call a method of the Downloader of the meters, or return None if it
+        fails. Timeouts and responses rejecting a request as too large are
+        passed on, for the planner to split the request.
+        """
+        name = self.owner[meterids[0]]
+        if name in self.failures:
+            return None
+        try:
+            response = getattr(self.downloaders[name], method)(*args, **kwargs)
+        except requests.ReadTimeout:
+            raise
+        except Exception as e:
+            self._fail(name, e)
+            return None
+        if is_oversized(response):
+            return response
+        if response.status_code != 200:
+            self._fail(name, RuntimeError(f"{method} returned HTTP {response.status_code}"))
+            return None
+        return response
+
+    def get_charges_batch(self, meterids):
+        return self._route("get_charges_batch", meterids, meterids)
+
+    def get_consumption_batch(self, fromdate, todate, meterids, agg="Hour", refresh=False):
+        return self._route(
+            "get_consumption_batch", meterids, fromdate, todate, meterids, agg=agg,
+            refresh=refresh,
+        )
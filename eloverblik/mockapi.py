@@ -0,0 +1,337 @@
+"""
+A local stand-in for eloverblik's customer API, serving a synthetic fleet of
+meters. It implements the `token`, `meteringpoints`, `gettimeseries` and
+`getcharges` endpoints used by `eloverblik.eloverblik.Downloader`, and can
+inject latency, throttling (HTTP 429) and server errors (HTTP 500), so that
+the download pipeline can be tested and benchmarked offline. It also serves
+synthetic spot prices with the datasets of Energi Data Service used by
+`eloverblik.spotprices.EnergiDataServiceSource`.
+
+Point the package at it with the ELOVERBLIK_API_URL and ELOVERBLIK_SPOT_URL
+environment variables, or the `base_url` arguments of Downloader and
+EnergiDataServiceSource.
+"""
+import base64
+import json
+import random
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from eloverblik.spotprices import DATASETS
+
+# Number of points per day for each resolution served
+POINTS_PER_DAY = {"PT1H": 24, "PT15M": 96}
+
+
+class Fleet:
+    """
+    A synthetic fleet of meters with deterministic readings.
+
+    Attributes:
+        meterids: The IDs of the meters.
+        start: The first day with readings.
+        resolution: "PT1H" or "PT15M", the resolution of the readings served
+            unless hourly readings are requested.
+        failing: The IDs of the meters whose timeseries and charges are
+            answered with a failed result entry, like the API does for a
+            meter it has no data for.
+    """
+
+    def __init__(self, meters: int = 3, years: int = 2, resolution: str = "PT1H",
+                 end: date = None) -> None:
+        if resolution not in POINTS_PER_DAY:
+            raise ValueError(f"Unknown resolution: {resolution}")
+        end = end or date.today()
+        self.meterids = [f"5713131{m:011d}" for m in range(meters)]
+        self.start = date(end.year - years + 1, 1, 1)
+        self.resolution = resolution
+        self.failing = set()
+
+    @staticmethod
+    def failure(meterid: str, document: str) -> dict:
+        """A failed result entry, with a null `document`."""
+        return {
+            "success": False,
+            "errorCode": 20000,
+            "errorText": "WrongNumberOfArguments",
+            "id": meterid,
+            document: None,
+        }
+
+    def meteringpoints(self) -> list:
+        return [
+            {
+                "meteringPointId": meterid,
+                "typeOfMP": "E17",
+                "consumerStartDate": str(self.start),
+                "streetName": "Testvej",
+                "buildingNumber": str(i + 1),
+                "floorId": "1",
+                "roomId": "tv",
+                "postcode": "2100",
+                "cityName": "København Ø",
+            }
+            for i, meterid in enumerate(self.meterids)
+        ]
+
+    def quantity(self, m: int, day: date, position: int, resolution: str = None) -> str:
+        """A plausible reading: base load, evening peak and a seasonal swing."""
+        resolution = resolution or self.resolution
+        hour = (position - 1) * 24 // POINTS_PER_DAY[resolution]
+        scale = 24 / POINTS_PER_DAY[resolution]
+        season = 1.5 if day.month in (1, 2, 3, 10, 11, 12) else 1.0
+        value = (0.2 + 0.6 * (17 <= hour <= 20) + 0.05 * ((m * 7 + day.toordinal() + hour) % 5))
+        return f"{value * season * scale:.3f}"
+
+    def timeseries(self, meterid: str, fromdate: date, todate: date, agg: str = "Actual") -> dict:
+        """
+        The readings of a meter, at the resolution of the fleet if `agg` is
+        "Actual" or "Quarter", or hourly if it is "Hour".
+        """
+        if meterid in self.failing:
+            return self.failure(meterid, "MyEnergyData_MarketDocument")
+        resolution = "PT1H" if agg == "Hour" else self.resolution
+        m = self.meterids.index(meterid)
+        periods = []
+        day = max(fromdate, self.start)
+        while day < todate:
+            # Days start at midnight Danish time, 23:00 UTC the day before
+            begin = datetime(day.year, day.month, day.day, tzinfo=timezone.utc) - timedelta(hours=1)
+            periods.append(
+                {
+                    "resolution": resolution,
+                    "timeInterval": {
+                        "start": begin.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                        "end": (begin + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    },
+                    "Point": [
+                        {
+                            "position": str(p),
+                            "out_Quantity.quantity": self.quantity(m, day, p, resolution),
+                            "out_Quantity.quality": "A04",
+                        }
+                        for p in range(1, POINTS_PER_DAY[resolution] + 1)
+                    ],
+                }
+            )
+            day += timedelta(days=1)
+        return {
+            "success": True,
+            "errorCode": 10000,
+            "errorText": "No error",
+            "id": meterid,
+            "MyEnergyData_MarketDocument": {
+                "TimeSeries": [{"mRID": meterid, "businessType": "A04", "Period": periods}]
+            },
+        }
+
+    def charges(self, meterid: str) -> dict:
+        if meterid in self.failing:
+            return self.failure(meterid, "result")
+        # Charges start at midnight Danish time, given in UTC
+        validfrom = f"{self.start - timedelta(days=1)}T23:00:00.000Z"
+        return {
+            "success": True,
+            "errorCode": 10000,
+            "id": meterid,
+            "result": {
+                "meteringPointId": meterid,
+                "fees": [],
+                "subscriptions": [],
+                "tariffs": [
+                    {
+                        "name": "Nettarif C time",
+                        "validFromDate": validfrom,
+                        "validToDate": None,
+                        "prices": [
+                            {"position": str(h), "price": 0.15 + 0.45 * (17 <= h - 1 <= 20)}
+                            for h in range(1, 25)
+                        ],
+                    },
+                    {
+                        "name": "Systemtarif",
+                        "validFromDate": validfrom,
+                        "validToDate": None,
+                        "prices": [{"position": "1", "price": 0.054}],
+                    },
+                ],
+            },
+        }
+
+
+def spot_records(dataset: str, area: str, fromdate: date, todate: date) -> list:
+    """
+    Return records of an Energi Data Service dataset of day-ahead prices in
+    DKK/MWh: hourly for Elspotprices, quarter-hourly for DayAheadPrices.
+    """
+    _, timecol, pricecol, _ = next(d for d in DATASETS if d[0] == dataset)
+    step = 60 if dataset == "Elspotprices" else 15
+    offset = 0 if area == "DK1" else 50
+    records = []
+    t = datetime(fromdate.year, fromdate.month, fromdate.day)
+    while t.date() < todate:
+        peak = 17 <= t.hour <= 20
+        price = 400 + offset + 600 * peak + 100 * (t.month in (1, 2, 12)) + t.minute
+        records.append(
+            {timecol: t.strftime("%Y-%m-%dT%H:%M:%S"), pricecol: round(price, 2)}
+        )
+        t += timedelta(minutes=step)
+    return records
+
+
+def mock_token(lifetime: int = 24 * 3600) -> str:
+    """Return a JWT-shaped token expiring in `lifetime` seconds."""
+
+    def encode(d):
+        return base64.urlsafe_b64encode(json.dumps(d).encode()).decode().rstrip("=")
+
+    return ".".join(
+        [encode({"alg": "none"}), encode({"exp": int(time.time()) + lifetime}), "mock"]
+    )
+
+
+class MockAPIServer(ThreadingHTTPServer):
+    """
+    An HTTP server serving a Fleet with the API's URL layout.
+
+    Attributes:
+        fleet: The Fleet served.
+        latency: Seconds waited before answering each request.
+        throttle_rate: Fraction of requests answered with HTTP 429.
+        error_rate: Fraction of requests answered with HTTP 500.
+        max_days: The longest timeseries range served, or None. Longer
+            ranges are answered with HTTP 413.
+        requests: Number of requests received.
+        bytes: Number of bytes sent in response bodies.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), fleet: Fleet = None, latency: float = 0.0,
+                 throttle_rate: float = 0.0, error_rate: float = 0.0, seed: int = 0,
+                 max_days: int = None) -> None:
+        super().__init__(address, MockAPIHandler)
+        self.fleet = fleet or Fleet()
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.max_days = max_days
+        self.requests = 0
+        self.bytes = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        """The base URL to give to Downloader."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/CustomerApi/api"
+
+    @property
+    def spot_url(self) -> str:
+        """The base URL to give to EnergiDataServiceSource."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> threading.Thread:
+        """Serve in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, name="mockapi", daemon=True)
+        thread.start()
+        return thread
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    server: MockAPIServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: dict = None, headers: dict = None) -> None:
+        content = json.dumps(body if body is not None else {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+        with self.server._lock:
+            self.server.bytes += len(content)
+
+    def _fault(self, auth: bool = True) -> bool:
+        """Apply latency and injected failures. Returns True if a failure was sent."""
+        server = self.server
+        with server._lock:
+            server.requests += 1
+            draw = server._random.random()
+        if server.latency:
+            time.sleep(server.latency)
+        if draw < server.throttle_rate:
+            self._send(429, {"error": "Too many requests"}, {"Retry-After": "1"})
+            return True
+        if draw < server.throttle_rate + server.error_rate:
+            self._send(500, {"error": "Internal server error"})
+            return True
+        if auth and not self.headers.get("Authorization", "").startswith("Bearer "):
+            self._send(401, {"error": "Unauthorized"})
+            return True
+        return False
+
+    def _meterids(self) -> list:
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        return body.get("meteringPoints", {}).get("meteringPoint", [])
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = re.fullmatch(r"/dataset/(\w+)", url.path)
+        if self._fault(auth=match is None):
+            return
+        if match:
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if match.group(1) not in [d[0] for d in DATASETS]:
+                self._send(404, {"error": "Unknown dataset"})
+                return
+            area = json.loads(query.get("filter", "{}")).get("PriceArea", ["DK1"])[0]
+            records = spot_records(
+                match.group(1), area,
+                date.fromisoformat(query["start"][:10]), date.fromisoformat(query["end"][:10]),
+            )
+            self._send(200, {"total": len(records), "records": records})
+            return
+        path = url.path
+        if path.endswith("/token"):
+            self._send(200, {"result": mock_token()})
+        elif path.endswith("/meteringpoints/meteringpoints"):
+            self._send(200, {"result": self.server.fleet.meteringpoints()})
+        else:
+            self._send(404, {"error": "Not found"})
+
+    def do_POST(self):
+        meterids = self._meterids()
+        if self._fault():
+            return
+        fleet = self.server.fleet
+        unknown = [m for m in meterids if m not in fleet.meterids]
+        if unknown:
+            self._send(400, {"error": f"Unknown metering points: {unknown}"})
+            return
+        match = re.search(r"/meterdata/gettimeseries/([^/]+)/([^/]+)/([^/]+)", self.path)
+        if match:
+            fromdate = date.fromisoformat(match.group(1)[:10])
+            todate = date.fromisoformat(match.group(2)[:10])
+            if self.server.max_days is not None and (todate - fromdate).days > self.server.max_days:
+                self._send(413, {"error": f"Period exceeds {self.server.max_days} days"})
+                return
+            self._send(
+                200,
+                {"result": [fleet.timeseries(m, fromdate, todate, match.group(3)) for m in meterids]},
+            )
+        elif self.path.endswith("/meteringpoints/meteringpoint/getcharges"):
+            self._send(200, {"result": [fleet.charges(m) for m in meterids]})
+        else:
+            self._send(404, {"error": "Not found"})
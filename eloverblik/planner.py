@@ -0,0 +1,178 @@
+"""
+Planning of the timeseries requests sent to the API.
+"""
+import json
+import os
+import threading
+from datetime import date, timedelta
+from pathlib import Path
+
+import requests
+
+# HTTP status codes suggesting that a request asked for too much data: the
+# request is split in two instead of being given up. Other errors, e.g. a 400
+# rejecting the request itself, fail the same way for any part of it.
+BISECT_STATUS = (413, 414, 504)
+
+# Calendar units ranges are cut at, as (longest unit in days, months), from
+# the longest: years, half years, quarters and months
+UNITS = [(366, 12), (184, 6), (92, 3), (31, 1)]
+
+
+def split_range(fromdate: date, todate: date, days: int) -> list:
+    """
+    Split the range from `fromdate` up to `todate` (excluded) in ranges of at
+    most `days` days, cut at the start of the longest calendar unit fitting in
+    `days`, e.g. calendar years, or at multiples of `days` days for less than
+    a month. Ranges of different meters are cut at the same dates, so they can
+    be requested together.
+
+    Returns:
+        A list of (fromdate, todate) tuples of dates.
+    """
+    months = next((m for length, m in UNITS if days >= length), None)
+    ranges = []
+    start = fromdate
+    while start < todate:
+        if months is not None:
+            index = (start.year * 12 + start.month - 1) // months * months + months
+            end = date(index // 12, index % 12 + 1, 1)
+        else:
+            end = date.fromordinal((start.toordinal() // days + 1) * days)
+        end = min(end, todate)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def is_oversized(response=None, error=None) -> bool:
+    """
+    Return True if a request failed in a way suggesting it asked for too much
+    data: it timed out, or was rejected with a status in BISECT_STATUS.
+    """
+    if error is not None:
+        return isinstance(error, requests.ReadTimeout)
+    return response is not None and response.status_code in BISECT_STATUS
+
+
+class RequestPlanner:
+    """
+    Turns the date ranges needed for each meter into requests, and learns the
+    longest range the API serves for each endpoint.
+
+    Ranges of a meter at most `merge_days` apart are merged, since a request
+    costs more than the days it downloads twice. Ranges longer than the limit
+    of the endpoint are split with `split_range`. A request which is rejected
+    or times out is bisected by dates, then by meters, see `bisect`; when one
+    of its halves succeeds, the length of the failed request is recorded and
+    later ranges are split below it. A request is bisected at most
+    `max_splits` times, and the caller gives it up when its first half fails
+    too, so an error which is not caused by its size, e.g. a gateway timeout
+    while the API is down, costs a few requests. The limits are stored in
+    `path` as JSON, so that later runs start from them.
+
+    Attributes:
+        path: The JSON file storing the limits, or None.
+        max_days: The longest range requested.
+        merge_days: Ranges of a meter at most this many days apart are merged.
+        max_splits: How many times a failed request is bisected at most.
+        limits: For each endpoint, the longest range that worked ("ok") and
+            the shortest range that failed ("failed"), in days.
+    """
+
+    def __init__(self, path: Path = None, max_days=366, merge_days=7, max_splits=6) -> None:
+        self.path = Path(path) if path is not None else None
+        self.max_days = max_days
+        self.merge_days = merge_days
+        self.max_splits = max_splits
+        self.limits = {}
+        self._lock = threading.Lock()
+        if self.path is not None and self.path.exists():
+            with open(self.path) as f:
+                self.limits = json.load(f)
+
+    def limit(self, endpoint: str) -> int:
+        """Return the longest range in days to request from `endpoint`."""
+        with self._lock:
+            known = self.limits.get(endpoint)
+            if known is None or known["failed"] is None:
+                return self.max_days
+            if known["ok"] > 0:
+                return min(self.max_days, known["ok"])
+            return max(1, min(self.max_days, known["failed"] // 2))
+
+    def record(self, endpoint: str, days: int, ok: bool) -> None:
+        """Record that a request of `days` days to `endpoint` worked, or was too long."""
+        with self._lock:
+            known = self.limits.setdefault(endpoint, {"ok": 0, "failed": None})
+            if ok:
+                if known["failed"] is None or days < known["failed"]:
+                    known["ok"] = max(known["ok"], days)
+            else:
+                known["failed"] = days if known["failed"] is None else min(known["failed"], days)
+                if known["ok"] >= known["failed"]:
+                    known["ok"] = 0
+
+    def save(self) -> None:
+        """Write the limits to `path`, replacing the file atomically."""
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with self._lock, open(tmp, "w") as f:
+            json.dump(self.limits, f)
+        os.replace(tmp, self.path)
+
+    def plan(self, periods: dict, endpoint: str) -> dict:
+        """
+        Plan the requests downloading `periods`.
+
+        Parameters:
+            periods: A dictionary mapping (fromdate, todate) to the list of
+                meterids needing that range, with dates as "YYYY-MM-DD".
+            endpoint: The endpoint the ranges are requested from.
+
+        Returns:
+            A dictionary in the same format, with merged and split ranges.
+            The meters of each range are in the order they were first given.
+        """
+        ranges = {}
+        for (fromdate, todate), meterids in periods.items():
+            for meterid in meterids:
+                ranges.setdefault(meterid, []).append(
+                    (date.fromisoformat(str(fromdate)), date.fromisoformat(str(todate)))
+                )
+
+        limit = self.limit(endpoint)
+        planned = {}
+        for meterid, meter_ranges in ranges.items():
+            merged = []
+            for fromdate, todate in sorted(meter_ranges):
+                if merged and fromdate <= merged[-1][1] + timedelta(days=self.merge_days):
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], todate))
+                else:
+                    merged.append((fromdate, todate))
+            for fromdate, todate in merged:
+                for start, end in split_range(fromdate, todate, limit):
+                    planned.setdefault((str(start), str(end)), []).append(meterid)
+        return dict(sorted(planned.items()))
+
+    @staticmethod
+    def bisect(fromdate: str, todate: str, meterids: list) -> list:
+        """
+        Split a request in two: its date range in halves if it is longer
+        than a day, otherwise its meters.
+
+        Returns:
+            A list of two (fromdate, todate, meterids) tuples, or an empty
+            list if the request cannot be split.
+        """
+        start, end = date.fromisoformat(fromdate), date.fromisoformat(todate)
+        days = (end - start).days
+        if days > 1:
+            middle = str(start + timedelta(days=days // 2))
+            return [(fromdate, middle, meterids), (middle, todate, meterids)]
+        if len(meterids) > 1:
+            half = len(meterids) // 2
+            return [(fromdate, todate, meterids[:half]), (fromdate, todate, meterids[half:])]
+        return []
@@ -0,0 +1,190 @@
+import json
+import math
+import os
+import threading
+import time
+from pathlib import Path
+
+
+class Span:
+    """
+    A timed stage of the pipeline, used as a context manager. Arguments, such
+    as the number of bytes or rows processed, can be added while it runs.
+    """
+
+    __slots__ = ("name", "args", "start", "duration", "tid", "_profiler")
+
+    def __init__(self, profiler, name: str, args: dict) -> None:
+        self._profiler = profiler
+        self.name = name
+        self.args = args
+        self.tid = threading.get_ident()
+
+    def set(self, **args) -> None:
+        """Add arguments to the span."""
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self._profiler._record(self)
+        return False
+
+
+class _NullSpan:
+    """The span returned while profiling is disabled, doing nothing."""
+
+    def set(self, **args) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Profiler:
+    """
+    Collects spans from all threads. While disabled, `span` returns a shared
+    no-op context manager, so instrumentation costs almost nothing.
+
+    Attributes:
+        enabled: If False, spans are not recorded.
+        spans: The recorded spans, in the order they ended.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.spans = []
+        self._threads = {}
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def enable(self) -> None:
+        """Start recording spans, discarding the ones recorded before."""
+        with self._lock:
+            self.spans = []
+            self._threads = {}
+            self._origin = time.perf_counter()
+            self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def span(self, name: str, **args):
+        """
+        Return a context manager timing a stage.
+
+        Parameters:
+            name: The stage, e.g. "http" or "parse". Spans are aggregated by
+                name in `summary`.
+            args: Details recorded with the span. The "bytes" and "rows"
+                arguments are summed in `summary`.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, args)
+
+    def _record(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+            if span.tid not in self._threads:
+                self._threads[span.tid] = threading.current_thread().name
+
+    def trace(self) -> dict:
+        """Return the spans in the Chrome trace event format."""
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+            threads = dict(self._threads)
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in threads.items()
+        ]
+        events += [
+            {
+                "name": s.name,
+                "cat": "eloverblik",
+                "ph": "X",
+                "ts": round((s.start - self._origin) * 1e6, 1),
+                "dur": round(s.duration * 1e6, 1),
+                "pid": pid,
+                "tid": s.tid,
+                "args": {k: v if isinstance(v, (int, float, bool)) else str(v)
+                         for k, v in s.args.items()},
+            }
+            for s in spans
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_trace(self, path: Path) -> None:
+        """
+        Write the spans to a JSON file which can be opened with
+        chrome://tracing or https://ui.perfetto.dev.
+        """
+        with open(path, "w") as f:
+            json.dump(self.trace(), f)
+
+    def summary(self) -> list:
+        """
+        Aggregate the spans by name.
+
+        Returns:
+            A list of dictionaries with keys name, count, total_s, p50_ms,
+            p95_ms, bytes, rows and rows_per_s, by decreasing total time.
+        """
+        byname = {}
+        with self._lock:
+            for s in self.spans:
+                byname.setdefault(s.name, []).append(s)
+        rows = []
+        for name, spans in byname.items():
+            durations = sorted(s.duration for s in spans)
+            total = sum(durations)
+            nrows = sum(s.args.get("rows", 0) for s in spans)
+            rows.append(
+                {
+                    "name": name,
+                    "count": len(spans),
+                    "total_s": round(total, 3),
+                    "p50_ms": round(percentile(durations, 50) * 1000, 2),
+                    "p95_ms": round(percentile(durations, 95) * 1000, 2),
+                    "bytes": sum(s.args.get("bytes", 0) for s in spans),
+                    "rows": nrows,
+                    "rows_per_s": round(nrows / total) if total > 0 else 0,
+                }
+            )
+        return sorted(rows, key=lambda r: r["total_s"], reverse=True)
+
+    def format_summary(self) -> str:
+        """Return `summary` as a plain text table."""
+        header = f"{'stage':<12}{'count':>8}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}{'MB':>9}{'rows':>11}{'rows/s':>11}"
+        lines = [header, "-" * len(header)]
+        for r in self.summary():
+            lines.append(
+                f"{r['name']:<12}{r['count']:>8}{r['total_s']:>10.3f}{r['p50_ms']:>10.2f}"
+                f"{r['p95_ms']:>10.2f}{r['bytes'] / 1e6:>9.1f}{r['rows']:>11}{r['rows_per_s']:>11}"
+            )
+        return "\n".join(lines)
+
+
+def percentile(values: list, q: float) -> float:
+    """Return the q-th percentile of sorted `values`, by nearest rank."""
+    if len(values) == 0:
+        return 0.0
+    rank = max(0, math.ceil(q / 100 * len(values)) - 1)
+    return values[rank]
+
+
+# The profiler used by the pipeline, enabled by the --profile option of eldata
+profiler = Profiler()
+span = profiler.span
@@ -0,0 +1,64 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket used to throttle calls to eloverblik's API.
+
+    Tokens are added at `rate` per second up to `capacity`. Every call to
+    `acquire` consumes one token, sleeping until one is available. When the
+    API signals throttling (HTTP 429/503), `penalize` pauses every caller
+    sharing the bucket, not only the thread that got the error.
+
+    Attributes:
+        rate: Number of tokens added per second.
+        capacity: Maximum number of tokens the bucket can hold (burst size).
+    """
+
+    def __init__(self, rate: float, capacity: int = None) -> None:
+        """
+        Initialize the bucket full.
+
+        Parameters:
+            rate: Number of requests per second allowed on average.
+            capacity: Burst size. Defaults to `max(1, int(rate))`.
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = capacity if capacity is not None else max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self) -> None:
+        """Block until a token is available, then consume it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self, seconds: float) -> None:
+        """
+        Stop handing out tokens for `seconds` and empty the bucket, so that
+        all threads back off together after the API throttled a request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            self._tokens = 0.0
+            self._last = now
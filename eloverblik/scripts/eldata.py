@@ -1,8 +1,11 @@
 import click
+from contextlib import contextmanager
 from datetime import datetime
-from streamlit.web.cli import _main_run
-from eloverblik.eloverblik import DatabaseBuilder
-from eloverblik.tools import basepath, datapath
+from eloverblik.profiling import profiler
+
+# Commands import the modules they need, pulling in pandas, duckdb, requests
+# or streamlit, when they run, so that the CLI and --help start quickly.
+# benchmarks/bench_import.py checks the import time of every command.
 
 
 @click.group()
@@ -10,26 +13,223 @@ def eloverblik():
     pass
 
 
+profile_option = click.option(
+    '--profile', type=click.Path(dir_okay=False), default=None, metavar='TRACE',
+    help='Write a Chrome trace of the run to TRACE and print a summary of its stages',
+)
+
+
+accounts_option = click.option(
+    '--accounts', type=click.Path(exists=True, dir_okay=False), default=None,
+    help='JSON file listing the accounts of a fleet, instead of token.txt',
+)
+
+
+def make_builder(accounts, **kwargs):
+    """
+    Return a DatabaseBuilder, or a FleetBuilder if an accounts file is given.
+    Options left to None, like `--workers`, keep the builder's default.
+    """
+    kwargs = {key: value for key, value in kwargs.items() if value is not None}
+    if accounts is None:
+        from eloverblik.eloverblik import DatabaseBuilder
+        return DatabaseBuilder(**kwargs)
+    from eloverblik.fleet import FleetBuilder, load_accounts
+    return FleetBuilder(load_accounts(accounts), **kwargs)
+
+
+def report_failures(db):
+    """
+    Print the accounts which failed and the number of ranges which could not
+    be downloaded, exiting with status 1 if there are any.
+    """
+    failures = getattr(db, 'failures', {})
+    for account, error in failures.items():
+        click.echo(f"Account {account} failed: {error!r}", err=True)
+    if db.failed_ranges:
+        click.echo(f"{len(db.failed_ranges)} requests failed, the next update retries them",
+                   err=True)
+    if failures or db.failed_ranges:
+        raise SystemExit(1)
+
+
+@contextmanager
+def profiled(path):
+    """Record spans while running the block if `path` is set, then report them."""
+    if path is None:
+        yield
+        return
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.write_trace(path)
+        click.echo(profiler.format_summary())
+        click.echo(f"Trace written to {path}, open it with https://ui.perfetto.dev")
+
+
 @click.command(help='First time setup: Constructs database')
-def initdb():
+@click.option('--workers', type=int, default=None,
+              help='Number of concurrent API requests  [default: 1, or 4 with --accounts]')
+@click.option('--rate', type=float, default=None,
+              help='Maximum number of API requests per second')
+@click.option('--batch-size', default=10, show_default=True,
+              help='Maximum number of meters per API request')
+@click.option('--offline', is_flag=True,
+              help='Rebuild the database from cached API responses only')
+@click.option('--storage', type=click.Choice(['duckdb', 'parquet']), default='duckdb',
+              show_default=True,
+              help='Store consumption in the database or as partitioned Parquet')
+@accounts_option
+@profile_option
+def initdb(workers, rate, batch_size, offline, storage, accounts, profile):
     click.echo('Initializing the database...')
     start = datetime.now()
-    db = DatabaseBuilder()
-    db.build_dataset()
+    db = make_builder(
+        accounts, workers=workers, rate=rate, batch_size=batch_size, offline=offline,
+        storage=storage,
+    )
+    with profiled(profile):
+        db.build_dataset()
     click.echo(f"DB initialized in {str(datetime.now() - start)}")
+    click.echo(f"API: {db.metrics}")
+    report_failures(db)
 
 
 @click.command(help='Updates the database with recent data')
-def update():
+@click.option('--workers', type=int, default=None,
+              help='Number of concurrent API requests  [default: 1, or 4 with --accounts]')
+@click.option('--rate', type=float, default=None,
+              help='Maximum number of API requests per second')
+@click.option('--batch-size', default=10, show_default=True,
+              help='Maximum number of meters per API request')
+@accounts_option
+@profile_option
+def update(workers, rate, batch_size, accounts, profile):
     click.echo('Updating the database...')
     start = datetime.now()
-    db = DatabaseBuilder()
-    db.update_dataset()
+    db = make_builder(accounts, workers=workers, rate=rate, batch_size=batch_size)
+    with profiled(profile):
+        db.update_dataset()
     click.echo(f"DB updated in {str(datetime.now() - start)}")
+    click.echo(f"API: {db.metrics}")
+    report_failures(db)
+
+
+@click.command(help='Downloads again missing or estimated readings')
+@click.option('--workers', type=int, default=None,
+              help='Number of concurrent API requests  [default: 1, or 4 with --accounts]')
+@click.option('--settle-days', default=7, show_default=True,
+              help='Days after which downloaded readings are considered final')
+@click.option('--max-attempts', default=3, show_default=True,
+              help='Number of final downloads after which a gap is left as it is')
+@accounts_option
+@profile_option
+def backfill(workers, settle_days, max_attempts, accounts, profile):
+    click.echo('Looking for gaps in the database...')
+    start = datetime.now()
+    db = make_builder(accounts, workers=workers)
+    with profiled(profile):
+        gaps = db.backfill_dataset(settle_days=settle_days, max_attempts=max_attempts)
+    click.echo(f"{len(gaps)} gaps backfilled in {str(datetime.now() - start)}")
+    click.echo(f"API: {db.metrics}")
+    report_failures(db)
+
+
+@click.command(help='Keeps the database updated, polling the API when new data is published')
+@click.option('--workers', type=int, default=None,
+              help='Number of concurrent API requests  [default: 1, or 4 with --accounts]')
+@click.option('--rate', type=float, default=None,
+              help='Maximum number of API requests per second')
+@click.option('--batch-size', default=10, show_default=True,
+              help='Maximum number of meters per API request')
+@click.option('--publish-time', default='06:00', show_default=True,
+              help='Local time after which the readings of yesterday are usually published')
+@click.option('--jitter', default=60, show_default=True,
+              help='Maximum random delay in minutes added to the publish time')
+@click.option('--retry-interval', default=60, show_default=True,
+              help='Minutes between polls while readings are not published')
+@click.option('--host', default='127.0.0.1', show_default=True,
+              help='Address of the /health and /metrics endpoints')
+@click.option('--port', default=8089, show_default=True,
+              help='Port of the /health and /metrics endpoints, 0 to disable them')
+@accounts_option
+def serve(workers, rate, batch_size, publish_time, jitter, retry_interval, host, port,
+          accounts):
+    import signal
+    import threading
+    from eloverblik.daemon import StatusServer, Updater
+    from eloverblik.tools import datapath
+    hour, minute = (int(v) for v in publish_time.split(':'))
+    db = make_builder(accounts, workers=workers, rate=rate, batch_size=batch_size)
+    if datapath.exists() is False:
+        click.echo('Initializing the database...')
+        db.build_dataset()
+    updater = Updater(
+        db, publish_time=(hour, minute), jitter=jitter * 60,
+        retry_interval=retry_interval * 60,
+    )
+    if port != 0:
+        server = StatusServer(updater, (host, port))
+        server.start()
+        click.echo(f"Health on http://{host}:{server.server_port}/health,"
+                   f" metrics on http://{host}:{server.server_port}/metrics")
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    click.echo('Updating the database, press Ctrl+C to stop')
+    try:
+        updater.run(stop)
+    except KeyboardInterrupt:
+        pass
+    click.echo(f"Stopped after {updater.cycles} updates. API: {db.metrics}")
+
+
+@click.command(help='Exports consumption data to Parquet, CSV or Arrow IPC')
+@click.argument('output', type=click.Path(dir_okay=False, allow_dash=True), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['parquet', 'csv', 'arrow', 'arrows']),
+              default=None,
+              help='Output format, by default the extension of OUTPUT, or csv on stdout')
+@click.option('--meter', 'meterids', multiple=True,
+              help='Export only this meter, can be repeated')
+@click.option('--from', 'fromdate', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='First date to export')
+@click.option('--to', 'todate', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='Date after the last one to export')
+@click.option('--resolution',
+              type=click.Choice(['hour', 'day', 'month', 'year', 'hour-of-day']),
+              default='hour', show_default=True,
+              help='Readings at the resolution of each meter, hourly or 15 minutes, or a rollup '
+                   'by day, month, year, or hour of day of each month')
+@click.option('--cost', is_flag=True,
+              help='Add the tariff and spot price of each reading and their cost')
+@click.option('--unsorted', is_flag=True,
+              help='Write rows in storage order instead of by meter and date, which is faster')
+@click.option('--memory-limit', default='256MB', show_default=True,
+              help='Memory used to sort rows, beyond which they are sorted on disk')
+def export(output, fmt, meterids, fromdate, todate, resolution, cost, unsorted,
+           memory_limit):
+    from eloverblik.export import export as export_data
+    if output != '-' and fmt is None:
+        from eloverblik.export import format_of
+        if format_of(output) is None:
+            raise click.BadParameter('Unknown extension, set --format', param_hint='OUTPUT')
+    start = datetime.now()
+    rows = export_data(
+        output, fmt=fmt, resolution=resolution, meterids=meterids or None,
+        fromdate=fromdate.date() if fromdate else None,
+        todate=todate.date() if todate else None, cost=cost, sort=not unsorted,
+        memory_limit=memory_limit,
+    )
+    if output != '-':
+        click.echo(f"{rows} rows exported to {output} in {str(datetime.now() - start)}")
 
 
 @click.command(help='Starts the dashboard, eventually constructing the database')
 def dashboard():
+    from streamlit.web.cli import _main_run
+    from eloverblik.eloverblik import DatabaseBuilder
+    from eloverblik.tools import basepath, datapath
     if datapath.exists() is False:
         click.echo('Initializing the database...')
         start = datetime.now()
@@ -40,6 +240,39 @@ def dashboard():
     _main_run((basepath / 'streamlit_app.py').as_posix() , args)
 
 
+@click.command(help='Serves a synthetic fleet of meters with the API\'s endpoints')
+@click.option('--port', default=8080, show_default=True)
+@click.option('--meters', default=3, show_default=True, help='Number of meters')
+@click.option('--years', default=2, show_default=True, help='Years of history')
+@click.option('--resolution', type=click.Choice(['PT1H', 'PT15M']), default='PT1H',
+              show_default=True)
+@click.option('--latency', default=0.0, show_default=True,
+              help='Seconds waited before each response')
+@click.option('--throttle-rate', default=0.0, show_default=True,
+              help='Fraction of requests answered with HTTP 429')
+@click.option('--error-rate', default=0.0, show_default=True,
+              help='Fraction of requests answered with HTTP 500')
+@click.option('--max-days', type=int, default=None,
+              help='Longest timeseries range served, longer ones are answered with HTTP 413')
+def mockapi(port, meters, years, resolution, latency, throttle_rate, error_rate, max_days):
+    from eloverblik.mockapi import Fleet, MockAPIServer
+    server = MockAPIServer(
+        ("127.0.0.1", port), Fleet(meters, years, resolution), latency=latency,
+        throttle_rate=throttle_rate, error_rate=error_rate, max_days=max_days,
+    )
+    click.echo(f"Serving {meters} meters, use ELOVERBLIK_API_URL={server.url}"
+               f" ELOVERBLIK_SPOT_URL={server.spot_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    click.echo(f"{server.requests} requests, {server.bytes / 1e6:.1f} MB sent")
+
+
 eloverblik.add_command(initdb)
 eloverblik.add_command(update)
+eloverblik.add_command(backfill)
+eloverblik.add_command(serve)
+eloverblik.add_command(export)
 eloverblik.add_command(dashboard)
+eloverblik.add_command(mockapi)
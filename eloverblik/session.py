@@ -0,0 +1,130 @@
+import bisect
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+import eloverblik.tools as tools
+from eloverblik.profiling import span
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """
+    Create a requests Session that keeps connections to the API alive.
+
+    Parameters:
+        pool_size: Maximum number of connections kept open per host. It should
+            be at least the number of threads sharing the session.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def send_with_retries(send, max_retries: int, wait=None, retry=None) -> requests.Response:
+    """
+    Send a request, backing off and sending it again when it is throttled,
+    fails with a transient server error, see tools.THROTTLE_STATUS and
+    tools.RETRY_STATUS, or the connection fails. Throttled requests wait as
+    long as the `Retry-After` header asks. The response of the last attempt
+    is returned whatever its status.
+
+    Parameters:
+        send: A function sending the request, called with the attempt number
+            starting at 0, and returning the response.
+        max_retries: How many times the request is sent again at most.
+        wait: A function called with the number of seconds to wait before
+            retrying a throttled request, e.g. to pause a rate limiter.
+            Defaults to sleeping.
+        retry: A function called with any other response, returning True if
+            the request should be sent again, e.g. after refreshing a token.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            response = send(attempt)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # A request which timed out twice while reading the response
+            # likely asks for too much data, so it is not sent again
+            if attempt == max_retries or (
+                isinstance(e, requests.ReadTimeout) and attempt >= 1
+            ):
+                raise
+            with span("backoff"):
+                time.sleep(tools.backoff(attempt))
+            continue
+        if attempt == max_retries:
+            return response
+        if response.status_code in tools.THROTTLE_STATUS:
+            seconds = tools.retry_after(response, attempt)
+            if wait is not None:
+                wait(seconds)
+            else:
+                with span("backoff"):
+                    time.sleep(seconds)
+        elif response.status_code in tools.RETRY_STATUS:
+            with span("backoff"):
+                time.sleep(tools.backoff(attempt))
+        elif retry is None or not retry(response):
+            return response
+
+
+class RequestMetrics:
+    """
+    Thread-safe counters about the requests sent to the API.
+
+    Attributes:
+        requests: Number of requests sent, including retries.
+        retries: Number of requests that were retries of a failed request.
+        errors: Number of requests that failed with a connection error.
+        bytes: Total size of the response bodies.
+        latency: Number of requests per latency bucket, see LATENCY_BUCKETS.
+        total_latency: Total time spent waiting for responses, in seconds.
+    """
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = [0] * len(LATENCY_BUCKETS)
+        self.total_latency = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed: float, nbytes: int = 0, retry: bool = False,
+               error: bool = False) -> None:
+        """Record a request which took `elapsed` seconds."""
+        with self._lock:
+            self.requests += 1
+            self.retries += int(retry)
+            self.errors += int(error)
+            self.bytes += nbytes
+            self.latency[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            self.total_latency += elapsed
+
+    def summary(self) -> dict:
+        """Return the counters as a dictionary."""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "errors": self.errors,
+                "bytes": self.bytes,
+                "total_latency": round(self.total_latency, 3),
+                "latency": {
+                    f"<={b}s": n for b, n in zip(LATENCY_BUCKETS, self.latency)
+                },
+            }
+
+    def __str__(self) -> str:
+        s = self.summary()
+        histogram = ", ".join(f"{k}: {v}" for k, v in s["latency"].items() if v)
+        return (
+            f"{s['requests']} requests ({s['retries']} retries, {s['errors']} errors), "
+            f"{s['bytes'] / 1e6:.1f} MB, {s['total_latency']}s waiting"
+            f" [{histogram}]"
+        )
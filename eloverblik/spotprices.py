@@ -0,0 +1,132 @@
+"""
+Sources of hourly spot prices of electricity by price area, in DKK/kWh.
+
+A source has a `fetch(area, fromdate, todate)` method returning a DataFrame
+with columns area, hour and price, where hour is the start of the hour in
+Danish local time, like the dates of consumption readings. DatabaseBuilder
+loads them into the "spot_prices" table.
+"""
+import json
+from datetime import date
+from pathlib import Path
+
+import pandas as pd
+import requests
+
+import eloverblik.tools as tools
+from eloverblik.profiling import span
+from eloverblik.session import send_with_retries
+
+# Energi Data Service datasets with the day-ahead prices, as (dataset, time
+# column, price column in DKK/MWh, first day). Elspotprices was replaced by
+# the quarter-hourly DayAheadPrices when the day-ahead market moved to 15
+# minute products.
+DATASETS = [
+    ("Elspotprices", "HourDK", "SpotPriceDKK", date(2019, 1, 1)),
+    ("DayAheadPrices", "TimeDK", "DayAheadPriceDKK", date(2025, 10, 1)),
+]
+
+
+def hourly_prices(area: str, times, prices) -> pd.DataFrame:
+    """
+    Return a DataFrame with columns area, hour and price from prices in
+    DKK/MWh, averaging prices given for shorter intervals by hour.
+    """
+    df = pd.DataFrame(
+        {
+            "hour": pd.to_datetime(pd.Series(times, dtype=object)).dt.floor("h"),
+            "price": pd.Series(prices, dtype="float64") / 1000,
+        }
+    )
+    df = df.groupby("hour", as_index=False)["price"].mean()
+    df.insert(0, "area", area)
+    return df
+
+
+class EnergiDataServiceSource:
+    """
+    Spot prices from Energinet's Energi Data Service,
+    https://www.energidataservice.dk/.
+
+    Attributes:
+        base_url: The root URL of the API. Defaults to tools.spoturl, which
+            can be set with the ELOVERBLIK_SPOT_URL environment variable.
+        session: The requests.Session used for requests.
+        timeout: Timeout of requests in seconds.
+        max_retries: How many times a request is retried after it was
+            throttled, answered with a 5xx error, or the connection failed.
+    """
+
+    def __init__(self, base_url=None, session=None, timeout=(10, 300), max_retries=5) -> None:
+        self.base_url = (base_url or tools.spoturl).rstrip("/")
+        self.session = session if session is not None else requests.Session()
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+    def _get(self, url, params) -> requests.Response:
+        """Send a GET request, retrying it as described in send_with_retries."""
+        return send_with_retries(
+            lambda attempt: self.session.get(url, params=params, timeout=self.timeout),
+            self.max_retries,
+        )
+
+    def fetch(self, area: str, fromdate, todate) -> pd.DataFrame:
+        """
+        Return the spot prices of `area` from `fromdate` up to, but not
+        including, `todate`, both as "YYYY-MM-DD".
+        """
+        frames = []
+        for i, (dataset, timecol, pricecol, first) in enumerate(DATASETS):
+            last = DATASETS[i + 1][3] if i + 1 < len(DATASETS) else None
+            start = max(str(fromdate), str(first))
+            end = min(str(todate), str(last)) if last is not None else str(todate)
+            if start >= end:
+                continue
+            with span("spotprices", area=area, fromdate=start, todate=end) as timing:
+                response = self._get(
+                    f"{self.base_url}/dataset/{dataset}",
+                    params={
+                        "start": start,
+                        "end": end,
+                        "filter": json.dumps({"PriceArea": [area]}),
+                        "columns": f"{timecol},{pricecol}",
+                        "sort": f"{timecol} asc",
+                        "limit": 0,
+                    },
+                )
+                response.raise_for_status()
+                records = tools.json_loads(response.content)["records"]
+                timing.set(bytes=len(response.content), rows=len(records))
+            frames.append(
+                hourly_prices(
+                    area, [r[timecol] for r in records], [r[pricecol] for r in records]
+                )
+            )
+        if len(frames) == 0:
+            return hourly_prices(area, [], [])
+        return pd.concat(frames, ignore_index=True)
+
+
+class FileSource:
+    """
+    Spot prices read from a CSV or Parquet file with columns area, hour and
+    price, in DKK/kWh, e.g. for tests or to load prices from another provider.
+
+    Attributes:
+        path: The file.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+
+    def fetch(self, area: str, fromdate, todate) -> pd.DataFrame:
+        if self.path.suffix == ".parquet":
+            df = pd.read_parquet(self.path)
+        else:
+            df = pd.read_csv(self.path, parse_dates=["hour"])
+        df = df[
+            (df["area"] == area)
+            & (df["hour"] >= pd.Timestamp(fromdate))
+            & (df["hour"] < pd.Timestamp(todate))
+        ]
+        return df[["area", "hour", "price"]].reset_index(drop=True)
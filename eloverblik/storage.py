@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+class ParquetStore:
+    """
+    An append-only store of consumption data as Hive-partitioned Parquet
+    segments, laid out as `<path>/meter=<meterid>/year=<year>/part-*.parquet`.
+
+    Appending writes a new segment per partition. Readings of dates already
+    stored replace the old ones when they are written: the segments holding
+    them are merged with the new readings and removed, so the dataset holds
+    each (meterid, date) once and can be read without deduplication, and the
+    cost of an append is bounded by the size of a partition. Each segment is
+    written to a temporary file and renamed, so readers never see a partial
+    file. Segments of a partition are merged by `compact`. The dataset can be
+    queried by DuckDB with `read_parquet`, see `viewdef`, or copied as is to
+    another machine.
+
+    Attributes:
+        path: The root directory of the dataset.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self._compaction = None
+        # Appends and compaction both replace segments
+        self._lock = threading.Lock()
+
+    def partition(self, meterid, year) -> Path:
+        """Return the directory of a (meterid, year) partition."""
+        return self.path / f"meter={meterid}" / f"year={year}"
+
+    def segments(self, meterids=None, years=None) -> list:
+        """
+        Return the segment files, optionally only those of some meters and
+        years, in the order they were written.
+        """
+        meters = [f"meter={m}" for m in meterids] if meterids is not None else ["meter=*"]
+        years = [f"year={y}" for y in years] if years is not None else ["year=*"]
+        files = [
+            file
+            for m in meters
+            for y in years
+            for file in self.path.glob(f"{m}/{y}/part-*.parquet")
+        ]
+        return sorted(files, key=lambda f: f.name)
+
+    @staticmethod
+    def _write(directory: Path, table: pa.Table, name: str = None) -> Path:
+        """
+        Write `table` as a segment of `directory`, committing it with a
+        rename. If `name` is None, a new segment name is generated.
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        if name is None:
+            name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp = directory / f".{name}.tmp"
+        pq.write_table(table, tmp)
+        os.replace(tmp, directory / name)
+        return directory / name
+
+    def append(self, table: pa.Table) -> None:
+        """
+        Append rows with (at least) the columns meterid, date, kWh and quality,
+        writing one segment per (meterid, year) partition present in `table`.
+        Segments of the partition with readings of the same dates are merged
+        into the new segment, keeping the new readings, and removed.
+        """
+        table = table.select(["meterid", "date", "kWh", "quality"])
+        years = pc.year(table["date"])
+        for meterid in pc.unique(table["meterid"]).to_pylist():
+            formeter = pc.equal(table["meterid"], meterid)
+            for year in pc.unique(pc.filter(years, formeter)).to_pylist():
+                mask = pc.and_(formeter, pc.equal(years, year))
+                with self._lock:
+                    self._replace(self.partition(meterid, year), table.filter(mask))
+
+    def _replace(self, directory: Path, table: pa.Table) -> None:
+        """Write `table` to a partition, replacing the readings of its dates."""
+        superseded = [
+            file
+            for file in sorted(directory.glob("part-*.parquet"), key=lambda f: f.name)
+            if pc.any(
+                pc.is_in(pq.read_table(file, columns=["date"])["date"], value_set=table["date"])
+            ).as_py()
+        ]
+        if len(superseded) == 0:
+            self._write(directory, table)
+            return
+        previous = pa.concat_tables([pq.read_table(f) for f in superseded])
+        previous = previous.filter(
+            pc.invert(pc.is_in(previous["date"], value_set=table["date"]))
+        )
+        merged = pa.concat_tables([previous, table.cast(previous.schema)]).sort_by("date")
+        # The merged segment replaces the newest one, then the others are
+        # removed
+        self._write(directory, merged, name=superseded[-1].name)
+        for file in superseded[:-1]:
+            file.unlink()
+
+    def compact(self, meterids=None, years=None) -> int:
+        """
+        Merge the segments of each partition into one, sorted by date. If a
+        date is still stored more than once, e.g. after an append was
+        interrupted, the most recently written reading is kept.
+
+        Returns:
+            The number of segments removed.
+        """
+        removed = 0
+        partitions = {file.parent for file in self.segments(meterids, years)}
+        for directory in sorted(partitions):
+            with self._lock:
+                removed += self._compact_partition(directory)
+        return removed
+
+    def _compact_partition(self, directory: Path) -> int:
+        """Merge the segments of a partition into one."""
+        files = sorted(directory.glob("part-*.parquet"), key=lambda f: f.name)
+        if len(files) < 2:
+            return 0
+        table = pa.concat_tables([pq.read_table(f) for f in files])
+        # Number rows so the last written reading of a date is kept
+        table = table.append_column("_row", pa.array(range(len(table)), pa.int64()))
+        last = table.group_by("date").aggregate([("_row", "max")])["_row_max"]
+        table = table.take(last).select(["meterid", "date", "kWh", "quality"])
+        table = table.sort_by("date")
+        # Replace the newest merged segment, so that it keeps its place in
+        # the order segments were written
+        self._write(directory, table, name=files[-1].name)
+        for file in files[:-1]:
+            file.unlink()
+        return len(files) - 1
+
+    def start_compaction(self, meterids=None, years=None) -> threading.Thread:
+        """Run `compact` in a background thread, unless one is already running."""
+        if self._compaction is None or not self._compaction.is_alive():
+            self._compaction = threading.Thread(
+                target=self.compact, args=(meterids, years), name="parquet-compaction"
+            )
+            self._compaction.start()
+        return self._compaction
+
+    def clear(self) -> None:
+        """Remove every segment of the dataset."""
+        for file in self.segments():
+            file.unlink()
+
+    def viewdef(self, viewname: str) -> str:
+        """
+        Return a query creating a view with the columns of the consumption
+        table over the dataset. The meterid is read from the partition
+        directories, so DuckDB only opens the segments of the meters a query
+        filters on.
+        """
+        query = f"""
+        CREATE OR REPLACE VIEW {viewname} AS
+        SELECT meter as meterid, date, CAST(kWh AS DECIMAL(9, 3)) as kWh, quality
+        FROM read_parquet(
+            '{self.path.as_posix()}/meter=*/year=*/part-*.parquet',
+            hive_partitioning=true, hive_types={{'meter': VARCHAR, 'year': INTEGER}}
+        )
+        """
+        return query
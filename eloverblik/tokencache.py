@@ -0,0 +1,77 @@
+import base64
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+# Lifetime assumed for a data access token whose expiry cannot be decoded
+DEFAULT_LIFETIME = 24 * 3600
+
+
+def token_expiry(token: str) -> float:
+    """
+    Return the expiry of a data access token as a UNIX timestamp.
+
+    Data access tokens are JWTs, so the `exp` claim is read from the payload.
+    If the token cannot be decoded, it is assumed to be valid for 24 hours.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, ValueError, KeyError, TypeError):
+        return time.time() + DEFAULT_LIFETIME
+
+
+def _fingerprint(refresh_token: str) -> str:
+    """Identify a refresh token without storing it."""
+    return hashlib.sha256(refresh_token.strip().encode()).hexdigest()
+
+
+def load_token(path: Path, refresh_token: str, margin: float = 3600):
+    """
+    Read a cached data access token.
+
+    Parameters:
+        path: The cache file.
+        refresh_token: The refresh token the data access token was issued for.
+        margin: Tokens expiring within `margin` seconds are not returned.
+
+    Returns:
+        A (token, expires) tuple, or None if there is no usable cached token.
+    """
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("refresh_token") != _fingerprint(refresh_token):
+        return None
+    if cached.get("expires", 0) - margin < time.time():
+        return None
+    return cached["token"], cached["expires"]
+
+
+def save_token(path: Path, refresh_token: str, token: str, expires: float) -> None:
+    """
+    Write a data access token to the cache file, readable only by the owner.
+
+    The file is written to a temporary file first and renamed, so that
+    concurrent processes never read a partially written cache.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(
+            {
+                "refresh_token": _fingerprint(refresh_token),
+                "token": token,
+                "expires": expires,
+            },
+            f,
+        )
+    os.replace(tmp, path)
+
@@ -1,10 +1,78 @@
+import json
+import os
+import random
+import time
+from collections import deque
+import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 from pathlib import Path
+from datetime import date
+from eloverblik.cache import CachedResponse
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 basepath = Path(__file__).parent.parent
-datapath = basepath / "data/data.duckdb"
+# The data directory and the API can be changed through environment
+# variables, e.g. to run against the local mock API in eloverblik.mockapi
+datadir = Path(os.environ.get("ELOVERBLIK_DATA_DIR", basepath / "data"))
+datapath = datadir / "data.duckdb"
+tokencachepath = datadir / "access_token.json"
+cachepath = datadir / "cache"
+parquetpath = datadir / "consumption"
+statuspath = datadir / "serve.json"
+apiurl = os.environ.get("ELOVERBLIK_API_URL", "https://api.eloverblik.dk/CustomerApi/api")
+spoturl = os.environ.get("ELOVERBLIK_SPOT_URL", "https://api.energidataservice.dk")
+
+# Quality codes of readings which are not final: not available, estimated
+# and incomplete
+ESTIMATED_QUALITY = ("A02", "A03", "A05")
+
+# Length in minutes of the `resolution` values used by TimeSeries periods
+RESOLUTIONS = {"PT15M": 15, "PT1H": 60, "P1D": 1440, "P1M": 44640}
+
+
+def get_db_version(path) -> str:
+    """
+    Return the version stamp of the database at `path`, which changes every
+    time the database is built, updated or backfilled. Reading it does not
+    open the database, so it does not conflict with a running writer.
+    """
+    try:
+        with open(f"{path}.version") as f:
+            return f.read()
+    except FileNotFoundError:
+        # Databases written before version stamps existed
+        try:
+            return str(Path(path).stat().st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+
+def bump_db_version(path) -> None:
+    """Write a new version stamp for the database at `path`."""
+    tmp = f"{path}.version.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(str(time.time_ns()))
+    os.replace(tmp, f"{path}.version")
+
+
+def price_area(postcode) -> str:
+    """
+    Return the spot price area of a Danish postcode: DK2 east of the Great
+    Belt (Zealand, Lolland-Falster and Bornholm), DK1 west of it.
+    """
+    try:
+        return "DK2" if int(postcode) < 5000 else "DK1"
+    except (TypeError, ValueError):
+        return None
 
 
 def get_headers(token):
@@ -16,26 +84,228 @@ def get_headers(token):
     return headers
 
 
-def data_to_df(data):
-    """ """
-    df = pd.json_normalize(
-        data.json()["result"][0]["MyEnergyData_MarketDocument"]["TimeSeries"][0][
-            "Period"
-        ],
-        record_path="Point",
-        meta=[["timeInterval", "end"]],
+# HTTP status codes the APIs use to signal throttling
+THROTTLE_STATUS = (429, 503)
+# HTTP status codes of transient server errors worth retrying
+RETRY_STATUS = (500, 502, 504)
+
+
+def backoff(attempt: int, base: float = 1.0) -> float:
+    """Return the exponential backoff `base * 2 ** attempt`, with up to 10% jitter."""
+    return base * 2**attempt * (1 + random.random() / 10)
+
+
+def retry_after(response, attempt: int, base: float = 1.0) -> float:
+    """
+    Return how many seconds to wait before retrying a throttled request.
+
+    Honours the `Retry-After` header when the API sends one in seconds,
+    otherwise backs off exponentially.
+    """
+    value = response.headers.get("Retry-After")
+    if value is not None:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+    return backoff(attempt, base)
+
+
+def consumption_periods(mindate: str, today: date = None) -> list:
+    """
+    Split the history of a meter into the (fromdate, todate) ranges requested
+    from the API: one range per calendar year, starting at `mindate` and
+    ending today.
+
+    Parameters:
+        mindate: The first date with data, as a string "YYYY-MM-DD".
+        today: The last date to request. Defaults to `date.today()`.
+
+    Returns:
+        A list of (fromdate, todate) tuples of strings.
+    """
+    if today is None:
+        today = date.today()
+    mindate = str(mindate)
+    minyear = int(mindate[:4])
+    periods = []
+    for year in range(minyear, today.year):
+        # Determine when to start querying the API
+        if year == minyear:
+            startdate = mindate
+        else:
+            startdate = f"{year}-01-01"
+        periods += [(startdate, f"{year+1}-01-01")]
+    if minyear < today.year:
+        startdate = f"{today.year}-01-01"
+    else:
+        startdate = mindate
+    periods += [(startdate, str(today))]
+    return periods
+
+
+def response_json(response):
+    """Decode the body of an API response, using orjson when it is installed."""
+    if isinstance(response, CachedResponse):
+        return response.json()
+    return json_loads(response.content)
+
+
+def result_meterid(result):
+    """Return the meterid a `result` entry of a timeseries or charges response refers to."""
+    if result.get("id"):
+        return result["id"]
+    if result.get("MyEnergyData_MarketDocument"):
+        return result["MyEnergyData_MarketDocument"]["TimeSeries"][0]["mRID"]
+    return (result.get("result") or {}).get("meteringPointId")
+
+
+def result_error(result):
+    """
+    Return the error of a `result` entry of a timeseries or charges response
+    the API could not answer for its meter, or None if the entry has data.
+
+    The API answers a batched request with HTTP 200 even when it fails for
+    some of the meters, whose entries have `"success": false` and a null
+    document instead.
+    """
+    document = result.get("MyEnergyData_MarketDocument", result.get("result"))
+    if result.get("success", True) and document is not None:
+        return None
+    return f"error {result.get('errorCode')}: {result.get('errorText')}"
+
+
+def result_errors(results) -> dict:
+    """Return a dictionary mapping meterid to error for the failed `result` entries."""
+    errors = {}
+    for result in results:
+        error = result_error(result)
+        if error is not None:
+            errors[result_meterid(result)] = error
+    return errors
+
+
+def timeseries_arrays(results) -> dict:
+    """
+    Convert the `result` entries of a timeseries response to a dictionary of
+    NumPy arrays meterid, date, kWh, quality and resolution, the length in
+    minutes of each reading.
+
+    The document is walked once, collecting flat lists which are converted to
+    arrays. The date of a point is the day of the period's `timeInterval.end`
+    plus `(position - 1) * resolution`, so hourly and quarter-hourly periods
+    can be mixed, e.g. when a meter switched to 15-minute readings. Entries
+    the API failed to answer are skipped, see `result_errors`.
+    """
+    meterids, days, steps, counts = [], [], [], []
+    positions, quantities, qualities = [], [], []
+    for result in results:
+        if result_error(result) is not None:
+            continue
+        meterid = result_meterid(result)
+        for timeseries in result["MyEnergyData_MarketDocument"]["TimeSeries"]:
+            for period in timeseries["Period"]:
+                points = period["Point"]
+                meterids.append(meterid)
+                days.append(period["timeInterval"]["end"][:10])
+                steps.append(RESOLUTIONS[period.get("resolution", "PT1H")])
+                counts.append(len(points))
+                positions += [p["position"] for p in points]
+                quantities += [p["out_Quantity.quantity"] for p in points]
+                qualities += [p["out_Quantity.quality"] for p in points]
+
+    counts = np.array(counts, dtype=np.int64)
+    steps = np.repeat(np.array(steps, dtype=np.int64), counts)
+    offsets = (np.array(positions, dtype=np.int64) - 1) * steps
+    dates = np.repeat(np.array(days, dtype="datetime64[D]"), counts).astype(
+        "datetime64[m]"
+    ) + offsets.astype("timedelta64[m]")
+    meterids = np.repeat(np.array(meterids, dtype=object), counts)
+
+    # On the day daylight saving time ends the points after the 24th hour
+    # fall on the first hour of the next day, e.g. positions 97 to 100 of a
+    # PT15M period, which the next day's period covers too. Keep the last
+    # point of each (meterid, date) in the batch so the pair is unique.
+    codes = np.unique(meterids, return_inverse=True)[1]
+    order = np.lexsort((np.arange(len(dates)), dates, codes))
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (dates[order[:-1]] != dates[order[1:]]) | (codes[order[:-1]] != codes[order[1:]])
+    keep = np.zeros(len(dates), dtype=bool)
+    keep[order[last]] = True
+    return {
+        "meterid": meterids[keep],
+        "date": dates[keep].astype("datetime64[us]"),
+        "kWh": np.array(quantities, dtype=np.float64)[keep],
+        "quality": np.array(qualities, dtype=object)[keep],
+        "resolution": steps[keep],
+    }
+
+
+def parse_timeseries(results) -> pd.DataFrame:
+    """
+    Convert the `result` entries of a timeseries response to a DataFrame with
+    columns meterid, date, kWh and quality.
+    """
+    arrays = timeseries_arrays(results)
+    df = pd.DataFrame({k: arrays[k] for k in ("meterid", "date", "kWh", "quality")})
+    df["date"] = df["date"].astype("datetime64[ns]")
+    return df
+
+
+def data_to_arrow(data) -> pa.Table:
+    """
+    Convert a timeseries response covering one or several meters to an Arrow
+    table with the columns of the "readings" table, meterid, minute, Wh and
+    quality, and the resolution of each reading in minutes, ready to be
+    inserted into DuckDB without going through pandas.
+    """
+    arrays = timeseries_arrays(response_json(data)["result"])
+    minutes = arrays["date"].astype("datetime64[m]").astype(np.int64)
+    return pa.table(
+        {
+            "meterid": pa.array(arrays["meterid"], type=pa.string()),
+            "minute": pa.array(minutes, type=pa.int32()),
+            "Wh": pa.array(np.rint(arrays["kWh"] * 1000).astype(np.int64), type=pa.int32()),
+            "quality": pa.array(arrays["quality"], type=pa.string()),
+            "resolution": pa.array(arrays["resolution"], type=pa.int16()),
+        }
     )
-    df = df.drop(columns=["out_Quantity.quality"])
 
-    df.columns = ["hour", "kWh", "date"]
-    df["date"] = pd.to_datetime(df["date"]).dt.normalize() + pd.to_timedelta(
-        (df["hour"].astype(int) - 1).astype(int), unit="hours"
+
+def readings_to_consumption(table: pa.Table) -> pa.Table:
+    """
+    Convert a table returned by `data_to_arrow` to the columns of the
+    consumption view, meterid, date, kWh and quality.
+    """
+    minutes = pc.cast(table["minute"], pa.int64())
+    return pa.table(
+        {
+            "meterid": table["meterid"],
+            "date": pc.cast(pc.multiply(minutes, 60_000_000), pa.timestamp("us")),
+            "kWh": pc.divide(pc.cast(table["Wh"], pa.float64()), 1000.0),
+            "quality": table["quality"],
+        }
     )
-    return df[["date", "kWh"]]
 
 
-def extract_tariffs(data):
-    hdata = pd.json_normalize(data.json()['result'][0]['result']['tariffs'], 'prices', meta='name')
+def ordered_map(executor, func, iterable, window: int):
+    """
+    Like `executor.map`, but with at most `window` calls submitted and not
+    yet consumed, so that results do not pile up in memory when the caller
+    is slower than the workers. Results are yielded in the input order.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def tariffs_to_df(tariffs):
+    """Convert the `tariffs` list of a charges result to a DataFrame by hour."""
+    hdata = pd.json_normalize(tariffs, 'prices', meta='name')
     Ct = hdata.query("name=='Nettarif C time'")[['position', 'price']]
     Ct.columns = ['hour', 'Nettarif C time']
     oth = hdata.query("name!='Nettarif C time'").pivot(columns='name', values='price', index='position')
@@ -43,10 +313,86 @@ def extract_tariffs(data):
     return tariffs
 
 
+def batch_extract_tariffs(data):
+    """
+    Extract current tariffs from a charges response covering several meters,
+    returning a single DataFrame with a meterid column. Entries the API
+    failed to answer are skipped.
+    """
+    dflist = []
+    for result in response_json(data)["result"]:
+        if result_error(result) is not None:
+            continue
+        tariffs = tariffs_to_df(result["result"]["tariffs"])
+        tariffs['meterid'] = result_meterid(result)
+        dflist += [tariffs]
+    return pd.concat(dflist)
+
+
+def tariff_history(data) -> pd.DataFrame:
+    """
+    Convert the tariffs of a charges response covering several meters to a
+    DataFrame with columns meterid, name, validfrom, validto, hour and price,
+    with one row per tariff, validity period and hour of day.
+
+    Validity dates are converted from UTC to Danish local time, like the
+    dates of consumption readings, and `validto` is NaT for tariffs without
+    an end. Tariffs with a single price apply to every hour, and tariffs
+    priced by quarter-hour are averaged by hour. Entries the API failed to
+    answer are skipped.
+    """
+    meterids, names, validfrom, validto, positions, npositions, prices = (
+        [] for _ in range(7)
+    )
+    for result in response_json(data)["result"]:
+        if result_error(result) is not None:
+            continue
+        meterid = result_meterid(result)
+        for tariff in result["result"].get("tariffs", []):
+            points = tariff["prices"]
+            meterids += [meterid] * len(points)
+            names += [tariff["name"]] * len(points)
+            validfrom += [tariff["validFromDate"]] * len(points)
+            validto += [tariff.get("validToDate")] * len(points)
+            npositions += [len(points)] * len(points)
+            positions += [int(p["position"]) for p in points]
+            prices += [float(p["price"]) for p in points]
+
+    df = pd.DataFrame(
+        {
+            "meterid": meterids,
+            "name": names,
+            "validfrom": validfrom,
+            "validto": validto,
+            "position": positions,
+            "npositions": npositions,
+            "price": prices,
+        }
+    )
+    flat = df[df["npositions"] == 1]
+    flat = flat.loc[flat.index.repeat(24)].assign(
+        position=np.tile(np.arange(1, 25), len(flat)), npositions=24
+    )
+    df = pd.concat([df[df["npositions"] > 1], flat], ignore_index=True)
+    df["hour"] = (df["position"] - 1) * 24 // df["npositions"]
+    for column in ["validfrom", "validto"]:
+        df[column] = (
+            pd.to_datetime(df[column], utc=True)
+            .dt.tz_convert("Europe/Copenhagen")
+            .dt.tz_localize(None)
+        )
+    return df.groupby(
+        ["meterid", "name", "validfrom", "hour"], as_index=False, dropna=False
+    ).agg(validto=("validto", "first"), price=("price", "mean"))[
+        ["meterid", "name", "validfrom", "validto", "hour", "price"]
+    ]
+
+
 def parquet_append(filepath: Path or str, df: pd.DataFrame) -> None:
     """
     Append to dataframe to existing .parquet file. Reads original .parquet file
-    in, appends new dataframe, writes new .parquet file out.
+    in, appends new dataframe, writes new .parquet file out. This rewrites the
+    whole file: to append to a growing dataset use storage.ParquetStore.
     :param filepath: Filepath for parquet file.
     :param df: Pandas dataframe to append. Must be same schema as original.
     """
@@ -57,21 +403,386 @@ def parquet_append(filepath: Path or str, df: pd.DataFrame) -> None:
     table_to_append = pa.Table.from_pandas(df)
     # Attempt to cast new schema to existing, e.g. datetime64[ns] to datetime64[us] (may throw otherwise).
     table_to_append = table_to_append.cast(table_original_file.schema)
-    # Overwrite old file with empty.
-    # WARNING: PRODUCTION LEVEL CODE SHOULD BE MORE ATOMIC: WRITE TO A TEMPORARY FILE, DELETE THE OLD, RENAME. THEN FAILURES WILL NOT LOSE DATA.
-    handle = pq.ParquetWriter(filepath, table_original_file.schema)
+    # Write to a temporary file and rename it, so that failures do not lose data.
+    tmp = f"{filepath}.tmp"
+    handle = pq.ParquetWriter(tmp, table_original_file.schema)
     handle.write_table(table_original_file)
     handle.write_table(table_to_append)
     # Writes binary footer. Until this occurs, .parquet file is not usable.
     handle.close()
+    os.replace(tmp, filepath)
+
+
+def is_view(conn, name: str) -> bool:
+    """Return True if `name` is a view in the database."""
+    return conn.execute(
+        "select count(*) from duckdb_views() where view_name = ?", [name]
+    ).fetchone()[0] > 0
+
+
+def is_table(conn, name: str) -> bool:
+    """Return True if `name` is a table in the database."""
+    return conn.execute(
+        "select count(*) from duckdb_tables() where table_name = ?", [name]
+    ).fetchone()[0] > 0
+
+
+def tabledef_readings(tablename: str) -> str:
+    """
+    Readings are stored compactly: `minute` is the start of the reading in
+    minutes since 1970-01-01 00:00, Danish time like the dates of the
+    consumption view, and `Wh` the consumption in integer Wh, which is the
+    precision of the API. The "consumption" view decodes them.
+    """
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , minute INTEGER
+        , Wh INTEGER
+        , quality VARCHAR
+        , PRIMARY KEY (meterid, minute)
+    );
+    """
+    return query
+
+
+def viewdef_consumption(viewname: str, source: str = "readings") -> str:
+    """
+    Return a query creating a view with the columns meterid, date, kWh and
+    quality over the compact readings of `source`, see tabledef_readings.
+    """
+    query = f"""
+    CREATE OR REPLACE VIEW {viewname} AS
+    SELECT meterid, TIMESTAMP '1970-01-01 00:00:00' + to_minutes(minute) as date
+    , CAST(Wh / 1000 AS DECIMAL(9, 3)) as kWh, quality
+    FROM {source}
+    """
+    return query
+
+
+def tabledef_meter_resolution(tablename: str) -> str:
+    """The length in minutes of the latest readings of each meter, and their start."""
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , resolution SMALLINT
+        , minute INTEGER
+        , PRIMARY KEY (meterid)
+    );
+    """
+    return query
+
+
+def upsert_meter_resolution(source: str) -> str:
+    """
+    Return a query recording the resolution of the latest reading of each
+    meter in `source`, unless a later reading was already recorded.
+    """
+    query = f"""
+    INSERT INTO meter_resolution (meterid, resolution, minute)
+    SELECT meterid, arg_max(resolution, minute), MAX(minute) FROM {source}
+    GROUP BY meterid
+    ON CONFLICT (meterid) DO UPDATE
+    SET resolution = excluded.resolution, minute = excluded.minute
+    WHERE excluded.minute >= meter_resolution.minute;
+    """
+    return query
+
+
+def tabledef_coverage(tablename: str) -> str:
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , fromdate DATE
+        , todate DATE
+        , fetched TIMESTAMP
+    );
+    """
+    return query
+
+
+def tabledef_failed_ranges(tablename: str) -> str:
+    """The ranges of each meter which could not be downloaded, requested again by the next update."""
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , fromdate DATE
+        , todate DATE
+        , error VARCHAR
+        , failed TIMESTAMP
+    );
+    """
+    return query
 
 
-def tabledef_consumption(tablename: str) -> str:
+def tabledef_tariffs(tablename: str) -> str:
     query = f"""
     CREATE TABLE {tablename} (
         meterid VARCHAR
-        , date TIMESTAMP
-        , kWh DECIMAL(9, 2)
+        , name VARCHAR
+        , validfrom TIMESTAMP
+        , validto TIMESTAMP
+        , hour INTEGER
+        , price DECIMAL(12, 6)
+        , PRIMARY KEY (meterid, name, validfrom, hour)
     );
     """
     return query
+
+
+def upsert_tariffs(source: str) -> str:
+    """Return a query upserting the rows of `source` into tariffs."""
+    query = f"""
+    INSERT INTO tariffs (meterid, name, validfrom, validto, hour, price)
+    SELECT meterid, name, validfrom, validto, hour, price FROM {source}
+    ON CONFLICT (meterid, name, validfrom, hour) DO UPDATE
+    SET validto = excluded.validto, price = excluded.price;
+    """
+    return query
+
+
+def tariff_schedule(tablename: str) -> str:
+    """
+    Return a query creating a table with the total tariff of each meter by
+    hour of day, from every date on which any of its tariffs starts or ends.
+    A tariff ends at the latest when the next price of the same name starts,
+    so a superseded price without `validto` is not added to its replacement.
+    The tariff applying to a reading is the one of the latest `validfrom`
+    not after it, which DuckDB finds with an ASOF join.
+    """
+    query = f"""
+    CREATE OR REPLACE TABLE {tablename} AS
+    WITH superseded AS (
+        select meterid, name, validfrom
+        , lead(validfrom) over (partition by meterid, name order by validfrom) as nextfrom
+        from (select distinct meterid, name, validfrom from tariffs)
+    ), effective AS (
+        select t.meterid, t.hour, t.price, t.validfrom, least(t.validto, s.nextfrom) as validto
+        from tariffs as t
+        inner join superseded as s
+        on s.meterid=t.meterid and s.name=t.name and s.validfrom=t.validfrom
+    ), changes AS (
+        select meterid, validfrom as changed from effective
+        union
+        select meterid, validto from effective where validto is not null
+    )
+    select c.meterid, c.changed as validfrom, h.hour
+    , CAST(COALESCE(SUM(t.price), 0) AS DECIMAL(12, 6)) as price
+    from changes as c
+    cross join (select range as hour from range(24)) as h
+    left join effective as t
+    on t.meterid=c.meterid and t.hour=h.hour
+    and t.validfrom <= c.changed and (t.validto is null or t.validto > c.changed)
+    group by c.meterid, c.changed, h.hour
+    order by c.meterid, c.changed, h.hour
+    """
+    return query
+
+
+def viewdef_consumption_cost(viewname: str) -> str:
+    """
+    Return a query creating a view with the tariff, cost, spot price and spot
+    cost of every reading. Readings from before the first known tariff of a
+    meter have no cost, and readings without a spot price no spot cost.
+    """
+    query = f"""
+    CREATE OR REPLACE VIEW {viewname} AS
+    SELECT c.meterid, c.date, c.kWh, s.price as tariff, c.kWh * s.price as cost
+    , p.price as spot_price, c.kWh * p.price as spot_cost
+    FROM consumption as c
+    LEFT JOIN meterinfo as mi on mi.meteringPointId=c.meterid
+    LEFT JOIN spot_prices as p on p.area=mi.priceArea and p.hour=date_trunc('hour', c.date)
+    ASOF LEFT JOIN tariff_schedule as s
+    ON c.meterid=s.meterid AND HOUR(c.date)=s.hour AND c.date >= s.validfrom
+    """
+    return query
+
+
+def tabledef_spot_prices(tablename: str) -> str:
+    query = f"""
+    CREATE TABLE {tablename} (
+        area VARCHAR
+        , hour TIMESTAMP
+        , price DECIMAL(12, 6)
+        , PRIMARY KEY (area, hour)
+    );
+    """
+    return query
+
+
+def upsert_spot_prices(source: str) -> str:
+    """Return a query upserting the rows of `source` into spot_prices."""
+    query = f"""
+    INSERT INTO spot_prices (area, hour, price)
+    SELECT area, hour, price FROM {source}
+    ORDER BY area, hour
+    ON CONFLICT (area, hour) DO UPDATE SET price = excluded.price;
+    """
+    return query
+
+
+def tabledef_consumption_daily(tablename: str) -> str:
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , day DATE
+        , kWh DECIMAL(18, 3)
+        , n INTEGER
+        , cost DECIMAL(18, 4)
+        , spot_cost DECIMAL(18, 4)
+    );
+    """
+    return query
+
+
+def tabledef_consumption_monthly(tablename: str) -> str:
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , month DATE
+        , kWh DECIMAL(18, 3)
+        , n INTEGER
+        , cost DECIMAL(18, 4)
+        , spot_cost DECIMAL(18, 4)
+    );
+    """
+    return query
+
+
+def tabledef_consumption_yearly(tablename: str) -> str:
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , year INTEGER
+        , kWh DECIMAL(18, 3)
+        , n INTEGER
+        , cost DECIMAL(18, 4)
+        , spot_cost DECIMAL(18, 4)
+    );
+    """
+    return query
+
+
+def tabledef_consumption_hourly(tablename: str) -> str:
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , year INTEGER
+        , month INTEGER
+        , hour INTEGER
+        , kWh DECIMAL(18, 3)
+        , n INTEGER
+    );
+    """
+    return query
+
+
+# Rollups of the consumption table maintained by DatabaseBuilder: kWh is the
+# total consumption, n the number of hours with readings, whatever their
+# resolution, cost the total of the tariffs paid for it, see tariff_schedule,
+# and spot_cost its value at spot prices. consumption_hourly holds
+# totals by hour of day for each month, from which any season can be derived.
+# They have no key because DuckDB cannot delete and re-insert a key in the
+# same transaction.
+ROLLUP_TABLES = {
+    "consumption_daily": tabledef_consumption_daily,
+    "consumption_monthly": tabledef_consumption_monthly,
+    "consumption_yearly": tabledef_consumption_yearly,
+    "consumption_hourly": tabledef_consumption_hourly,
+}
+
+
+def tabledef_stats_pending(tablename: str) -> str:
+    """Readings downloaded since the statistics were last updated."""
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , minute INTEGER
+        , Wh INTEGER
+        , resolution SMALLINT
+    );
+    """
+    return query
+
+
+def tabledef_consumption_stats(tablename: str) -> str:
+    """
+    The number, mean and sum of squared deviations of the hourly consumption
+    of each meter by hour of the week, 0 being Monday 00:00.
+    """
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , how SMALLINT
+        , n BIGINT
+        , mean DOUBLE
+        , m2 DOUBLE
+        , PRIMARY KEY (meterid, how)
+    );
+    """
+    return query
+
+
+def tabledef_consumption_sketch(tablename: str) -> str:
+    """Histograms of the hourly consumption by hour of the week, see eloverblik.anomalies."""
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , how SMALLINT
+        , bin SMALLINT
+        , n BIGINT
+        , PRIMARY KEY (meterid, how, bin)
+    );
+    """
+    return query
+
+
+def tabledef_stats_watermark(tablename: str) -> str:
+    """The start of the last hour of each meter included in the statistics."""
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , minute INTEGER
+        , PRIMARY KEY (meterid)
+    );
+    """
+    return query
+
+
+def tabledef_consumption_anomalies(tablename: str) -> str:
+    query = f"""
+    CREATE TABLE {tablename} (
+        meterid VARCHAR
+        , hour TIMESTAMP
+        , kWh DECIMAL(9, 3)
+        , expected DOUBLE
+        , z DOUBLE
+        , rank DOUBLE
+        , flag VARCHAR
+        , PRIMARY KEY (meterid, hour)
+    );
+    """
+    return query
+
+
+# Tables maintained by eloverblik.anomalies: the readings not yet included in
+# the statistics, the statistics, and the anomaly scores of each hour
+STATS_TABLES = {
+    "stats_pending": tabledef_stats_pending,
+    "consumption_stats": tabledef_consumption_stats,
+    "consumption_sketch": tabledef_consumption_sketch,
+    "stats_watermark": tabledef_stats_watermark,
+    "consumption_anomalies": tabledef_consumption_anomalies,
+}
+
+
+def upsert_readings(source: str) -> str:
+    """Return a query upserting the rows of `source` into readings."""
+    query = f"""
+    INSERT INTO readings (meterid, minute, Wh, quality)
+    SELECT meterid, minute, Wh, quality FROM {source}
+    ORDER BY meterid, minute
+    ON CONFLICT (meterid, minute) DO UPDATE
+    SET Wh = excluded.Wh, quality = excluded.quality;
+    """
+    return query
@@ -13,6 +13,10 @@ setup(
         'altair',
         'matplotlib'
     ],
+    extras_require={
+        'fast': ['orjson'],
+        'test': ['pytest'],
+    },
     entry_points={
         'console_scripts': [
             'eloverblik = eloverblik.scripts.eldata:eloverblik',
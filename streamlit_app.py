@@ -4,7 +4,16 @@ from eloverblik.eloverblik import DatabaseBuilder
 
 st.header("Electricity overview")
 
-if st.button("Update database"):
+updater = eloverblik.dashboard.get_updater_status()
+if updater is not None:
+    # `eloverblik serve` keeps the database updated, the dashboard only reads
+    st.write(
+        f"The database is updated by `eloverblik serve` (status: {updater['status']},"
+        f" readings at most {updater['max_lag_hours']} hours behind)"
+    )
+elif st.button("Update database"):
+    # The update needs the database for writing
+    eloverblik.dashboard.close_connection()
     db = DatabaseBuilder()
     db.update_dataset()
     st.write("Database updated")
@@ -41,6 +50,24 @@ st.write(
 
 st.write(eloverblik.dashboard.chart_year_rolling_avgs(meterid=meterid))
 
+anomaly_summary = eloverblik.dashboard.get_anomaly_summary()
+if anomaly_summary is not None:
+    st.write(
+        """
+    **Unusual consumption**
+
+    Each new hourly reading is compared with the consumption of the same meter
+    at the same hour of the week so far. Hours far above or below it, e.g. a
+    heat pump running constantly or a boiler losing heat, are flagged as high
+    or low. Below are the flagged hours of each meter in the last week, and the
+    last two weeks of the selected meter.
+    """
+    )
+    st.write(anomaly_summary)
+    chart = eloverblik.dashboard.chart_anomalies(meterid)
+    if chart is not None:
+        st.write(chart)
+
 
 st.write(
     """
@@ -54,6 +81,20 @@ an overview of your hourly tariffs and its composition.
 
 st.write(eloverblik.dashboard.current_tariffs_graph(meterid))
 
+st.write(
+    """
+**Cost of consumption**
+
+The cost of your consumption in tariffs and at spot prices, computed from the
+tariffs and prices of each hourly reading, without VAT, taxes and the fees of
+your electricity supplier. Hours before the oldest known tariff of a meter
+have no tariff cost.
+"""
+)
+
+st.write(eloverblik.dashboard.get_cost_by_year())
+st.write(eloverblik.dashboard.chart_monthly_cost(meterid))
+
 st.write(
     """
 It can then be useful to understand your hourly consumption patterns. The graph
@@ -62,6 +103,8 @@ years and seasons. You can compare two periods using the selection menus.
 """
 )
 
+years = eloverblik.dashboard.get_years_in_db()
+
 col1, col2 = st.columns(2)
 with col1:
     st.write(
@@ -69,8 +112,8 @@ with col1:
     )
     years1 = st.multiselect(
         "Years",
-        eloverblik.dashboard.get_years_in_db(),
-        eloverblik.dashboard.get_years_in_db(),
+        years,
+        years,
         key="years1",
     )
     summer1 = st.checkbox("Summer", key="summer1", value=True)
@@ -82,8 +125,8 @@ with col2:
     )
     years2 = st.multiselect(
         "Years",
-        eloverblik.dashboard.get_years_in_db(),
-        eloverblik.dashboard.get_years_in_db(),
+        years,
+        years,
         key="years2",
     )
     summer2 = st.checkbox("Summer", key="summer2")
@@ -94,3 +137,6 @@ st.write(
         meterid, years1, summer1, winter1, years2, summer2, winter2, width=0.35
     )
 )
+
+# Release the database between reruns, so that updates are not blocked
+eloverblik.dashboard.close_connection()
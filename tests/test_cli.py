@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from eloverblik.scripts.eldata import eloverblik
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Dependencies only the commands doing the work should import
+HEAVY = (
+    "altair", "duckdb", "matplotlib", "numpy", "pandas", "pyarrow", "requests", "streamlit",
+)
+
+CHILD = 'from eloverblik.scripts.eldata import eloverblik; eloverblik({args!r}, prog_name="eloverblik")'
+
+
+def imported_modules(args: list) -> set:
+    """Run the CLI with `args` in a fresh interpreter and return the top-level modules it imported."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(ROOT), os.environ.get("PYTHONPATH", "")]))
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD.format(args=args)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    assert process.returncode == 0, process.stderr
+    return {
+        line.split("|")[-1].strip().split(".")[0]
+        for line in process.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+
+@pytest.mark.parametrize(
+    "args", [["--help"]] + [[command, "--help"] for command in sorted(eloverblik.commands)]
+)
+def test_help_imports_no_heavy_dependency(args):
+    assert imported_modules(args).isdisjoint(HEAVY)
@@ -0,0 +1,57 @@
+from datetime import timedelta
+
+import duckdb
+
+from eloverblik import tools
+from eloverblik.cache import CachedResponse
+from eloverblik.mockapi import Fleet
+
+
+def dst_end_response(meters=2):
+    """
+    A PT15M response for two days, where the first day ends like the day
+    daylight saving time ends: its period has 100 points, and points 97 to
+    100 fall on the first hour of the second day.
+    """
+    fleet = Fleet(meters, 1, resolution="PT15M")
+    response = {
+        "result": [
+            fleet.timeseries(m, fleet.start, fleet.start + timedelta(days=2))
+            for m in fleet.meterids
+        ]
+    }
+    for result in response["result"]:
+        first = result["MyEnergyData_MarketDocument"]["TimeSeries"][0]["Period"][0]
+        first["Point"] += [
+            {"position": str(96 + p), "out_Quantity.quantity": "9.999", "out_Quantity.quality": "A04"}
+            for p in range(1, 5)
+        ]
+    return response
+
+
+def test_dst_end_keeps_next_day_points():
+    df = tools.parse_timeseries(dst_end_response()["result"])
+    assert len(df) == 2 * 2 * 96
+    assert not df.duplicated(["meterid", "date"]).any()
+    assert (df["kWh"] != 9.999).all()
+
+
+def test_dst_end_upserts_into_readings():
+    conn = duckdb.connect()
+    conn.execute(tools.tabledef_readings("readings"))
+    batch = tools.data_to_arrow(CachedResponse(dst_end_response()))
+    conn.execute(tools.upsert_readings("batch"))
+    assert conn.execute("select count(*) from readings").fetchone()[0] == 2 * 2 * 96
+
+
+def test_duplicates_across_results_keep_the_last():
+    fleet = Fleet(1, 1)
+    day = fleet.start
+    first = fleet.timeseries(fleet.meterids[0], day, day + timedelta(days=2))
+    second = fleet.timeseries(fleet.meterids[0], day + timedelta(days=1), day + timedelta(days=2))
+    for point in second["MyEnergyData_MarketDocument"]["TimeSeries"][0]["Period"][0]["Point"]:
+        point["out_Quantity.quantity"] = "9.999"
+
+    arrays = tools.timeseries_arrays([first, second])
+    assert len(arrays["date"]) == 48
+    assert (arrays["kWh"][24:] == 9.999).all() and (arrays["kWh"][:24] != 9.999).all()